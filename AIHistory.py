@@ -1,22 +1,17 @@
 import json
-import os
-import re  # Ensure this import is present!
-import openai
 import logging
-from google.cloud import bigquery  # Import BigQuery client
-from datetime import date
-from dotenv import load_dotenv
+from typing import TYPE_CHECKING
+# The BigQuery SDK (and .env loading) is deferred until first use.
+from patient_history import services
+from patient_history import llm_gateway, structured_output
 
-# Load environment variables
-load_dotenv()
-
-# Set your OpenAI API key from the environment
-openai.api_key = os.getenv("OPENAI_API_KEY")
+if TYPE_CHECKING:
+    from google.cloud import bigquery
 
 # Set up logging
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
-def fetch_patient_data(client: bigquery.Client, subject_id=None):
+def fetch_patient_data(client: "bigquery.Client", subject_id=None):
     """
     Fetch a patient (random or by subject_id) by joining PATIENTS and ADMISSIONS,
     then retrieve additional data for that patient:
@@ -182,7 +177,8 @@ def fetch_patient_data(client: bigquery.Client, subject_id=None):
         services_rows = list(client.query(query_services).result())
         services = [dict(row) for row in services_rows]
 
-        # 8. LAB TESTS (with test names)
+        # 8. LAB TESTS (with test names) - every result for the admission; prompts use the
+        #    per-test summary from history/lab_summary.py rather than the raw rows.
         query_lab_tests = f"""
             SELECT
                 l.itemid,
@@ -197,8 +193,7 @@ def fetch_patient_data(client: bigquery.Client, subject_id=None):
               ON l.itemid = d.itemid
             WHERE l.subject_id = {subject_id}
               AND l.hadm_id = {hadm_id}
-            ORDER BY l.charttime DESC
-            LIMIT 10;
+            ORDER BY l.charttime DESC;
         """
         lab_rows = list(client.query(query_lab_tests).result())
         lab_tests = [dict(row) for row in lab_rows]
@@ -240,7 +235,7 @@ def fetch_patient_data(client: bigquery.Client, subject_id=None):
         micro_rows = list(client.query(query_microbiology).result())
         microbiology = [dict(row) for row in micro_rows]
 
-        # 11. CLINICAL NOTES
+        # 11. CLINICAL NOTES (prompts only use their history-relevant sections, see history/note_sections.py)
         query_notes = f"""
             SELECT
                 chartdate,
@@ -251,7 +246,7 @@ def fetch_patient_data(client: bigquery.Client, subject_id=None):
             WHERE subject_id = {subject_id}
               AND hadm_id = {hadm_id}
             ORDER BY chartdate DESC
-            LIMIT 5;
+            LIMIT 10;
         """
         notes_rows = list(client.query(query_notes).result())
         notes = [dict(row) for row in notes_rows]
@@ -318,13 +313,13 @@ Make sure the JSON is valid and includes each heading, even if empty.
     logger.debug("Constructed prompt for generate_history: %s", prompt)
 
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",  # or "gpt-4" if available and desired
+        response = llm_gateway.chat_completion(
+            "generation",
+            route="ai_history",
             messages=[
                 {"role": "system", "content": "You are a medical assistant providing structured patient histories."},
                 {"role": "user", "content": prompt}
             ],
-            max_tokens=800,
             temperature=0.7,
         )
         history_response = response["choices"][0]["message"]["content"].strip()
@@ -334,8 +329,10 @@ Make sure the JSON is valid and includes each heading, even if empty.
         return None
 
     try:
-        history_data = json.loads(history_response)
-    except json.JSONDecodeError:
+        history_data = structured_output.flatten_history(
+            structured_output.extract_json(history_response, structured_output.history_schema())
+        )
+    except structured_output.StructuredOutputError:
         logger.warning("GPT returned invalid JSON; storing entire response in 'PC' only.")
         history_data = {
             "PC": history_response,
@@ -353,7 +350,7 @@ Make sure the JSON is valid and includes each heading, even if empty.
 if __name__ == "__main__":
     try:
         # Initialize BigQuery client (make sure your GOOGLE_APPLICATION_CREDENTIALS env variable is set)
-        client = bigquery.Client()
+        client = services.get_bigquery_client()
         logger.info("BigQuery client initialized successfully.")
     except Exception as e:
         logger.error("Error initializing BigQuery client: %s", e)
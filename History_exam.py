@@ -1,4 +1,3 @@
-import openai
 import time
 from AIHistory import (
     fetch_patient_data,
@@ -6,7 +5,7 @@ from AIHistory import (
     connect_to_db,
     calculate_age
 )
-import openai
+from patient_history import llm_gateway
 
 # Timer and rating mechanism
 def rate_performance(start_time, end_time):
@@ -75,13 +74,13 @@ def run_cli():
                 """
                 start_time = time.time()
                 try:
-                    response = openai.ChatCompletion.create(
-                        model="gpt-3.5-turbo",  # Use "gpt-4" if available
+                    response = llm_gateway.chat_completion(
+                        "offline",
+                        route="history_exam",
                         messages=[
                             {"role": "system", "content": "You are a medical assistant answering questions about patient cases."},
                             {"role": "user", "content": prompt}
                         ],
-                        max_tokens=600,
                         temperature=0.7
                     )
                     answer = response["choices"][0]["message"]["content"].strip()
@@ -0,0 +1,127 @@
+"""
+Measure how many LLM-bound requests one worker keeps in flight.
+
+Drives the ASGI application in-process with N concurrent POSTs to /ask-question/.
+OpenAI is replaced by a stand-in that answers after --latency seconds, so the
+numbers show the server's concurrency rather than OpenAI's speed. With --sync the
+same requests go through a blocking view instead, which under ASGI runs on
+Django's single sync thread, i.e. the behaviour before the views were async.
+
+Usage:
+    python benchmark_async.py [--requests 200] [--latency 1.0] [--sync]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "patient_history.settings")
+# Generous limits: the benchmark measures the server, not the rate budget.
+os.environ.setdefault("LLM_RPM", "100000")
+os.environ.setdefault("LLM_TPM", "100000000")
+
+
+class FakeChatCompletion:
+    """
+    Answers every completion after a fixed delay and tracks how many overlap.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.in_flight = 0
+        self.peak = 0
+
+    def _reply(self):
+        return {
+            "choices": [{"message": {"role": "assistant", "content": "It started two days ago."}}],
+            "usage": {"total_tokens": 120},
+        }
+
+    async def acreate(self, **kwargs):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        return self._reply()
+
+    def create(self, **kwargs):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            time.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        return self._reply()
+
+
+def blocking_ask_question(request):
+    from django.http import JsonResponse
+    from patient_history import llm_gateway
+
+    response = llm_gateway.chat_completion(
+        "ask_question",
+        model="gpt-3.5-turbo",
+        messages=[{"role": "user", "content": request.body.decode("utf-8")}],
+        max_tokens=600,
+    )
+    return JsonResponse({"answer": response["choices"][0]["message"]["content"]})
+
+
+async def run(count, use_sync):
+    from asgiref.sync import sync_to_async
+    from django.test import AsyncClient, AsyncRequestFactory
+
+    payload = {"question": "When did the pain start?", "history": {"PC": "Chest pain"}}
+    client = AsyncClient()
+    factory = AsyncRequestFactory()
+    # How Django's ASGI handler runs a sync view: serialised on one thread.
+    blocking_view = sync_to_async(blocking_ask_question, thread_sensitive=True)
+
+    async def one():
+        start = time.perf_counter()
+        if use_sync:
+            response = await blocking_view(factory.post("/ask-question/", payload, content_type="application/json"))
+        else:
+            response = await client.post("/ask-question/", payload, content_type="application/json")
+        return response.status_code, time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one() for _ in range(count)))
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure concurrent LLM-bound requests per worker.")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=1.0, help="Simulated OpenAI latency in seconds.")
+    parser.add_argument("--sync", action="store_true", help="Use a blocking view as the baseline.")
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+    from django.conf import settings
+    from patient_history import services
+
+    settings.ALLOWED_HOSTS.append("testserver")   # the test client's host, as Django's test runner allows
+
+    completions = FakeChatCompletion(args.latency)
+    object.__setattr__(services.openai, "_module", types.SimpleNamespace(ChatCompletion=completions, api_key=None))
+
+    results, elapsed = asyncio.run(run(args.requests, args.sync))
+    latencies = sorted(duration for _, duration in results)
+    failed = sum(1 for status, _ in results if status != 200)
+    print(f"{'sync' if args.sync else 'async'} view, {args.requests} requests, {args.latency:.2f}s simulated latency")
+    print(f"peak concurrent LLM calls: {completions.peak}")
+    print(f"throughput: {args.requests / elapsed:.1f} req/s over {elapsed:.2f}s ({failed} failed)")
+    print(f"latency: median {statistics.median(latencies):.2f}s, "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1]:.2f}s, max {latencies[-1]:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
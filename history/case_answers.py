@@ -0,0 +1,198 @@
+"""
+Precomputed patient answers for profiled cases.
+
+The questions in a condition's english_profile are the ones a good student
+will ask. When generate_history_with_profile creates a case, `schedule` answers
+all of them for that case's history in one background completion and stores
+the answers under the case key: a hash of the history sections, which
+ask_question and the realtime endpoints already receive with every turn.
+
+At question time `lookup` matches the student's question against the stored
+profile questions in the coverage TF-IDF space (marking_scheme_endpoints/
+coverage.py) and returns the stored answer when the best cosine similarity
+reaches MATCH_THRESHOLD; everything else, and every question asked before the
+answers are ready, goes to the live LLM as before. Answers are generated in the
+patient's voice, so they need no rephrasing when served.
+
+Records live in memory and as JSON files under fallbacks.FALLBACK_DIR, so every
+worker can serve a case whichever worker created it.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from marking_scheme_endpoints import coverage
+from patient_history import llm_gateway, structured_output
+from patient_history.aio import run_in_background
+from patient_history.structured_output import HISTORY_SECTIONS, StructuredOutputError
+
+from . import fallbacks, profiles
+
+logger = logging.getLogger(__name__)
+
+MATCH_THRESHOLD = 0.6      # stricter than coverage: a wrong answer is worse than a slower one
+TOKENS_PER_ANSWER = 80
+_ENCODED_CACHE_SIZE = 256
+
+store = fallbacks.LookupCache(os.path.join(fallbacks.FALLBACK_DIR, "case_answers"))
+
+_lock = threading.Lock()
+_encoded = OrderedDict()   # case key -> (vocab, matrix) of its stored questions
+_stats = {"scheduled": 0, "generated": 0, "served": 0, "unmatched": 0}
+
+
+def case_key(history):
+    """
+    Key of a case's precomputed answers: a hash of its history sections. `history`
+    may be the history dict or its JSON; other text is keyed as-is. None if empty.
+    """
+    if isinstance(history, str):
+        try:
+            history = json.loads(history)
+        except ValueError:
+            pass
+    if isinstance(history, dict):
+        sections = {section: str(history.get(section) or "").strip() for section in HISTORY_SECTIONS}
+        if not any(sections.values()):
+            return None
+        text = json.dumps(sections, sort_keys=True)
+    else:
+        text = " ".join(str(history or "").split())
+        if not text:
+            return None
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def profile_questions(condition_icd):
+    """
+    The distinct C-node questions of the profile for `condition_icd`.
+    """
+    library = profiles.load_profiles()
+    found = library.lookup_icd(condition_icd) if library else None
+    if not found:
+        return []
+    questions, seen = [], set()
+    for question in found[1].questions:
+        if question.finding.lower() not in seen:
+            seen.add(question.finding.lower())
+            questions.append(question)
+    return questions
+
+
+def schedule(history, condition_icd):
+    """
+    Precompute the answers for a new case in the background.
+    """
+    key = case_key(history)
+    if key is None:
+        return
+    with _lock:
+        _stats["scheduled"] += 1
+    run_in_background(generate, key, history, condition_icd)
+
+
+def answers_prompt(history, findings):
+    sections = "\n".join(f"{section}: {history.get(section, '')}" for section in HISTORY_SECTIONS)
+    numbered = "\n".join(f"{i}. Do you have {finding}?" for i, finding in enumerate(findings, 1))
+    return f"""
+You are a real human patient in a clinical history-taking exam. Your medical history:
+{sections}
+
+Answer each of the doctor's questions below exactly as you would reply in the consultation:
+first person, one or two natural sentences, consistent with your history. If your history does
+not mention something, answer as this patient plausibly would without inventing new diagnoses.
+Never reveal that you are an AI.
+
+Questions:
+{numbered}
+
+Return a JSON object exactly in this format, with one answer per question in the same order:
+{{"answers": ["<answer to question 1>", "<answer to question 2>", ...]}}
+"""
+
+
+def generate(key, history, condition_icd):
+    """
+    Answer every profile question for the case `key` with one completion and store them.
+    """
+    if store.get(key) is not None:
+        return
+    questions = profile_questions(condition_icd)
+    if not questions or not isinstance(history, dict):
+        return
+    findings = [question.finding for question in questions]
+    messages = [{"role": "user", "content": answers_prompt(history, findings)}]
+    completion_kwargs = {
+        "route": "case_answers",
+        "temperature": 0.7,
+        "max_tokens": min(3000, 100 + TOKENS_PER_ANSWER * len(findings)),
+    }
+    response = llm_gateway.chat_completion("generation", messages=messages, **completion_kwargs)
+    try:
+        answers = structured_output.parse_with_reask(
+            response["choices"][0]["message"]["content"],
+            structured_output.ANSWERS,
+            reask=structured_output.reask_via(llm_gateway.creator("generation"), messages, **completion_kwargs),
+        )["answers"]
+    except StructuredOutputError as e:
+        logger.error("Could not parse precomputed answers for %s: %s", condition_icd, e)
+        return
+    if len(answers) != len(findings):
+        logger.error("Precomputed answers for %s: expected %d, got %d; discarded.", condition_icd, len(findings), len(answers))
+        return
+    store.store(key, {
+        "condition": condition_icd,
+        "questions": [question.text for question in questions],
+        "findings": findings,
+        "answers": [str(answer).strip() for answer in answers],
+    })
+    with _lock:
+        _stats["generated"] += 1
+    logger.info("Precomputed %d profile answers for %s.", len(findings), condition_icd)
+
+
+def _encoded_findings(key, findings, space):
+    with _lock:
+        if key in _encoded:
+            _encoded.move_to_end(key)
+            return _encoded[key]
+    encoded = space.encode(findings)
+    with _lock:
+        _encoded[key] = encoded
+        while len(_encoded) > _ENCODED_CACHE_SIZE:
+            _encoded.popitem(last=False)
+    return encoded
+
+
+def lookup(history, question):
+    """
+    The precomputed answer to `question` for the case with `history`, or None when
+    there is none or the question matches no profile question closely enough.
+    """
+    key = case_key(history)
+    record = store.get(key) if key and str(question or "").strip() else None
+    if not record:
+        return None
+    index = coverage.get_index()
+    if index is None:
+        return None
+    vocab, matrix = _encoded_findings(key, record["findings"], index.space)
+    _, asked = index.space.encode([str(question)], vocab)
+    similarity = (asked @ matrix.T)[0]
+    best = int(similarity.argmax())
+    if similarity[best] < MATCH_THRESHOLD:
+        with _lock:
+            _stats["unmatched"] += 1
+        return None
+    with _lock:
+        _stats["served"] += 1
+    logger.info("Serving precomputed answer for '%s' (similarity %.2f).", record["findings"][best], similarity[best])
+    return record["answers"][best]
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,211 @@
+"""
+Degraded-mode data for the history endpoints while BigQuery or OpenAI is down.
+
+`lookup_cache` keeps the last successful result of the fixed lookup queries
+(the category lists and the conditions of a category), so those endpoints can
+answer from slightly stale data when the query fails or its circuit is open.
+Queries built from free user input (searches, ICD/subject lookups) are not
+cached. Entries are evicted least recently used beyond LOOKUP_CACHE_SIZE entries
+or LOOKUP_CACHE_ROWS rows in total, per worker.
+
+`case_pool` keeps recently generated histories. When generate_history cannot
+reach its dependencies it serves one of these instead: a pooled case for the
+requested condition, or, for random/category requests, one from the same
+category or any category, marked "degraded": true.
+
+Both live in memory and in JSON files under FALLBACK_DIR, so a restarted
+worker still has something to serve. Writes are atomic (tmp file + replace);
+concurrent workers may occasionally overwrite each other's latest entry, which
+only costs a fallback candidate. Lookup files are written on the blocking-I/O
+pool, and only when the value changed.
+"""
+import copy
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+from collections import OrderedDict
+
+from patient_history.aio import run_in_background
+
+from .profiles import normalize_icd
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_DIR = os.path.join("/tmp", "osce_fallbacks")
+MAX_CASES_PER_CONDITION = 5
+MAX_CASES = 200
+LOOKUP_CACHE_SIZE = int(os.getenv("LOOKUP_CACHE_SIZE", 256))
+LOOKUP_CACHE_ROWS = int(os.getenv("LOOKUP_CACHE_ROWS", 50000))
+
+
+def _atomic_write(path, value):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "w") as f:
+            json.dump(value, f, default=str)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning("Could not write fallback file %s: %s", path, e)
+
+
+def _read(path, default):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _size(value):
+    return len(value) if isinstance(value, list) else 1
+
+
+class LookupCache:
+    """
+    Last known good result per lookup key, least recently used entries evicted
+    (from memory and disk) beyond `max_entries` entries or `max_rows` list items.
+    """
+
+    def __init__(self, directory, max_entries=LOOKUP_CACHE_SIZE, max_rows=LOOKUP_CACHE_ROWS):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+        self._rows = 0
+        self._stats = {"stores": 0, "writes": 0, "evictions": 0}
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _put(self, key, value):
+        """
+        Insert `value` as the most recent entry and evict; returns the evicted keys.
+        Called with the lock held.
+        """
+        if key in self._values:
+            self._rows -= _size(self._values[key])
+        self._values[key] = value
+        self._values.move_to_end(key)
+        self._rows += _size(value)
+        evicted = []
+        while len(self._values) > 1 and (len(self._values) > self.max_entries or self._rows > self.max_rows):
+            old_key, old_value = self._values.popitem(last=False)
+            self._rows -= _size(old_value)
+            evicted.append(old_key)
+        self._stats["evictions"] += len(evicted)
+        return evicted
+
+    def store(self, key, value):
+        """
+        Remember `value` for `key`. The file is written in the background, and only
+        when the value differs from the one already held.
+        """
+        with self._lock:
+            self._stats["stores"] += 1
+            if self._values.get(key) == value:
+                self._values.move_to_end(key)
+                return
+            evicted = self._put(key, value)
+            self._stats["writes"] += 1
+        run_in_background(self._write, key, value, evicted)
+
+    def _write(self, key, value, evicted):
+        for old_key in evicted:
+            _remove(self._path(old_key))
+        _atomic_write(self._path(key), value)
+
+    def get(self, key):
+        """
+        The last stored value for `key`, or None.
+        """
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key]
+        value = _read(self._path(key), None)
+        if value is not None:
+            with self._lock:
+                evicted = self._put(key, value)
+            for old_key in evicted:
+                _remove(self._path(old_key))
+        return value
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._values), rows=self._rows)
+
+
+class CasePool:
+    """
+    Recently generated generate_history responses, grouped by condition.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._cases = None
+
+    def _load(self):
+        if self._cases is None:
+            self._cases = _read(self.path, [])
+        return self._cases
+
+    def remember(self, condition, result):
+        """
+        Add a generated case (the generate_history response body) to the pool.
+        """
+        if not isinstance(result, dict) or not result.get("history"):
+            return
+        case = {"condition": normalize_icd(str(condition or "").strip()), "result": result}
+        with self._lock:
+            # Merge with what other workers wrote since we last read the file.
+            cases = _read(self.path, []) or self._load()
+            same = [c for c in cases if c.get("condition") == case["condition"]]
+            if len(same) >= MAX_CASES_PER_CONDITION:
+                cases.remove(same[0])
+            cases.append(case)
+            self._cases = cases[-MAX_CASES:]
+            snapshot = list(self._cases)
+        _atomic_write(self.path, snapshot)
+
+    def pick(self, condition=None, category=None):
+        """
+        A pooled response for `condition` (ICD code or condition name). Without a
+        condition, prefer one from `category`, else any case. Returns a copy marked
+        "degraded", or None if nothing suitable is pooled.
+        """
+        with self._lock:
+            cases = list(self._load())
+        if condition:
+            wanted = str(condition).strip().lower()
+            candidates = [
+                c for c in cases
+                if c.get("condition") == normalize_icd(str(condition or "").strip())
+                or str(c["result"].get("right_condition", "")).strip().lower() == wanted
+            ]
+        else:
+            candidates = []
+            if category:
+                candidates = [c for c in cases if str(c["result"].get("category", "")).lower() == str(category).lower()]
+            candidates = candidates or cases
+        if not candidates:
+            return None
+        result = copy.deepcopy(random.choice(candidates)["result"])
+        result["degraded"] = True
+        return result
+
+
+lookup_cache = LookupCache(os.path.join(FALLBACK_DIR, "lookups"))
+case_pool = CasePool(os.path.join(FALLBACK_DIR, "case_pool.json"))
@@ -0,0 +1,101 @@
+"""
+Per-test summary of all LABEVENTS rows for an admission.
+
+Instead of the ten most recent raw rows, the prompt gets one line per test:
+number of results, last value (with unit), min/max, trend from the first to
+the last numeric result and how many results were flagged abnormal. The rows
+are sorted once and every statistic is a NumPy `reduceat` over the per-test
+groups, so admissions with thousands of lab events summarise in milliseconds.
+Tests with abnormal results are listed first.
+"""
+import logging
+import time
+
+import numpy as np
+
+from .serialization import format_value
+
+logger = logging.getLogger(__name__)
+
+TREND_THRESHOLD = 0.1   # relative change between first and last result reported as a trend
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _to_datetime64(value):
+    text = format_value(value).replace(" ", "T")
+    try:
+        return np.datetime64(text, "m") if text else np.datetime64("NaT")
+    except ValueError:
+        return np.datetime64("NaT")
+
+
+def _is_summary(row):
+    return "n" in row and "last" in row and "charttime" not in row
+
+
+def _number(value):
+    return f"{value:.4g}"
+
+
+def summarize_labs(lab_rows):
+    """
+    Summarise LABEVENTS rows (dicts with test_name, charttime, value, valuenum,
+    valueuom, flag) into one dict per test:
+    {"test_name", "n", "last", "min", "max", "trend", "abnormal", "last_time"}.
+    Rows that are already summaries (e.g. from a saved case bundle) are returned as they are.
+    """
+    rows = [row for row in lab_rows or [] if isinstance(row, dict)]
+    if not rows:
+        return []
+    if all(_is_summary(row) for row in rows):
+        return rows
+    start = time.perf_counter()
+
+    names = np.array([str(row.get("test_name") or row.get("itemid") or "unknown") for row in rows])
+    times = np.array([_to_datetime64(row.get("charttime")) for row in rows], dtype="datetime64[m]")
+    values = np.array([_to_float(row.get("valuenum")) for row in rows], dtype=np.float64)
+    abnormal = np.array([str(row.get("flag") or "").lower() in ("abnormal", "delta") for row in rows])
+
+    # Group by test, chronological within each test (NaT sorts last).
+    order = np.lexsort((times, names))
+    names, times, values, abnormal = names[order], times[order], values[order], abnormal[order]
+    tests, starts, counts = np.unique(names, return_index=True, return_counts=True)
+
+    numeric = ~np.isnan(values)
+    positions = np.arange(len(values))
+    first_numeric = np.minimum.reduceat(np.where(numeric, positions, len(values)), starts)
+    last_numeric = np.maximum.reduceat(np.where(numeric, positions, -1), starts)
+    minimum = np.fmin.reduceat(values, starts)
+    maximum = np.fmax.reduceat(values, starts)
+    abnormal_counts = np.add.reduceat(abnormal.astype(np.int64), starts)
+    last_rows = starts + counts - 1
+
+    summary = []
+    for i, test in enumerate(tests):
+        last_index = last_rows[i]
+        source = rows[order[last_index]]
+        unit = format_value(source.get("valueuom"))
+        entry = {"test_name": str(test), "n": int(counts[i]), "abnormal": int(abnormal_counts[i])}
+        if last_numeric[i] >= 0:
+            first_value, last_value = values[first_numeric[i]], values[last_numeric[i]]
+            entry["last"] = f"{_number(last_value)} {unit}".strip()
+            if counts[i] > 1:
+                entry["min"] = _number(minimum[i])
+                entry["max"] = _number(maximum[i])
+                change = (last_value - first_value) / max(abs(first_value), 1e-9)
+                entry["trend"] = "rising" if change > TREND_THRESHOLD else "falling" if change < -TREND_THRESHOLD else "stable"
+        else:
+            entry["last"] = f"{format_value(source.get('value'))} {unit}".strip()
+        entry["last_time"] = format_value(source.get("charttime"))
+        summary.append(entry)
+
+    summary.sort(key=lambda entry: (-entry["abnormal"], entry["test_name"].lower()))
+    logger.info("Summarised %d lab events into %d tests in %.1f ms.",
+                len(rows), len(summary), (time.perf_counter() - start) * 1000)
+    return summary
@@ -0,0 +1,179 @@
+"""
+Section extraction for MIMIC NOTEEVENTS text.
+
+Discharge summaries are written under headings such as "History of Present
+Illness:", "Past Medical History:" or "Medications on Admission:". A single
+pass over the lines (a small state machine: a recognised heading switches the
+current section, anything else is appended to it) splits each note into
+canonical sections, which are then mapped onto the history headings
+PC/HPC/PMHx/DHx/FHx/SHx/SR. Sections that do not feed the history (hospital
+course, exam, results, discharge instructions) are recognised only so that
+they end the previous section. Results are cached per notes bundle.
+"""
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from .serialization import format_value
+
+HISTORY_SECTIONS = ["PC", "HPC", "PMHx", "DHx", "FHx", "SHx", "SR"]
+
+# Canonical note section -> history section (None: recognised but not used for the history).
+NOTE_SECTIONS = {
+    "chief complaint": "PC",
+    "history of present illness": "HPC",
+    "past medical history": "PMHx",
+    "past surgical history": "PMHx",
+    "medications on admission": "DHx",
+    "allergies": "DHx",
+    "family history": "FHx",
+    "social history": "SHx",
+    "review of systems": "SR",
+    "major surgical or invasive procedure": None,
+    "physical exam": None,
+    "pertinent results": None,
+    "brief hospital course": None,
+    "discharge medications": None,
+    "discharge disposition": None,
+    "discharge diagnosis": None,
+    "discharge condition": None,
+    "discharge instructions": None,
+    "followup instructions": None,
+    "impression": None,
+    "assessment and plan": None,
+}
+
+# Spellings seen in MIMIC notes, mapped onto the canonical names above.
+HEADING_ALIASES = {
+    "cc": "chief complaint",
+    "reason for admission": "chief complaint",
+    "hpi": "history of present illness",
+    "history of the present illness": "history of present illness",
+    "history of presenting illness": "history of present illness",
+    "present illness": "history of present illness",
+    "pmh": "past medical history",
+    "pmhx": "past medical history",
+    "past history": "past medical history",
+    "past medical/surgical history": "past medical history",
+    "past medical and surgical history": "past medical history",
+    "psh": "past surgical history",
+    "medications prior to admission": "medications on admission",
+    "home medications": "medications on admission",
+    "outpatient medications": "medications on admission",
+    "meds on admission": "medications on admission",
+    "admission medications": "medications on admission",
+    "fh": "family history",
+    "fhx": "family history",
+    "sh": "social history",
+    "shx": "social history",
+    "ros": "review of systems",
+    "physical examination": "physical exam",
+    "admission physical exam": "physical exam",
+    "exam": "physical exam",
+    "hospital course": "brief hospital course",
+    "discharge diagnoses": "discharge diagnosis",
+    "a/p": "assessment and plan",
+    "assessment/plan": "assessment and plan",
+}
+
+_HEADING_LINE = re.compile(r"^\s*([A-Za-z][A-Za-z /&,]{1,50}?)\s*:\s*(.*)$")
+_BLANK_RUNS = re.compile(r"\n\s*\n+")
+_CACHE_SIZE = 64
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def canonical_heading(label):
+    label = re.sub(r"\s+", " ", label.strip().lower())
+    label = HEADING_ALIASES.get(label, label)
+    return label if label in NOTE_SECTIONS else None
+
+
+def parse_note(text):
+    """
+    Split one note into {canonical section: text}. Text before the first
+    recognised heading, or in a note without headings, is not returned.
+    """
+    sections = {}
+    current = None
+    for line in str(text or "").splitlines():
+        match = _HEADING_LINE.match(line)
+        heading = canonical_heading(match.group(1)) if match else None
+        if heading:
+            current = heading
+            line = match.group(2)
+        if current is None:
+            continue
+        sections.setdefault(current, []).append(line)
+    return {
+        heading: _BLANK_RUNS.sub("\n", "\n".join(lines)).strip()
+        for heading, lines in sections.items()
+        if "".join(lines).strip()
+    }
+
+
+def _bundle_key(notes):
+    texts = [
+        (note.get("text") or "") if isinstance(note, dict) else str(note)
+        for note in notes or []
+    ]
+    return hashlib.sha1(json.dumps(texts).encode("utf-8")).hexdigest()
+
+
+def extract_history_sections(notes):
+    """
+    Parse a bundle of NOTEEVENTS rows (dicts with "text", or plain strings).
+    Returns (sections, unstructured): `sections` maps PC..SR to the de-duplicated
+    excerpts found across all notes, `unstructured` holds the notes in which no
+    heading was recognised (nursing and radiology notes, typically).
+    Results are cached per bundle, so repeated prompts for a patient parse once.
+    """
+    key = _bundle_key(notes)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    sections = {section: [] for section in HISTORY_SECTIONS}
+    unstructured = []
+    for note in notes or []:
+        text = note.get("text") if isinstance(note, dict) else note
+        parsed = parse_note(text)
+        if not parsed:
+            if str(text or "").strip():
+                unstructured.append(note)
+            continue
+        for heading, excerpt in parsed.items():
+            section = NOTE_SECTIONS[heading]
+            if section and excerpt not in sections[section]:
+                sections[section].append(excerpt)
+    result = ({section: "\n".join(excerpts) for section, excerpts in sections.items() if excerpts}, unstructured)
+
+    with _cache_lock:
+        _cache[key] = result
+        if len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+def prompt_rows(notes):
+    """
+    Rows for the "notes" prompt source: one "SECTION: excerpt" line per history
+    section found in the notes, followed by any notes without recognisable headings.
+    """
+    if not notes:
+        return notes
+    sections, unstructured = extract_history_sections(notes if isinstance(notes, list) else [notes])
+    rows = [f"{section}: {excerpt}" for section, excerpt in sections.items()]
+    for note in unstructured:
+        if isinstance(note, dict):
+            label = " ".join(
+                value for value in (format_value(note.get(key)) for key in ("chartdate", "category", "description")) if value
+            )
+            rows.append(f"{label}: {note.get('text')}" if label else str(note.get("text")))
+        else:
+            rows.append(str(note))
+    return rows
@@ -0,0 +1,299 @@
+"""
+Compiled decision-tree profiles for the Text2DT/MIMIC mapping file.
+
+Mapping entries store their decision tree as strings ("Does the patient have X
+(relation)?" and "D node: {json}"). This module compiles each entry once into
+typed nodes - C nodes become `Question`s, D nodes become `TreatmentSet`s, each
+with its logical relation - and caches the result per mapping file (reloaded
+only when the file changes). Coverage scoring, prompt builders and the mapping
+scripts all work from these objects instead of re-parsing strings.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+MAPPING_FILE = "text2dt_mimic_mapping_english-full-profile.json"
+
+_C_QUESTION = re.compile(r"^Does the patient have (.+?) \(([^()]+)\)(.*?)\??$", re.IGNORECASE)
+_RELATION_WORDS = {"and": "all of", "or": "any of"}
+# CJK ideographs and punctuation: untranslated Text2DT text that no student can ask about in English.
+_UNTRANSLATED = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff]")
+_TRANSLATES_TO = re.compile(r"[\"']?\s+translates to\s+[\"']?", re.IGNORECASE)
+
+
+@dataclass(frozen=True, slots=True)
+class Question:
+    """
+    A C (condition) node triple, asked of the patient during history taking.
+    `group` is the index of the C node it came from (None for profile strings), so the
+    triples of one node, and their shared logical_rel, can be serialized together again.
+    """
+    text: str
+    finding: str
+    relation: str = ""
+    logical_rel: str = "null"
+    subject: str = ""
+    group: int | None = None
+
+
+@dataclass(frozen=True, slots=True)
+class TreatmentSet:
+    """A D (decision) node: the treatment options that follow, combined by logical_rel."""
+    relation: str
+    options: tuple
+    logical_rel: str = "null"
+    subject: str = ""
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledProfile:
+    condition: str
+    mimic_condition: str
+    icd9_codes: tuple
+    category: str
+    nodes: tuple
+
+    @property
+    def questions(self):
+        return tuple(node for node in self.nodes if isinstance(node, Question))
+
+    @property
+    def treatments(self):
+        return tuple(node for node in self.nodes if isinstance(node, TreatmentSet))
+
+    def prompt_text(self):
+        return render_nodes(self.nodes)
+
+
+def is_english(text):
+    return not _UNTRANSLATED.search(text or "")
+
+
+def render_nodes(nodes):
+    """
+    Compact rendering of compiled nodes for LLM prompts (one line per node, no JSON).
+    """
+    lines = []
+    for node in nodes:
+        if isinstance(node, Question):
+            relation = f" [{node.relation}]" if node.relation else ""
+            lines.append(f"Q: {node.finding}{relation}")
+        else:
+            joiner = _RELATION_WORDS.get(node.logical_rel)
+            label = f"{node.relation} ({joiner})" if joiner else node.relation
+            lines.append(f"{label}: " + "; ".join(node.options))
+    return "\n".join(lines)
+
+
+def question_from_triple(triple, logical_rel="null", group=None):
+    subject, relation, finding = triple
+    return Question(
+        text=f"Does the patient have {finding} ({relation})?",
+        finding=finding,
+        relation=relation,
+        logical_rel=logical_rel or "null",
+        subject=subject or "",
+        group=group,
+    )
+
+
+def treatment_from_node(node):
+    triples = [triple for triple in node.get("triples", []) if len(triple) == 3 and triple[2] and is_english(triple[2])]
+    relation = triples[0][1] if triples else ""
+    return TreatmentSet(
+        relation=relation,
+        options=tuple(triple[2] for triple in triples),
+        logical_rel=node.get("logical_rel") or "null",
+        subject=(triples[0][0] or "") if triples else "",
+    )
+
+
+def compile_tree(tree):
+    """
+    Compile a raw Text2DT decision tree (list of {"role", "triples", "logical_rel"}) into nodes.
+    Untranslated (non-English) findings and options are dropped.
+    """
+    nodes = []
+    for index, node in enumerate(tree or []):
+        if node.get("role") == "C":
+            nodes.extend(
+                question_from_triple(triple, node.get("logical_rel"), group=index)
+                for triple in node.get("triples", []) if len(triple) == 3 and is_english(triple[2])
+            )
+        elif node.get("role") == "D":
+            treatment = treatment_from_node(node)
+            if treatment.options:
+                nodes.append(treatment)
+    return tuple(nodes)
+
+
+def _unquote(text):
+    text = text.strip()
+    while len(text) >= 2 and text[0] == text[-1] and text[0] in "\"'":
+        text = text[1:-1].strip()
+    return text
+
+
+def compile_profile_strings(profile):
+    """
+    Compile a stored `profile` / `english_profile` list of strings into nodes.
+    Untranslated (non-English) questions and options are dropped.
+    """
+    nodes = []
+    for raw in profile or []:
+        entry = _unquote(str(raw))
+        if entry.startswith("D node:"):
+            # Some entries carry the untranslated node followed by "Translation: D node: {...}";
+            # the last node in the string is the English one.
+            try:
+                node, _ = json.JSONDecoder().raw_decode(entry[entry.rfind("D node:") + len("D node:"):].strip())
+            except json.JSONDecodeError:
+                logger.warning("Skipping unparsable D node: %s", entry[:80])
+                continue
+            treatment = treatment_from_node(node)
+            if treatment.options:
+                nodes.append(treatment)
+            continue
+        # Some questions are stored as '<untranslated>" translates to "<English>'; keep the English one.
+        entry = _unquote(_TRANSLATES_TO.split(entry)[-1])
+        if not is_english(entry):
+            continue
+        match = _C_QUESTION.match(entry)
+        if match:
+            finding = f"{match.group(1)} {match.group(3)}".strip()
+            nodes.append(Question(text=entry, finding=finding, relation=match.group(2)))
+        else:
+            nodes.append(Question(text=entry, finding=entry.rstrip("?")))
+    return tuple(nodes)
+
+
+def compile_entry(entry):
+    """
+    Compile one mapping entry. A structured "english_decision_tree" (written by the
+    mapping scripts) is used when present; otherwise the english_profile strings are parsed.
+    """
+    group = entry.get("mapped_mimic_group", {})
+    if entry.get("english_decision_tree"):
+        nodes = compile_tree(entry["english_decision_tree"])
+    else:
+        nodes = compile_profile_strings(entry.get("english_profile") or entry.get("profile"))
+    return CompiledProfile(
+        condition=entry.get("text2dt_condition", "Unknown Condition"),
+        mimic_condition=group.get("mimic_condition", ""),
+        icd9_codes=tuple(group.get("icd9_codes", [])),
+        category=entry.get("category", "other"),
+        nodes=nodes,
+    )
+
+
+def describe_tree(tree):
+    """
+    Prompt text for a decision tree supplied by a client: either raw Text2DT nodes or
+    profile strings. Returns None if `tree` is neither, so callers can fall back to JSON.
+    """
+    if not isinstance(tree, list) or not tree:
+        return None
+    if all(isinstance(node, dict) and "role" in node for node in tree):
+        nodes = compile_tree(tree)
+    elif all(isinstance(node, str) for node in tree):
+        nodes = compile_profile_strings(tree)
+    else:
+        return None
+    return render_nodes(nodes) or None
+
+
+def normalize_icd(code):
+    return str(code).replace(".", "").lstrip("0")
+
+
+class ProfileLibrary:
+    """
+    The raw mapping entries plus their compiled profiles and lookup indexes.
+    `entries` is shared between requests and must be treated as read-only.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.compiled = [compile_entry(entry) for entry in entries]
+        self.by_icd = {}
+        self.by_mimic_condition = {}
+        for entry, compiled in zip(entries, self.compiled):
+            for code in compiled.icd9_codes:
+                self.by_icd.setdefault(normalize_icd(code), (entry, compiled))
+            if compiled.mimic_condition:
+                self.by_mimic_condition.setdefault(compiled.mimic_condition, (entry, compiled))
+
+    def lookup_icd(self, code):
+        """
+        Return (entry, compiled profile) for an ICD-9 code (dots/leading zeros ignored), or None.
+        """
+        return self.by_icd.get(normalize_icd(code))
+
+    def lookup_condition(self, mimic_condition):
+        return self.by_mimic_condition.get(mimic_condition)
+
+
+_lock = threading.Lock()
+_cache = {}
+
+
+def load_profiles(mapping_file=MAPPING_FILE):
+    """
+    Return the ProfileLibrary for `mapping_file`, compiling it only when the file changes.
+    Returns None if the file is missing or unreadable.
+    """
+    try:
+        mtime = os.path.getmtime(mapping_file)
+    except OSError:
+        logger.error(f"Mapping file {mapping_file} not found.")
+        return None
+    cached = _cache.get(mapping_file)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with _lock:
+        cached = _cache.get(mapping_file)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        start = time.perf_counter()
+        try:
+            with open(mapping_file, "r", encoding="utf-8") as f:
+                library = ProfileLibrary(json.load(f))
+        except Exception as e:
+            logger.error(f"Error reading mapping file: {e}")
+            return None
+        _cache[mapping_file] = (mtime, library)
+        logger.info("Compiled %d profiles from %s in %.0f ms.",
+                    len(library.compiled), mapping_file, (time.perf_counter() - start) * 1000)
+        return library
+
+
+def serialize_tree(nodes):
+    """
+    Raw Text2DT form of compiled nodes, the inverse of compile_tree: consecutive
+    questions from the same C node are written back as one node with their shared
+    logical_rel. Questions without a group each become their own C node.
+    """
+    serialized = []
+    previous_group = None
+    for node in nodes:
+        if isinstance(node, Question):
+            triple = [node.subject, node.relation, node.finding]
+            if node.group is not None and node.group == previous_group:
+                serialized[-1]["triples"].append(triple)
+            else:
+                serialized.append({"role": "C", "triples": [triple], "logical_rel": node.logical_rel})
+            previous_group = node.group
+        else:
+            serialized.append({
+                "role": "D",
+                "triples": [[node.subject, node.relation, option] for option in node.options],
+                "logical_rel": node.logical_rel,
+            })
+            previous_group = None
+    return serialized
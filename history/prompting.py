@@ -0,0 +1,184 @@
+"""
+Token-budgeted assembly of MIMIC data sources into LLM prompts.
+
+Each source (PATIENTS, NOTEEVENTS, ...) has a token budget and a priority.
+Rows are rendered, de-duplicated and added until the source's budget is spent;
+an oversized row (typically a clinical note) is truncated rather than dropped.
+Sources are granted their budgets in priority order out of an overall budget,
+so the size of the final prompt is bounded no matter how much data a patient
+has. Token counts use tiktoken when it is installed and a close local estimate
+otherwise; the per-source report is logged with every prompt.
+"""
+import logging
+import re
+from dataclasses import dataclass
+
+from . import serialization
+
+logger = logging.getLogger(__name__)
+
+TRUNCATION_MARK = " …[truncated]"
+MIN_ROW_TOKENS = 50   # a truncated row shorter than this is dropped instead
+
+_TOKEN_PIECE = re.compile(r"\w+|[^\w\s]")
+_encoding = None
+_encoding_checked = False
+
+
+def _tiktoken_encoding():
+    global _encoding, _encoding_checked
+    if not _encoding_checked:
+        _encoding_checked = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            logger.debug("tiktoken not available; using the heuristic token counter.")
+    return _encoding
+
+
+def count_tokens(text):
+    """
+    Number of tokens in `text` (tiktoken if installed, otherwise roughly one token per
+    short word or punctuation mark, plus one per extra five characters of long words).
+    """
+    text = str(text or "")
+    encoding = _tiktoken_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return sum(1 + len(piece) // 5 for piece in _TOKEN_PIECE.findall(text))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Cut `text` at a word boundary so that it (plus the truncation mark) fits in `max_tokens`.
+    """
+    text = str(text or "")
+    if count_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - count_tokens(TRUNCATION_MARK)
+    if budget <= 0:
+        return ""
+    cut = len(text)
+    while cut > 0:
+        cut = int(cut * min(0.9, budget / max(count_tokens(text[:cut]), 1)))
+        candidate = text[:cut].rsplit(" ", 1)[0] if " " in text[:cut] else text[:cut]
+        if count_tokens(candidate) <= budget:
+            return candidate.rstrip() + TRUNCATION_MARK
+    return ""
+
+
+@dataclass(frozen=True)
+class Source:
+    key: str
+    title: str
+    budget: int              # maximum tokens for this source
+    priority: int = 1        # lower is granted budget first
+    max_row_tokens: int = 0  # per-row cap (0 = the source budget)
+
+
+# Budgets for the generate_history prompt; the full prompt stays well inside the
+# gpt-3.5 context even for patients with long stays and many notes.
+HISTORY_SOURCES = [
+    Source("patient", "Patient Info (PATIENTS)", 120, priority=0),
+    Source("admissions", "Admissions (ADMISSIONS)", 200, priority=0),
+    Source("diagnoses", "Diagnoses (DIAGNOSES_ICD + D_ICD_DIAGNOSES)", 450, priority=0),
+    Source("procedures", "Procedures (PROCEDURES_ICD + D_ICD_PROCEDURES)", 250, priority=2),
+    Source("icu_stays", "ICU Stays (ICUSTAYS)", 150, priority=3),
+    Source("transfers", "Transfers (TRANSFERS)", 150, priority=4),
+    Source("services", "Services (SERVICES)", 100, priority=4),
+    Source("lab_tests", "Lab Tests (LABEVENTS + D_LABITEMS, per-test summary for the admission)", 400, priority=2),
+    Source("prescriptions", "Prescriptions (PRESCRIPTIONS)", 350, priority=1),
+    Source("microbiology", "Microbiology (MICROBIOLOGYEVENTS)", 200, priority=3),
+    Source("notes", "Clinical Notes (NOTEEVENTS, history-relevant sections)", 1200, priority=1, max_row_tokens=400),
+]
+HISTORY_TOTAL_BUDGET = 3000
+
+# generate_questions only needs enough context for four questions.
+QUESTION_TOTAL_BUDGET = 1800
+
+
+def render_source(source, rows):
+    """
+    Render `rows` for `source` as (header lines, row lines) using the compact table
+    format from history/serialization.py. The header is always kept.
+    """
+    return serialization.table_lines(source.key, rows)
+
+
+def fit_source(source, rows, budget):
+    """
+    Render, de-duplicate and truncate `rows` into at most `budget` tokens.
+    Returns (text, stats) where stats records rows in/kept, tokens and truncation.
+    """
+    header, lines = render_source(source, rows)
+    used = sum(count_tokens(line) for line in header)
+    kept, seen, truncated, duplicates = [], set(), False, 0
+    row_cap = source.max_row_tokens or budget
+    for line in lines:
+        if line in seen:
+            duplicates += 1
+            continue
+        seen.add(line)
+        tokens = count_tokens(line)
+        if tokens > row_cap:
+            line, truncated = truncate_to_tokens(line, row_cap), True
+            tokens = count_tokens(line)
+        remaining = budget - used
+        if tokens > remaining:
+            # Budget spent: free-text sources keep a shortened final row, tabular ones stop here.
+            truncated = True
+            if not source.max_row_tokens or remaining < MIN_ROW_TOKENS:
+                break
+            line = truncate_to_tokens(line, remaining)
+            tokens = count_tokens(line)
+        kept.append(line)
+        used += tokens
+    text = "\n".join(header + kept) if kept else "None"
+    return text, {
+        "rows": len(lines),
+        "kept": len(kept),
+        "duplicates": duplicates,
+        "tokens": count_tokens(text),
+        "truncated": truncated,
+    }
+
+
+class PromptSections:
+    """
+    The assembled data sections of a prompt plus a per-source token report.
+    """
+
+    def __init__(self, sources, texts, report):
+        self.sources = sources
+        self.texts = texts
+        self.report = report
+
+    @property
+    def total_tokens(self):
+        return sum(stats["tokens"] for stats in self.report.values())
+
+    def render(self, separator="\n\n"):
+        return separator.join(f"{source.title}:\n{self.texts[source.key]}" for source in self.sources)
+
+    def summary(self):
+        return ", ".join(f"{key}={stats['tokens']}" for key, stats in self.report.items())
+
+
+def assemble(data, sources=HISTORY_SOURCES, total_budget=HISTORY_TOTAL_BUDGET):
+    """
+    Fit each source in `data` (key -> rows) into its budget, granting budgets in
+    priority order until `total_budget` is spent. Returns PromptSections in the
+    order of `sources`.
+    """
+    remaining = total_budget
+    texts, report = {}, {}
+    for source in sorted(sources, key=lambda s: s.priority):
+        text, stats = fit_source(source, data.get(source.key), max(0, min(source.budget, remaining)))
+        remaining -= stats["tokens"]
+        texts[source.key] = text
+        report[source.key] = stats
+    ordered_report = {source.key: report[source.key] for source in sources}
+    sections = PromptSections(sources, texts, ordered_report)
+    logger.info("Prompt data: %d tokens (%s)", sections.total_tokens, sections.summary())
+    return sections
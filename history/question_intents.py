@@ -0,0 +1,184 @@
+"""
+Local intent classifier for ask_question.
+
+Many questions are plain lookups of one history section: "what medications is
+the patient on?" is the DHx field, "any family history?" the FHx field. Each
+section has a list of keyword/phrase patterns, compiled once at import into one
+regex per section. A question is answered straight from the history, without
+the LLM, only when it is a high-confidence lookup:
+
+- the patterns of exactly one section match (SECTION_EXCLUSIONS rule a section
+  out, e.g. "family" anywhere rules out PMHx);
+- it is short (at most MAX_WORDS words);
+- it contains none of the DETAIL_PATTERNS that ask for more than the section
+  says (timing, doses, reasoning, exceptions, advice);
+- it asks for the whole section, not about one item in it: TARGETED_PATTERNS
+  ("do you smoke?", "are you allergic to penicillin?", "do you live alone?")
+  need a yes/no or a specific answer that only the LLM can pick out.
+
+Anything else returns None and goes to the LLM as before.
+"""
+import json
+import re
+import threading
+
+from patient_history.structured_output import HISTORY_SECTIONS
+
+MAX_WORDS = 14
+
+SECTION_LABELS = {
+    "PC": "Presenting complaint",
+    "HPC": "History of presenting complaint",
+    "PMHx": "Past medical history",
+    "DHx": "Drug history",
+    "FHx": "Family history",
+    "SHx": "Social history",
+    "SR": "Systems review",
+}
+
+INTENT_PATTERNS = {
+    "PC": [
+        r"\b(presenting|chief|main|primary) (complaint|problem|symptom)s?\b",
+        r"\bwhat (brings|brought) (you|him|her|them|the patient)\b",
+        r"\breason for (the )?(visit|attendance|admission|presentation|consultation)\b",
+        r"\bPC\b",
+    ],
+    "HPC": [
+        r"\bhistory of (the )?present(ing)? (illness|complaint)\b",
+        r"\bHPC\b",
+        r"\bHPI\b",
+    ],
+    "PMHx": [
+        r"\bpast medical( history)?\b",
+        r"\bmedical history\b",
+        r"\bPMHx?\b",
+        r"\b(previous|past|other|any|known|chronic) (medical )?(conditions|illness(es)?|medical problems|health problems)\b",
+        r"\b(previous|past|any) (operations|surgery|surgeries|hospital admissions)\b",
+    ],
+    "DHx": [
+        r"\bdrug history\b",
+        r"\bDHx\b",
+        r"\bmedications?\b",
+        r"\bmeds\b",
+        r"\b(regular|current|any) (medicines|tablets|pills|drugs|treatments?)\b",
+        r"\ballerg(y|ies|ic)\b",
+        r"\bprescri(bed|ptions?)\b",
+    ],
+    "FHx": [
+        r"\bfamily (medical )?history\b",
+        r"\bFHx?\b",
+        r"\bruns? in (the|your|his|her|their) family\b",
+        r"\b(relatives|family members)\b",
+        r"\bin (the|your|his|her|their) family\b",
+    ],
+    "SHx": [
+        r"\bsocial history\b",
+        r"\bSHx\b",
+        r"\bsocial (circumstances|situation|background)\b",
+    ],
+    "SR": [
+        r"\b(systems?|systemic) (review|enquiry|inquiry)\b",
+        r"\breview of systems\b",
+        r"\bROS\b",
+    ],
+}
+
+# Questions that ask for more than a section's text: left to the LLM.
+DETAIL_PATTERNS = [
+    r"\bhow (long|much|many|often|far)\b",
+    r"\b(when|since when|why)\b",
+    r"\bdos(e|es|age)\b",
+    r"\b(other than|apart from|except|besides)\b",
+    r"\b(cause[sd]?|explain|mean|relevant|relate[sd]?|significan(t|ce))\b",
+    r"\b(diagnos[ie]s|differential|likely)\b",
+    r"\b(should|recommend|advise|manage|treat|investigat(e|ion)s?)\b",
+    r"\b(compare|change[sd]?|stopp?ed|started)\b",
+]
+
+# Sections that a question cannot be about when these match anywhere in it.
+SECTION_EXCLUSIONS = {
+    "PMHx": [r"\bfamily\b", r"\brelatives\b"],
+}
+
+# Questions about one item of a section: answered by the LLM from the section, not with all of it.
+TARGETED_PATTERNS = [
+    r"\bsmok(e|es|ed|ing|er|ers)\b",
+    r"\b(alcohol|drink(s|ing|er)?)\b",
+    r"\b(cigarettes|tobacco|vap(e|es|ing)|recreational drugs)\b",
+    r"\b(occupation|job|employment|work)\b",
+    r"\b(lives?|living) (with|alone|on|in)\b",
+    r"\ballergic to\b",
+    r"\ballerg(y|ies) to\b",
+    r"\b(medications?|meds|medicines|tablets|drugs)\b.*\bfor\b",
+]
+
+_COMPILED = {
+    section: re.compile("|".join(f"(?:{pattern})" for pattern in patterns), re.IGNORECASE)
+    for section, patterns in INTENT_PATTERNS.items()
+}
+_EXCLUDED = {
+    section: re.compile("|".join(f"(?:{pattern})" for pattern in patterns), re.IGNORECASE)
+    for section, patterns in SECTION_EXCLUSIONS.items()
+}
+_DETAIL = re.compile("|".join(f"(?:{pattern})" for pattern in DETAIL_PATTERNS), re.IGNORECASE)
+_TARGETED = re.compile("|".join(f"(?:{pattern})" for pattern in TARGETED_PATTERNS), re.IGNORECASE)
+
+_lock = threading.Lock()
+_stats = {section: 0 for section in HISTORY_SECTIONS}
+_stats.update({"ambiguous": 0, "targeted": 0, "unmatched": 0})
+
+
+def classify(question):
+    """
+    The history section `question` looks up, or None when it is not a
+    high-confidence single-section lookup.
+    """
+    text = " ".join(str(question or "").split())
+    if not text or len(text.split()) > MAX_WORDS:
+        return None
+    if _TARGETED.search(text):
+        with _lock:
+            _stats["targeted"] += 1
+        return None
+    sections = [
+        section for section, pattern in _COMPILED.items()
+        if pattern.search(text) and not (section in _EXCLUDED and _EXCLUDED[section].search(text))
+    ]
+    if len(sections) != 1:
+        with _lock:
+            _stats["ambiguous" if sections else "unmatched"] += 1
+        return None
+    if _DETAIL.search(text):
+        with _lock:
+            _stats["unmatched"] += 1
+        return None
+    return sections[0]
+
+
+def answer(history, question):
+    """
+    (section, answer) for `question` taken from `history` (a dict or its JSON), or
+    None when the question is not a lookup or the history has no such section.
+    """
+    if isinstance(history, str):
+        try:
+            history = json.loads(history)
+        except ValueError:
+            return None
+    if not isinstance(history, dict):
+        return None
+    section = classify(question)
+    if section is None or section not in history:
+        return None
+    with _lock:
+        _stats[section] += 1
+    text = str(history.get(section) or "").strip()
+    label = SECTION_LABELS[section]
+    if not text:
+        return section, f"No {label.lower()} is recorded for this patient."
+    return section, f"{label}: {text}"
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,133 @@
+"""
+Compact tabular rendering of MIMIC rows for LLM prompts.
+
+fetch_patient_data returns lists of dicts whose reprs repeat every key on every
+row and wrap values in `datetime.datetime(...)` / `Decimal(...)`. Here a
+collection becomes a small pipe-separated table instead: the header is written
+once, columns follow a fixed order per source, columns that are empty in every
+row are dropped, values that are the same in every row are hoisted into one
+"key=value" line, dates are shortened and value/unit pairs are merged
+("140 mEq/L"). The same rendering is used for rows loaded back from the saved
+JSON bundle, so both prompts see identical text.
+"""
+import datetime
+import decimal
+import re
+
+# Preferred column order per MIMIC collection; unknown columns follow alphabetically.
+COLUMN_ORDER = {
+    "patient": ["subject_id", "gender", "dob", "admittime", "dischtime", "hadm_id"],
+    "admissions": ["admittime", "dischtime", "admission_type", "admission_location", "discharge_location",
+                   "insurance", "marital_status", "ethnicity", "hadm_id", "subject_id"],
+    "diagnoses": ["seq_num", "icd9_code", "diagnosis_title"],
+    "procedures": ["seq_num", "procedure_code", "procedure_title"],
+    "icu_stays": ["intime", "outtime", "los", "first_careunit", "last_careunit", "icustay_id"],
+    "transfers": ["intime", "outtime", "eventtype", "prev_careunit", "curr_careunit", "los"],
+    "services": ["transfertime", "prev_service", "curr_service", "hadm_id", "subject_id"],
+    "lab_tests": ["test_name", "n", "last", "min", "max", "trend", "abnormal", "last_time",
+                  "charttime", "value", "flag", "itemid"],
+    "prescriptions": ["startdate", "enddate", "drug", "dose", "route", "drug_type"],
+    "microbiology": ["chartdate", "spec_type_desc", "org_name", "ab_name", "interpretation", "isolate_num"],
+    "notes": ["chartdate", "category", "description", "text"],
+}
+
+# (value column, unit column, merged column): the unit is appended to the value.
+UNIT_COLUMNS = [
+    ("valuenum", "valueuom", "value"),
+    ("dose_val_rx", "dose_unit_rx", "dose"),
+]
+
+_NULLS = (None, "", "None", "nan", "NaN", "null")
+_DATETIME_STRING = re.compile(r"^(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2})(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?$")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def format_value(value):
+    """
+    Short, prompt-friendly text for a single value ("" for nulls).
+    Midnight timestamps lose their time part; Decimals and floats lose trailing zeros.
+    """
+    if value in _NULLS or (isinstance(value, float) and value != value):
+        return ""
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d") if value.time() == datetime.time() else value.strftime("%Y-%m-%d %H:%M")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (decimal.Decimal, float)):
+        return f"{value:.6g}" if isinstance(value, float) else format(value.normalize(), "f")
+    text = _WHITESPACE.sub(" ", str(value)).strip()
+    match = _DATETIME_STRING.match(text)
+    if match:
+        return match.group(1) if match.group(2) == "00:00" else f"{match.group(1)} {match.group(2)}"
+    return text.replace("|", "/")
+
+
+def json_default(value):
+    """
+    `default=` hook for json.dump so saved bundles hold the same normalised values.
+    """
+    if isinstance(value, (datetime.date, decimal.Decimal)):
+        return format_value(value)
+    return str(value)
+
+
+def _merge_units(row):
+    row = dict(row)
+    for value_key, unit_key, merged_key in UNIT_COLUMNS:
+        if value_key not in row and unit_key not in row:
+            continue
+        value = format_value(row.pop(value_key, None))
+        unit = format_value(row.pop(unit_key, None))
+        if merged_key in row and merged_key != value_key:
+            # LABEVENTS carries both `value` (text) and `valuenum`; prefer the numeric one when present.
+            value = value or format_value(row.pop(merged_key))
+        row[merged_key] = f"{value} {unit}".strip() if value else ""
+    return row
+
+
+def _ordered_columns(source, rows):
+    present = []
+    for row in rows:
+        present.extend(key for key in row if key not in present)
+    preferred = [column for column in COLUMN_ORDER.get(source, []) if column in present]
+    return preferred + sorted(column for column in present if column not in preferred)
+
+
+def table_lines(source, rows):
+    """
+    Render `rows` (a dict, a list of dicts or a list of strings) of the MIMIC collection
+    `source` as (header lines, row lines). Header lines hold the constant "key=value"
+    pairs and the column names; each row line is one pipe-separated record.
+    A single row is rendered as one "key=value; ..." line without a header.
+    """
+    if rows in _NULLS:
+        return [], []
+    if not isinstance(rows, list):
+        rows = [rows]
+    if not all(isinstance(row, dict) for row in rows):
+        return [], [format_value(row) for row in rows if format_value(row)]
+
+    cells = [{key: format_value(value) for key, value in _merge_units(row).items()} for row in rows]
+    columns = [column for column in _ordered_columns(source, cells) if any(row.get(column) for row in cells)]
+    if len(cells) == 1:
+        return [], ["; ".join(f"{column}={cells[0][column]}" for column in columns)]
+    header = []
+    if len({tuple(row.get(column, "") for column in columns) for row in cells}) > 1:
+        constant = [column for column in columns if len({row.get(column, "") for row in cells}) == 1]
+        if constant:
+            header.append("; ".join(f"{column}={cells[0][column]}" for column in constant))
+            columns = [column for column in columns if column not in constant]
+    if not columns:
+        return header, []
+    header.append(" | ".join(columns))
+    return header, [" | ".join(row.get(column, "") for column in columns) for row in cells]
+
+
+def serialize_table(source, rows):
+    """
+    `table_lines` joined into a single block of text ("None" when there are no rows).
+    """
+    header, lines = table_lines(source, rows)
+    return "\n".join(header + lines) or "None"
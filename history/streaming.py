@@ -0,0 +1,133 @@
+"""
+Incremental parsing of a streamed JSON history and Server-Sent Events helpers.
+
+`SectionStreamParser` is fed completion chunks as they arrive and returns each
+top-level `"KEY": value` pair of the JSON object as soon as its value is
+complete, so "PC" can be sent to the browser while "SR" is still being
+generated. It is a small character state machine (one pass, no re-scanning):
+text before the opening brace (e.g. a ```json fence) is ignored, string escapes
+are decoded with json.loads, and nested values are captured by brace/bracket
+depth. The whole raw text is kept in `buffer` for the non-streaming fallback.
+"""
+import json
+
+# Parser states
+_BEFORE_OBJECT, _BEFORE_KEY, _IN_KEY, _BEFORE_COLON, _BEFORE_VALUE, _IN_STRING, _IN_NESTED, _IN_SCALAR, _AFTER_VALUE, _DONE = range(10)
+
+
+class SectionStreamParser:
+    def __init__(self):
+        self.buffer = []
+        self.sections = {}
+        self._state = _BEFORE_OBJECT
+        self._token = []
+        self._key = None
+        self._escape = False
+        self._depth = 0
+        self._nested_in_string = False
+
+    @property
+    def text(self):
+        return "".join(self.buffer)
+
+    @property
+    def complete(self):
+        return self._state == _DONE
+
+    def feed(self, chunk):
+        """
+        Consume the next piece of the completion. Returns a list of (key, value)
+        pairs completed by this chunk, in order.
+        """
+        completed = []
+        if not chunk:
+            return completed
+        self.buffer.append(chunk)
+        for char in chunk:
+            pair = self._step(char)
+            if pair:
+                completed.append(pair)
+        return completed
+
+    def _finish_value(self, raw):
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            value = raw
+        key, self._key = self._key, None
+        self._token = []
+        self._state = _AFTER_VALUE
+        self.sections[key] = value
+        return key, value
+
+    def _step(self, char):
+        state = self._state
+        if state == _BEFORE_OBJECT:
+            if char == "{":
+                self._state = _BEFORE_KEY
+        elif state == _BEFORE_KEY:
+            if char == '"':
+                self._state, self._token = _IN_KEY, ['"']
+            elif char == "}":
+                self._state = _DONE
+        elif state in (_IN_KEY, _IN_STRING):
+            self._token.append(char)
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                raw = "".join(self._token)
+                if state == _IN_STRING:
+                    return self._finish_value(raw)
+                try:
+                    self._key = json.loads(raw)
+                except json.JSONDecodeError:
+                    self._key = raw.strip('"')
+                self._state, self._token = _BEFORE_COLON, []
+        elif state == _BEFORE_COLON:
+            if char == ":":
+                self._state = _BEFORE_VALUE
+        elif state == _BEFORE_VALUE:
+            if char == '"':
+                self._state, self._token = _IN_STRING, ['"']
+            elif char in "{[":
+                self._state, self._token, self._depth = _IN_NESTED, [char], 1
+            elif not char.isspace():
+                self._state, self._token = _IN_SCALAR, [char]
+        elif state == _IN_NESTED:
+            self._token.append(char)
+            if self._nested_in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._nested_in_string = False
+            elif char == '"':
+                self._nested_in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    return self._finish_value("".join(self._token))
+        elif state == _IN_SCALAR:
+            if char in ",}":
+                pair = self._finish_value("".join(self._token).strip())
+                self._state = _DONE if char == "}" else _BEFORE_KEY
+                return pair
+            self._token.append(char)
+        elif state == _AFTER_VALUE:
+            if char == ",":
+                self._state = _BEFORE_KEY
+            elif char == "}":
+                self._state = _DONE
+        return None
+
+
+def sse_event(event, data):
+    """
+    One Server-Sent Events frame with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
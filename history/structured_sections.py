@@ -0,0 +1,86 @@
+"""
+Deterministic history sections rendered from structured MIMIC tables.
+
+PMHx comes from DIAGNOSES_ICD/D_ICD_DIAGNOSES and DHx from PRESCRIPTIONS, so
+neither needs the LLM: rows are de-duplicated and rendered through fixed
+templates. The admission's principal diagnosis (lowest seq_num) and the case's
+own condition are left out of PMHx, since they are what the student has to
+work out. The same input always gives the same text, which makes these
+sections reproducible and cacheable; only the narrative sections are sent to
+the LLM.
+"""
+from .serialization import format_value
+
+HISTORY_SECTIONS = ["PC", "HPC", "PMHx", "DHx", "FHx", "SHx", "SR"]
+
+MAX_PMHX_ITEMS = 12
+MAX_DHX_ITEMS = 15
+
+
+def _icd_key(code):
+    return str(code or "").replace(".", "").strip().lstrip("0")
+
+
+def _sentence_case(text):
+    return text[:1].upper() + text[1:] if text else text
+
+
+def render_pmhx(diagnoses, exclude_icd=None):
+    """
+    Past medical history from the admission's secondary diagnoses, in seq_num order.
+    Returns "" when there is nothing to report.
+    """
+    rows = [row for row in diagnoses or [] if isinstance(row, dict) and row.get("diagnosis_title")]
+    if not rows:
+        return ""
+    rows.sort(key=lambda row: int(row.get("seq_num") or 0))
+    excluded = {_icd_key(rows[0].get("icd9_code"))}
+    if exclude_icd:
+        excluded.add(_icd_key(exclude_icd))
+    titles, seen = [], set()
+    for row in rows:
+        title = format_value(row["diagnosis_title"])
+        if _icd_key(row.get("icd9_code")) in excluded or title.lower() in seen:
+            continue
+        seen.add(title.lower())
+        titles.append(title)
+    if not titles:
+        return ""
+    shown = titles[:MAX_PMHX_ITEMS]
+    more = f" (and {len(titles) - len(shown)} other recorded conditions)" if len(titles) > len(shown) else ""
+    return "Known conditions: " + "; ".join(_sentence_case(title) for title in shown) + more + "."
+
+
+def render_dhx(prescriptions):
+    """
+    Drug history from PRESCRIPTIONS: one entry per drug with its dose and route,
+    most recently started first. Returns "" when there are no prescriptions.
+    """
+    rows = [row for row in prescriptions or [] if isinstance(row, dict) and row.get("drug")]
+    if not rows:
+        return ""
+    rows.sort(key=lambda row: format_value(row.get("startdate")), reverse=True)
+    entries, seen = [], set()
+    for row in rows:
+        drug = format_value(row["drug"])
+        if drug.lower() in seen:
+            continue
+        seen.add(drug.lower())
+        dose = " ".join(part for part in (format_value(row.get("dose_val_rx")), format_value(row.get("dose_unit_rx"))) if part)
+        route = format_value(row.get("route"))
+        entries.append(" ".join(part for part in (drug, dose, f"({route})" if route else "") if part))
+    shown = entries[:MAX_DHX_ITEMS]
+    more = f" (and {len(entries) - len(shown)} other medications)" if len(entries) > len(shown) else ""
+    return "Medications: " + "; ".join(shown) + more + "."
+
+
+def prefill_sections(diagnoses, prescriptions, condition=None):
+    """
+    The history sections that can be rendered locally, e.g. {"PMHx": "...", "DHx": "..."}.
+    Sections without supporting rows are omitted so the LLM writes them instead.
+    """
+    prefilled = {
+        "PMHx": render_pmhx(diagnoses, exclude_icd=condition),
+        "DHx": render_dhx(prescriptions),
+    }
+    return {section: text for section, text in prefilled.items() if text}
@@ -1,3 +1,645 @@
-from django.test import TestCase
+import asyncio
+import json
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.test import RequestFactory, SimpleTestCase
+
+from patient_history import circuit_breaker, llm_gateway, model_routing, singleflight, structured_output
+
+from . import fallbacks, question_intents, streaming, views
+
+from .lab_summary import summarize_labs
+from .profiles import Question, TreatmentSet, compile_entry, compile_profile_strings, compile_tree, serialize_tree
+
+TREE = [
+    {"role": "C", "triples": [["patient", "symptom", "chest pain"], ["patient", "symptom", "sweating"]], "logical_rel": "and"},
+    {"role": "D", "triples": [["patient", "drug", "aspirin"], ["patient", "drug", "clopidogrel"]], "logical_rel": "or"},
+    {"role": "C", "triples": [["patient", "sign", "hypotension"]], "logical_rel": "null"},
+    {"role": "C", "triples": [["patient", "history", "diabetes"], ["patient", "history", "smoking"]], "logical_rel": "or"},
+    {"role": "D", "triples": [["patient", "procedure", "PCI"]], "logical_rel": "null"},
+]
+
+
+class ProfileCompilationTests(SimpleTestCase):
+    def test_tree_round_trips_through_compiled_nodes(self):
+        self.assertEqual(serialize_tree(compile_tree(TREE)), TREE)
+
+    def test_triples_of_a_c_node_share_its_group_and_logical_rel(self):
+        questions = [node for node in compile_tree(TREE) if isinstance(node, Question)]
+        self.assertEqual([q.group for q in questions], [0, 0, 2, 3, 3])
+        self.assertEqual([q.logical_rel for q in questions], ["and", "and", "null", "or", "or"])
+        self.assertEqual(questions[0].text, "Does the patient have chest pain (symptom)?")
+
+    def test_adjacent_c_nodes_are_not_merged(self):
+        tree = [
+            {"role": "C", "triples": [["patient", "symptom", "cough"]], "logical_rel": "null"},
+            {"role": "C", "triples": [["patient", "symptom", "fever"]], "logical_rel": "null"},
+        ]
+        self.assertEqual(serialize_tree(compile_tree(tree)), tree)
+
+    def test_stored_english_tree_is_preferred_over_profile_strings(self):
+        entry = {
+            "text2dt_condition": "NSTEMI",
+            "mapped_mimic_group": {"mimic_condition": "Subendocardial infarction", "icd9_codes": ["410.71"]},
+            "english_profile": ["Does the patient have chest pain (symptom)?"],
+            "english_decision_tree": TREE,
+        }
+        profile = compile_entry(entry)
+        self.assertEqual(len(profile.questions), 5)
+        self.assertEqual(profile.treatments[0], TreatmentSet("drug", ("aspirin", "clopidogrel"), "or", "patient"))
+        self.assertEqual(serialize_tree(profile.nodes), TREE)
+
+    def test_profile_strings_compile_to_questions_and_treatments(self):
+        nodes = compile_profile_strings([
+            '"Does the patient have chest pain (symptom)?"',
+            'D node: {"role": "D", "triples": [["patient", "drug", "aspirin"]], "logical_rel": "null"}',
+        ])
+        self.assertEqual(nodes[0].finding, "chest pain")
+        self.assertEqual(nodes[0].relation, "symptom")
+        self.assertIsNone(nodes[0].group)
+        self.assertEqual(nodes[1].options, ("aspirin",))
+
+
+class LabSummaryTests(SimpleTestCase):
+    ROWS = [
+        {"test_name": "Potassium", "charttime": "2150-01-01 08:00", "valuenum": 3.1, "valueuom": "mEq/L", "flag": "abnormal"},
+        {"test_name": "Potassium", "charttime": "2150-01-02 08:00", "valuenum": 4.2, "valueuom": "mEq/L", "flag": None},
+        {"test_name": "Sodium", "charttime": "2150-01-01 08:00", "valuenum": 140, "valueuom": "mEq/L", "flag": None},
+    ]
+
+    def test_rows_are_summarised_per_test(self):
+        summary = summarize_labs(self.ROWS)
+        self.assertEqual([entry["test_name"] for entry in summary], ["Potassium", "Sodium"])
+        self.assertEqual(summary[0]["n"], 2)
+        self.assertEqual(summary[0]["last"], "4.2 mEq/L")
+        self.assertEqual(summary[0]["trend"], "rising")
+
+    def test_saved_summary_is_passed_through(self):
+        summary = summarize_labs(self.ROWS)
+        self.assertEqual(summarize_labs(summary), summary)
+
+
+NESTED_HISTORY = {
+    "PC": "Chest pain",
+    "HPC": "Two hours of central chest pain",
+    "PMHx": ["Hypertension", "Type 2 diabetes"],
+    "DHx": {"Ramipril": "5mg daily", "Allergies": ["penicillin"]},
+    "FHx": "",
+    "SHx": {"Smoking": "20 pack years", "Alcohol": None},
+    "SR": "Nil else",
+}
+FLAT_HISTORY = {
+    "PC": "Chest pain",
+    "HPC": "Two hours of central chest pain",
+    "PMHx": "Hypertension; Type 2 diabetes",
+    "DHx": "Ramipril: 5mg daily; Allergies: penicillin",
+    "FHx": "",
+    "SHx": "Smoking: 20 pack years",
+    "SR": "Nil else",
+}
+
+
+class StructuredHistoryTests(SimpleTestCase):
+    def test_nested_sections_are_accepted_and_flattened(self):
+        reply = "```json\n" + json.dumps(NESTED_HISTORY) + "\n```"
+        self.assertEqual(views.parse_history_response(reply), FLAT_HISTORY)
+
+    def test_reask_reply_with_nested_sections_is_flattened(self):
+        asked = []
+
+        async def reask(reply, error, schema):
+            asked.append(str(error))
+            return json.dumps(NESTED_HISTORY)
+
+        history = asyncio.run(views.aparse_history_response('{"PC": "Chest pain"}', reask=reask))
+        self.assertEqual(history, FLAT_HISTORY)
+        self.assertEqual(len(asked), 1)
+        self.assertIn("missing key 'HPC'", asked[0])
+
+    def test_unusable_reply_is_kept_under_pc(self):
+        async def reask(reply, error, schema):
+            return "still not JSON"
+
+        history = asyncio.run(views.aparse_history_response("not JSON", reask=reask))
+        self.assertEqual(history["PC"], "not JSON")
+        self.assertEqual(history["SR"], "")
+
+    def test_streamed_sections_are_validated_and_flattened(self):
+        parser = streaming.SectionStreamParser()
+        text = json.dumps(NESTED_HISTORY)
+        streamed = []
+        for i in range(0, len(text), 7):
+            streamed.extend(parser.feed(text[i:i + 7]))
+        self.assertEqual(dict(streamed)["DHx"], NESTED_HISTORY["DHx"])
+        self.assertEqual(structured_output.section_text(dict(streamed)["DHx"]), FLAT_HISTORY["DHx"])
+        self.assertEqual(views.streamed_history(parser), FLAT_HISTORY)
+
+    def test_truncated_stream_falls_back_to_the_raw_text(self):
+        parser = streaming.SectionStreamParser()
+        parser.feed(json.dumps(NESTED_HISTORY)[:-20])
+        self.assertFalse(parser.complete)
+        self.assertEqual(views.streamed_history(parser)["PC"], parser.text)
+
+    def test_streamed_section_of_the_wrong_type_is_not_used(self):
+        parser = streaming.SectionStreamParser()
+        parser.feed(json.dumps(dict(FLAT_HISTORY, SR=42)))
+        self.assertTrue(parser.complete)
+        self.assertEqual(views.streamed_history(parser)["PC"], parser.text)
+
+
+class SingleflightTests(SimpleTestCase):
+    def test_concurrent_threads_share_one_call(self):
+        flight = singleflight.Group("test")
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"rows": [1, 2]}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do("key", work)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(flight.do("key", work))) for _ in range(4)]
+        for thread in followers:
+            thread.start()
+        while flight.stats["coalesced"] < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"rows": [1, 2]}] * 5)
+        self.assertEqual(flight.stats, {"calls": 5, "coalesced": 4, "shared_from_file": 0})
+
+    def test_failure_is_shared_and_not_cached(self):
+        flight = singleflight.Group("test")
+        with self.assertRaises(ValueError):
+            flight.do("key", lambda: (_ for _ in ()).throw(ValueError("boom")))
+        self.assertEqual(flight.do("key", lambda: "ok"), "ok")
+
+    def test_result_is_shared_across_workers_through_the_lock_dir(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        first, second = singleflight.Group("test", lock_dir=lock_dir), singleflight.Group("test", lock_dir=lock_dir)
+        self.assertEqual(first.do("key", lambda: [1, 2]), [1, 2])
+        self.assertEqual(second.do("key", lambda: self.fail("recomputed")), [1, 2])
+        self.assertEqual(second.stats["shared_from_file"], 1)
+
+    def test_coroutines_share_one_task(self):
+        flight = singleflight.Group("test")
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        async def main():
+            return await asyncio.gather(*(flight.ado("key", work) for _ in range(5)))
+
+        self.assertEqual(asyncio.run(main()), ["answer"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats["coalesced"], 4)
+
+    def test_cancelled_caller_does_not_cancel_the_shared_task(self):
+        flight = singleflight.Group("test")
+
+        async def work():
+            await asyncio.sleep(0.05)
+            return "answer"
+
+        async def main():
+            first = asyncio.ensure_future(flight.ado("key", work))
+            second = asyncio.ensure_future(flight.ado("key", work))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            return await second
+
+        self.assertEqual(asyncio.run(main()), "answer")
+
+
+class GatewayAdmissionTests(SimpleTestCase):
+    def gateway(self, **kwargs):
+        settings = dict(rpm=6000, tpm=10 ** 7, max_concurrency=1, max_queue=10, state_dir="")
+        settings.update(kwargs)
+        return llm_gateway.Gateway(**settings)
+
+    def test_threads_are_admitted_by_priority(self):
+        gateway = self.gateway()
+        held = gateway.acquire("offline", 10)
+        order = []
+
+        def call(priority):
+            ticket = gateway.acquire(priority, 10)
+            order.append(priority)
+            gateway.release(ticket)
+
+        threads = []
+        for priority in ("generation", "marking", "realtime"):
+            threads.append(threading.Thread(target=call, args=(priority,)))
+            threads[-1].start()
+            while gateway.metrics()["classes"][priority]["queued"] == 0:
+                time.sleep(0.005)
+        gateway.release(held)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, ["realtime", "marking", "generation"])
+
+    def test_coroutines_are_admitted_by_priority_when_a_slot_frees(self):
+        gateway = self.gateway()
+        order = []
+
+        async def call(priority):
+            ticket = await gateway.aacquire(priority, 10)
+            order.append((priority, time.monotonic()))
+            await asyncio.sleep(0)
+            gateway.arelease(ticket)
+
+        async def main():
+            held = await gateway.aacquire("offline", 10)
+            tasks = [asyncio.ensure_future(call(priority)) for priority in ("generation", "ask_question", "realtime")]
+            await asyncio.sleep(0.05)
+            released = time.monotonic()
+            gateway.arelease(held)
+            await asyncio.gather(*tasks)
+            return released
+
+        released = asyncio.run(main())
+        self.assertEqual([priority for priority, _ in order], ["realtime", "ask_question", "generation"])
+        # Woken by the release, not by a polling interval.
+        self.assertLess(order[0][1] - released, 0.02)
+
+    def test_queue_wait_is_bounded_per_class(self):
+        gateway = self.gateway()
+
+        async def main():
+            held = await gateway.aacquire("offline", 10)
+            with mock.patch.dict(llm_gateway.MAX_QUEUE_WAIT, {"realtime": 0.05}):
+                with self.assertRaises(llm_gateway.LLMBusyError):
+                    await gateway.aacquire("realtime", 10)
+            gateway.arelease(held)
+
+        asyncio.run(main())
+        metrics = gateway.metrics()
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertEqual(metrics["in_flight"], 0)
+        self.assertEqual(metrics["classes"]["realtime"]["rejected"], 1)
+
+    def test_cancelled_waiter_leaves_the_queue(self):
+        gateway = self.gateway()
+
+        async def main():
+            held = await gateway.aacquire("offline", 10)
+            waiter = asyncio.ensure_future(gateway.aacquire("marking", 10))
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            gateway.arelease(held)
+
+        asyncio.run(main())
+        self.assertEqual((gateway.metrics()["queue_depth"], gateway.metrics()["in_flight"]), (0, 0))
+
+    def test_full_queue_rejects_immediately(self):
+        gateway = self.gateway(max_queue=1)
+
+        async def main():
+            held = await gateway.aacquire("offline", 10)
+            queued = asyncio.ensure_future(gateway.aacquire("marking", 10))
+            await asyncio.sleep(0.01)
+            with self.assertRaises(llm_gateway.LLMBusyError):
+                await gateway.aacquire("realtime", 10)
+            gateway.arelease(held)
+            gateway.arelease(await queued)
+
+        asyncio.run(main())
+
+    def test_node_wide_buckets_are_shared_and_reserved_off_the_loop(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        first = self.gateway(rpm=1, max_concurrency=4, state_dir=state_dir)
+        second = self.gateway(rpm=1, max_concurrency=4, state_dir=state_dir)
+        self.assertTrue(first.shared)
+
+        async def main():
+            ticket = await first.aacquire("realtime", 10)
+            with self.assertRaisesRegex(llm_gateway.LLMBusyError, "rate limit budget exhausted"):
+                await second.aacquire("realtime", 10)
+            first.arelease(ticket)
+
+        with mock.patch.object(llm_gateway, "run_blocking", wraps=llm_gateway.run_blocking) as run_blocking:
+            asyncio.run(main())
+        self.assertGreaterEqual(run_blocking.call_count, 2)
+
+    def test_unused_token_estimate_is_refunded(self):
+        gateway = self.gateway(tpm=1000)
+        ticket = gateway.acquire("marking", 400)
+        self.assertEqual(round(gateway.tokens.level), 600)
+        gateway.release(ticket, used_tokens=100)
+        self.assertEqual(round(gateway.tokens.level), 900)
+
+
+class LookupCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        # Write files inline instead of on the blocking-I/O pool.
+        patch = mock.patch.object(fallbacks, "run_in_background", side_effect=lambda fn, *args: fn(*args))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = fallbacks.LookupCache(self.tmp, max_entries=2)
+        cache.store("a", [1])
+        cache.store("b", [2])
+        cache.get("a")
+        cache.store("c", [3])
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertIsNone(cache.get("b"))   # evicted from memory and disk
+        self.assertEqual(cache.get("a"), [1])
+        self.assertEqual(cache.get("c"), [3])
+
+    def test_total_rows_are_bounded(self):
+        cache = fallbacks.LookupCache(self.tmp, max_rows=10)
+        cache.store("a", list(range(6)))
+        cache.store("b", list(range(6)))
+        self.assertEqual(cache.stats()["rows"], 6)
+        self.assertIsNone(cache.get("a"))
+
+    def test_unchanged_value_is_not_rewritten(self):
+        cache = fallbacks.LookupCache(self.tmp)
+        cache.store("a", [1, 2])
+        cache.store("a", [1, 2])
+        cache.store("a", [1, 2, 3])
+        self.assertEqual(cache.stats()["writes"], 2)
+        self.assertEqual(fallbacks.LookupCache(self.tmp).get("a"), [1, 2, 3])
+
+    def test_only_fixed_lookups_are_cached(self):
+        cache = fallbacks.LookupCache(self.tmp)
+        client = mock.Mock()
+        client.query.return_value.result.return_value = [{"category_prefix": "410"}]
+        with mock.patch.object(fallbacks, "lookup_cache", cache):
+            views.run_bigquery("SELECT search", client=client)
+            self.assertEqual(cache.stats()["entries"], 0)
+            views.run_bigquery("SELECT categories", client=client, fallback=True)
+            self.assertEqual(cache.stats()["entries"], 1)
+
+            client.query.side_effect = ConnectionError("BigQuery unreachable")
+            self.assertEqual(views.run_bigquery("SELECT categories", client=client, fallback=True), [{"category_prefix": "410"}])
+            with self.assertRaises(ConnectionError):
+                views.run_bigquery("SELECT search", client=client)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def breaker(self):
+        return circuit_breaker.CircuitBreaker("test", min_calls=4, open_seconds=30.0)
+
+    def record_failure(self, breaker, error=None):
+        breaker.before()
+        breaker.record(0.1, error or ConnectionError("down"))
+
+    def test_opens_at_the_failure_rate(self):
+        breaker = self.breaker()
+        for _ in range(2):
+            breaker.before()
+            breaker.record(0.1)
+        self.record_failure(breaker)
+        self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+        self.record_failure(breaker)
+        self.assertEqual(breaker.state, circuit_breaker.OPEN)
+        with self.assertRaises(circuit_breaker.CircuitOpenError) as raised:
+            breaker.before()
+        self.assertGreater(raised.exception.retry_after, 1.0)
+
+    def test_client_errors_do_not_count(self):
+        breaker = self.breaker()
+        rejected = type("InvalidRequestError", (Exception,), {"http_status": 400})
+        for _ in range(5):
+            self.record_failure(breaker, rejected())
+        self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+
+    def test_half_open_probe_closes_or_reopens(self):
+        breaker = self.breaker()
+        for _ in range(4):
+            self.record_failure(breaker)
+        later = time.monotonic() + breaker.open_seconds + 1
+        with mock.patch("time.monotonic", return_value=later):
+            self.assertEqual(breaker.state, circuit_breaker.HALF_OPEN)
+            breaker.before()
+            with self.assertRaises(circuit_breaker.CircuitOpenError):
+                breaker.before()   # only one probe at a time
+            breaker.record(0.1, ConnectionError("still down"))
+            self.assertEqual(breaker.state, circuit_breaker.OPEN)
+        with mock.patch("time.monotonic", return_value=later + breaker.open_seconds + 1):
+            breaker.before()
+            breaker.record(0.1)
+            self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+            breaker.before()
+
+    def test_cancelled_probe_is_given_back(self):
+        breaker = self.breaker()
+        for _ in range(4):
+            self.record_failure(breaker)
+        with mock.patch("time.monotonic", return_value=time.monotonic() + breaker.open_seconds + 1):
+            breaker.before()
+            breaker.cancel()
+            self.assertTrue(breaker.available())
+            breaker.before()
+
+    def test_slow_successes_count_as_failures(self):
+        breaker = self.breaker()
+        for _ in range(4):
+            breaker.before()
+            breaker.record(breaker.slow_call_seconds + 1)
+        self.assertEqual(breaker.state, circuit_breaker.OPEN)
+
+
+class AskQuestionTests(SimpleTestCase):
+    HISTORY = json.dumps(FLAT_HISTORY)
+
+    def ask(self, question):
+        request = RequestFactory().post(
+            "/ask_question/", json.dumps({"question": question, "history": self.HISTORY}), content_type="application/json",
+        )
+        with mock.patch.object(views.llm_gateway, "achat_completion", side_effect=AssertionError("LLM called")):
+            response = asyncio.run(views.ask_question(request))
+        return json.loads(response.content)
+
+    def test_section_lookup_is_answered_from_the_history(self):
+        result = self.ask("Any family history?")
+        self.assertEqual(result["section"], "FHx")
+
+    def test_family_rules_out_past_medical_history(self):
+        self.assertEqual(question_intents.classify("Any medical history in your family?"), "FHx")
+        self.assertEqual(question_intents.classify("Any past medical history?"), "PMHx")
+
+    def test_only_whole_section_questions_are_looked_up(self):
+        self.assertEqual(question_intents.classify("What medications are you on?"), "DHx")
+        for question in ("Do you smoke?", "Do you live alone?", "Are you allergic to penicillin?",
+                         "How much do you drink?", "What medications do you take for your blood pressure?"):
+            with self.subTest(question=question):
+                self.assertIsNone(question_intents.classify(question))
+
+    def test_precomputed_answer_is_returned_before_the_prompt_is_built(self):
+        with mock.patch.object(views.case_answers, "lookup", return_value="Two hours.") as lookup:
+            result = self.ask("How long has the pain lasted?")
+        self.assertEqual(result, {"answer": "Two hours.", "precomputed": True})
+        lookup.assert_called_once_with(self.HISTORY, "How long has the pain lasted?")
+
+
+class ModelRoutingTests(SimpleTestCase):
+    def setUp(self):
+        models = {"fast": "model-fast", "standard": "model-standard", "strong": "model-strong"}
+        for patch in (
+            mock.patch.dict(model_routing.TIER_MODELS, models),
+            mock.patch.object(model_routing, "COOLDOWN", 0.0),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def feed(self, route, seconds, failed=False):
+        for _ in range(model_routing.MIN_SAMPLES):
+            route.observe(seconds, failed)
+
+    def test_slow_route_is_downgraded_and_recovers(self):
+        route = model_routing.Route("test", tier="strong", max_tokens=100, slo=2.0)
+        self.feed(route, 3.0)
+        self.assertEqual((route.active_tier, route.model), ("standard", "model-standard"))
+        self.feed(route, 3.0)
+        self.assertEqual(route.active_tier, "fast")
+        self.feed(route, 0.5)
+        self.assertEqual(route.active_tier, "standard")
+        self.feed(route, 0.5)
+        self.assertEqual(route.active_tier, "strong")
+        self.feed(route, 0.5)
+        self.assertEqual(route.active_tier, "strong")   # never above its configured tier
+        self.assertEqual((route.downgrades, route.upgrades), (2, 2))
+
+    def test_fast_failures_count_as_breaches(self):
+        route = model_routing.Route("test", tier="standard", max_tokens=100, slo=2.0)
+        self.feed(route, 0.05, failed=True)
+        self.assertEqual(route.active_tier, "fast")
+        snapshot = route.snapshot()
+        self.assertEqual(snapshot["failures"], model_routing.MIN_SAMPLES)
+        self.assertEqual(snapshot["slo_breaches"], model_routing.MIN_SAMPLES)
+
+    def test_fast_tier_route_is_never_downgraded(self):
+        route = model_routing.Route("test", tier="fast", max_tokens=100, slo=2.0, hedge=True)
+        self.feed(route, 10.0)
+        self.assertEqual(route.active_tier, "fast")
+        self.assertEqual(route.hedge_delay(), 10.0)
+
+    def test_gateway_reports_failed_calls(self):
+        error = type("APIError", (Exception,), {"__module__": "openai.error", "http_status": 503})
+        with mock.patch.object(model_routing, "observe") as observe:
+            llm_gateway._observe_failure("ask_question", time.monotonic() - 1.5, error())
+            llm_gateway._observe_failure("ask_question", time.monotonic(), type("InvalidRequestError", (error,), {"http_status": 400})())
+        observe.assert_called_once()
+        self.assertTrue(observe.call_args.kwargs["failed"])
+        self.assertGreaterEqual(observe.call_args.args[1], 1.5)
+
+    def test_invalid_override_changes_nothing(self):
+        route = model_routing.get("ask_question")
+        before = route.snapshot()
+        with self.assertRaises(model_routing.RoutingError):
+            model_routing._apply_overrides({
+                "tiers": {"fast": "model-other"},
+                "routes": {"ask_question": {"slo": 9.0}, "case_answers": {"max_tokens": "lots"}},
+            }, "test")
+        self.assertEqual(model_routing.TIER_MODELS["fast"], "model-fast")
+        self.assertEqual(route.snapshot()["slo"], before["slo"])
+
+    def test_valid_override_is_applied(self):
+        route = model_routing.get("generate_tree")
+        original = route.snapshot()
+        self.addCleanup(route.configure, slo=original["slo"], max_tokens=original["max_tokens"])
+        model_routing._apply_overrides({"routes": {"generate_tree": {"slo": "12.5", "max_tokens": 200}}}, "test")
+        self.assertEqual((route.slo, route.max_tokens), (12.5, 200))
+
+
+class FakeChatCompletion:
+    """Stands in for openai.ChatCompletion: call N sleeps delays[N] before answering."""
+
+    def __init__(self, *delays):
+        self.delays = list(delays)
+        self.calls = 0
+        self.cancelled = []
+
+    async def acreate(self, stream=False, **kwargs):
+        index, self.calls = self.calls, self.calls + 1
+        try:
+            await asyncio.sleep(self.delays[index])
+        except asyncio.CancelledError:
+            self.cancelled.append(index)
+            raise
+        if stream:
+            return self._chunks(index)
+        return {"choices": [{"message": {"content": f"reply {index}"}}], "usage": {"total_tokens": 10}}
+
+    async def _chunks(self, index):
+        for word in ("reply", str(index)):
+            yield {"choices": [{"delta": {"content": word}}]}
+
+
+class HedgingTests(SimpleTestCase):
+    def setUp(self):
+        self.gateway = llm_gateway.Gateway(rpm=6000, tpm=10 ** 7, max_concurrency=8, max_queue=10, state_dir="")
+        for patch in (
+            mock.patch.object(model_routing.Route, "hedge_delay", return_value=0.02),
+            mock.patch.object(model_routing, "observe"),
+            mock.patch.object(model_routing, "HEDGING", True),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def call(self, completion, **kwargs):
+        async def main():
+            with mock.patch.object(llm_gateway, "openai", mock.Mock(ChatCompletion=completion)):
+                response = await self.gateway.acreate("ask_question", route="ask_question", messages=[], **kwargs)
+                if kwargs.get("stream"):
+                    return [chunk["choices"][0]["delta"]["content"] async for chunk in response]
+                return response["choices"][0]["message"]["content"]
+        return asyncio.run(main())
+
+    def test_stalled_request_is_cancelled_when_the_backup_wins(self):
+        completion = FakeChatCompletion(5.0, 0.0)
+        self.assertEqual(self.call(completion), "reply 1")
+        self.assertEqual(completion.cancelled, [0])
+        self.assertEqual(self.gateway.metrics()["in_flight"], 0)
+        hedging = self.gateway.hedges.metrics()
+        self.assertEqual(hedging["in_flight"], 0)
+        self.assertEqual(hedging["routes"]["ask_question"]["backup_wins"], 1)
+
+    def test_stalled_stream_is_cancelled_when_the_backup_streams_first(self):
+        completion = FakeChatCompletion(5.0, 0.0)
+        self.assertEqual(self.call(completion, stream=True), ["reply", "1"])
+        self.assertEqual(completion.cancelled, [0])
+        self.assertEqual(self.gateway.metrics()["in_flight"], 0)
+
+    def test_backup_is_cancelled_when_the_primary_answers_first(self):
+        completion = FakeChatCompletion(0.05, 5.0)
+        self.assertEqual(self.call(completion), "reply 0")
+        self.assertEqual(completion.cancelled, [1])
+        self.assertEqual(self.gateway.hedges.metrics()["routes"]["ask_question"]["primary_wins"], 1)
+        self.assertEqual(self.gateway.metrics()["in_flight"], 0)
+
+    def test_prompt_reply_sends_no_backup(self):
+        completion = FakeChatCompletion(0.0)
+        self.assertEqual(self.call(completion), "reply 0")
+        self.assertEqual(completion.calls, 1)
+        self.assertEqual(self.gateway.hedges.metrics()["routes"]["ask_question"]["fired"], 0)
+
+    def test_backups_stop_when_the_budget_is_spent(self):
+        self.gateway.hedges = llm_gateway.HedgeBudget(ratio=0.0, max_in_flight=0)
+        completion = FakeChatCompletion(0.05)
+        self.assertEqual(self.call(completion), "reply 0")
+        self.assertEqual(completion.calls, 1)
+        self.assertEqual(self.gateway.hedges.metrics()["routes"]["ask_question"]["skipped"], 1)
@@ -1,20 +1,25 @@
+import hmac
 import json
 import os
 import re  # Ensure this import is present!
-import openai
 import logging
-from google.cloud import bigquery  # Import BigQuery client
 import uuid
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
 import random
 
 # Import your fetch_patient_data (which now works with BigQuery)
 from AIHistory import fetch_patient_data  # Assume this now works with BigQuery
-from dotenv import load_dotenv
-
-load_dotenv()
+# SDKs are imported lazily on first use; see patient_history/services.py.
+from patient_history import services
+from patient_history.services import bigquery
+from patient_history import circuit_breaker, llm_gateway, model_routing, singleflight, structured_output
+from patient_history.aio import executor_view, run_blocking
+from patient_history.circuit_breaker import DependencyUnavailableError
+from patient_history.structured_output import StructuredOutputError
+from realtime_endpoints import transcripts
+from . import case_answers, fallbacks, lab_summary, note_sections, profiles, prompting, question_intents, serialization, streaming, structured_sections
 # Set up logging
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -22,19 +27,48 @@ logging.basicConfig(level=logging.DEBUG)
 # Define a base path for saving raw MIMIC data.
 # (In production, you might use session storage or a caching system.)
 MIMIC_DATA_BASE = "/tmp"
-# Load condition mapping from JSON file
-@csrf_exempt
+# Load condition mapping from JSON file (parsed and compiled once per file change; see history/profiles.py).
+# The returned list is shared between requests, so callers must not mutate it.
 def load_text2dt_mapping():
-    mapping_file = "text2dt_mimic_mapping_english-full-profile.json"
-    if not os.path.exists(mapping_file):
-        logger.error(f"Mapping file {mapping_file} not found.")
-        return None
+    library = profiles.load_profiles()
+    return library.entries if library else None
+
+# Identical concurrent lookups and generations share one backend call (see patient_history/singleflight.py).
+bigquery_flight = singleflight.group("bigquery")
+llm_flight = singleflight.group("llm")
+
+
+def run_bigquery(query, params=(), client=None, fallback=False):
+    """
+    Run a read-only query and return its rows as dicts. `params` is a sequence of
+    (name, type, value) scalar parameters. Concurrent calls with the same SQL and
+    parameters share one BigQuery job; the returned list must not be mutated.
+    With `fallback` (for the fixed lookups only, not queries built from free user
+    input), the result is kept, and returned while BigQuery is failing (see
+    history/fallbacks.py).
+    """
+    key = singleflight.make_key(query, list(params))
+
+    def execute():
+        bq_client = client or services.get_bigquery_client()
+        job_config = None
+        if params:
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ScalarQueryParameter(*param) for param in params]
+            )
+        rows = [dict(row.items()) for row in bq_client.query(query, job_config=job_config).result()]
+        if fallback:
+            fallbacks.lookup_cache.store(key, rows)
+        return rows
+
     try:
-        with open(mapping_file, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return bigquery_flight.do(key, execute)
     except Exception as e:
-        logger.error(f"Error reading mapping file: {e}")
-        return None
+        stale = fallbacks.lookup_cache.get(key) if fallback and circuit_breaker.is_upstream_error(e) else None
+        if stale is None:
+            raise
+        logger.warning("BigQuery lookup failed (%s); serving the last good result.", e)
+        return stale
 
 # NEW: Helper function to automatically get a subject_id based on condition ICD code.
 def get_subject_id_by_condition(condition_icd):
@@ -45,23 +79,15 @@ def get_subject_id_by_condition(condition_icd):
     Returns the subject_id if found; otherwise, returns None.
     """
     try:
-        client = bigquery.Client()
         query = """
             SELECT DISTINCT subject_id 
             FROM `fyp-project-451413.mimic_iii_local.DIAGNOSES_ICD`
             WHERE REPLACE(TRIM(ICD9_CODE), '.', '') = REPLACE(@icd, '.', '')
             LIMIT 1
         """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("icd", "STRING", condition_icd)
-            ]
-        )
-        query_job = client.query(query, job_config=job_config)
-        results = query_job.result()
-        for row in results:
-            logger.info(f"Found subject_id {row.subject_id} for ICD code {condition_icd}")
-            return row.subject_id
+        for row in run_bigquery(query, [("icd", "STRING", condition_icd)]):
+            logger.info(f"Found subject_id {row['subject_id']} for ICD code {condition_icd}")
+            return row["subject_id"]
         logger.warning(f"No subject found with ICD code {condition_icd}")
         return None
     except Exception as e:
@@ -69,7 +95,7 @@ def get_subject_id_by_condition(condition_icd):
         return None
 
 @csrf_exempt
-def generate_history_with_profile(request):
+async def generate_history_with_profile(request):
     """
     Generates a structured patient history for a condition that exists in the
     `text2dt_mimic_mapping_english-full-profile.json` mapping file.
@@ -97,7 +123,8 @@ def generate_history_with_profile(request):
     except json.JSONDecodeError:
         return JsonResponse({"error": "Invalid JSON"}, status=400)
 
-    mapping_data = load_text2dt_mapping()
+    # The first call (or one after the file changed) reads and compiles the mapping file.
+    mapping_data = await run_blocking(load_text2dt_mapping)
     if mapping_data is None:
         return JsonResponse({"error": "Mapping file not found or could not be loaded."}, status=500)
 
@@ -157,9 +184,16 @@ def generate_history_with_profile(request):
     logger.info(f"Extracted category: {category}")
 
     # Fetch a subject ID from BigQuery using the ICD code
-    subject_id = get_subject_id_by_condition(condition_icd)
+    subject_id = await run_blocking(get_subject_id_by_condition, condition_icd)
     if subject_id is None:
-        return JsonResponse({"error": f"No patient found with condition ICD code {condition_icd}."}, status=404)
+        # While BigQuery is down, a pooled case for the same condition still serves the station.
+        pooled = None
+        if not circuit_breaker.get("bigquery").available():
+            pooled = await run_blocking(pooled_history, {"condition": condition_icd})
+        if pooled is None:
+            return JsonResponse({"error": f"No patient found with condition ICD code {condition_icd}."}, status=404)
+        pooled.update(right_condition=condition_icd, profile=True, category=category)
+        return JsonResponse(pooled)
 
     # Build request for /generate-history/
     new_request_body = {
@@ -171,7 +205,7 @@ def generate_history_with_profile(request):
     request._body = json.dumps(new_request_body).encode("utf-8")
 
     # Call downstream generator
-    response = generate_history(request)
+    response = await generate_history(request)
 
     try:
         response_data = json.loads(response.content)
@@ -183,12 +217,17 @@ def generate_history_with_profile(request):
     response_data["profile"] = True
     response_data["category"] = category
 
+    if response.status_code == 200 and not response_data.get("degraded"):
+        # Answers to the profile's questions are generated while the student reads the case.
+        case_answers.schedule(response_data.get("history"), condition_icd)
+
     return JsonResponse(response_data)
 
 
 
 
 @csrf_exempt
+@executor_view
 def convert_mimic_to_icd(request):
     """
     Given a mimic condition name (e.g. "Hypertrophic cardiomyopathy"),
@@ -234,7 +273,7 @@ def convert_mimic_to_icd(request):
     return JsonResponse({"icd_code": icd_code}, status=200)
 
 @csrf_exempt
-def generate_history(request):
+async def generate_history(request):
     logger.info("Received request to generate history.")
 
     if request.method == "GET":
@@ -249,110 +288,301 @@ def generate_history(request):
         logger.error("Invalid JSON: %s", e)
         return JsonResponse({"error": "Invalid JSON"}, status=400)
 
+    original = dict(data)
     try:
-        client = bigquery.Client()
+        client = await run_blocking(services.get_bigquery_client)
     except Exception as e:
         logger.error("Failed to initialize BigQuery client: %s", e)
-        return JsonResponse({"error": "BigQuery connection failed"}, status=500)
+        return await degraded_history(original, e, JsonResponse({"error": "BigQuery connection failed"}, status=500))
 
-    fallback_condition_name = None
     try:
-        if data.get("random"):
-            condition, subject_id, condition_name = select_random_condition_and_subject(client)
-            if not condition or not subject_id:
-                return JsonResponse({"error": "Failed to select random condition or subject"}, status=500)
+        case, error_response = await run_blocking(prepare_history_case, client, data)
+        if error_response:
+            if not circuit_breaker.get("bigquery").available():
+                return await degraded_history(original, "BigQuery circuit open", error_response)
+            return error_response
+
+        messages = history_messages(case["prompt"])
+        completion_kwargs = {"route": "generate_history", "max_tokens": case["max_tokens"], "temperature": 0.7}
+        gpt_response = await llm_gateway.achat_completion("generation", messages=messages, **completion_kwargs)
+        history_str = gpt_response["choices"][0]["message"]["content"].strip()
+        history_data = await aparse_history_response(
+            history_str,
+            case["requested"],
+            reask=structured_output.areask_via(llm_gateway.acreator("generation"), messages, **completion_kwargs),
+        )
+        result = await run_blocking(history_result, client, data, case, history_data)
+        await run_blocking(fallbacks.case_pool.remember, case["condition"], result)
+        return JsonResponse(result)
+
+    except DependencyUnavailableError as e:
+        return await degraded_history(original, e, circuit_breaker.unavailable_response(e))
+    except Exception as e:
+        logger.exception("Unexpected error in generate_history: %s", e)
+        error_response = JsonResponse({"error": f"Unexpected error: {str(e)}"}, status=500)
+        if circuit_breaker.is_upstream_error(e):
+            return await degraded_history(original, e, error_response)
+        return error_response
+
+
+async def degraded_history(data, reason, otherwise):
+    """
+    Degraded generate_history response: a pooled case matching the request (see
+    history/fallbacks.py), or `otherwise` if none is pooled.
+    """
+    # The pool may have to be read from disk.
+    pooled = await run_blocking(pooled_history, data)
+    if pooled is None:
+        return otherwise
+    logger.warning("Serving a pooled case for generate_history (%s).", reason)
+    return JsonResponse(pooled)
+
+
+def pooled_history(data):
+    condition = None if data.get("random") else (str(data.get("condition") or "").strip() or None)
+    return fallbacks.case_pool.pick(condition, data.get("category"))
+
+
+async def pooled_history_events(pooled):
+    for section, text in pooled["history"].items():
+        yield streaming.sse_event("section", {"section": section, "text": text})
+    yield streaming.sse_event("done", pooled)
+
+
+async def degraded_history_stream(data, reason):
+    """
+    The SSE counterpart of degraded_history; returns None if no case is pooled.
+    """
+    pooled = await run_blocking(pooled_history, data)
+    if pooled is None:
+        return None
+    logger.warning("Serving a pooled case for generate_history_stream (%s).", reason)
+    response = StreamingHttpResponse(pooled_history_events(pooled), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+@csrf_exempt
+async def generate_history_stream(request):
+    """
+    Streaming variant of generate_history. Accepts the same POST body and responds
+    with Server-Sent Events:
+      - "section": {"section": "PC", "text": "..."} as soon as each section is complete
+        (locally prefilled sections first, then each LLM section as it is generated)
+      - "done": the same payload generate_history returns
+      - "error": {"error": "..."} if generation fails part-way
+    Errors before streaming starts are returned as normal JSON responses.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request method"}, status=400)
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError as e:
+        logger.error("Invalid JSON: %s", e)
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    original = dict(data)
+    try:
+        client = await run_blocking(services.get_bigquery_client)
+    except Exception as e:
+        logger.error("Failed to initialize BigQuery client: %s", e)
+        return await degraded_history_stream(original, e) or JsonResponse({"error": "BigQuery connection failed"}, status=500)
+    if not circuit_breaker.get("openai").available():
+        # Do not start streaming a case the LLM cannot finish.
+        degraded = await degraded_history_stream(original, "OpenAI circuit open")
+        if degraded:
+            return degraded
+    try:
+        case, error_response = await run_blocking(prepare_history_case, client, data)
+    except Exception as e:
+        logger.exception("Unexpected error in generate_history_stream: %s", e)
+        error_response = JsonResponse({"error": f"Unexpected error: {str(e)}"}, status=500)
+        if circuit_breaker.is_upstream_error(e):
+            return await degraded_history_stream(original, e) or error_response
+        return error_response
+    if error_response:
+        if not circuit_breaker.get("bigquery").available():
+            return await degraded_history_stream(original, "BigQuery circuit open") or error_response
+        return error_response
+
+    async def events():
+        sent = set()
+        for section, text in case["prefilled"].items():
+            sent.add(section)
+            yield streaming.sse_event("section", {"section": section, "text": text})
+        parser = streaming.SectionStreamParser()
+        try:
+            chunks = await llm_gateway.achat_completion(
+                "generation",
+                route="generate_history",
+                messages=history_messages(case["prompt"]),
+                max_tokens=case["max_tokens"],
+                temperature=0.7,
+                stream=True,
+            )
+            async for chunk in chunks:
+                delta = chunk["choices"][0].get("delta", {}).get("content")
+                for section, value in parser.feed(delta):
+                    if section in SECTION_TITLES and section not in sent:
+                        sent.add(section)
+                        yield streaming.sse_event("section", {"section": section, "text": structured_output.section_text(value)})
+            history_data = streamed_history(parser, case["requested"])
+            history = merge_history_sections(history_data, case["prefilled"])
+            for section, text in history.items():
+                if section not in sent:
+                    yield streaming.sse_event("section", {"section": section, "text": text})
+            result = await run_blocking(history_result, client, data, case, history_data)
+            await run_blocking(fallbacks.case_pool.remember, case["condition"], result)
+            yield streaming.sse_event("done", result)
+        except Exception as e:
+            logger.exception("Error while streaming history: %s", e)
+            yield streaming.sse_event("error", {"error": str(e)})
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def prepare_history_case(client, data):
+    """
+    Resolve the condition and subject for a generate_history request, fetch and save the
+    patient's MIMIC data, prefill the structured sections and build the LLM prompt.
+    Returns (case, None), or (None, JsonResponse) when the request cannot be served.
+    """
+    fallback_condition_name = None
+    if data.get("random"):
+        condition, subject_id, condition_name = select_random_condition_and_subject(client)
+        if not condition or not subject_id:
+            return None, JsonResponse({"error": "Failed to select random condition or subject"}, status=500)
+        data["condition"] = condition
+        data["subject_id"] = subject_id
+        fallback_condition_name = condition_name
+    else:
+        subject_id = data.get("subject_id")
+        condition = data.get("condition", "").strip()
+
+        if not subject_id:
+            if not condition:
+                return None, JsonResponse({"error": "Condition or subject_id is required"}, status=400)
+            if not condition.replace(".", "", 1).isdigit():
+                condition = convert_condition_by_bigquery(condition)
+                if not condition:
+                    return None, JsonResponse({"error": f"Condition '{condition}' not found in mimic database."}, status=404)
+            subject_id = get_subject_id_by_condition(condition)
+            if not subject_id:
+                return None, JsonResponse({"error": f"No patient found with condition ICD code {condition}."}, status=404)
             data["condition"] = condition
             data["subject_id"] = subject_id
-            fallback_condition_name = condition_name
-        else:
-            subject_id = data.get("subject_id")
-            condition = data.get("condition", "").strip()
 
-            if not subject_id:
-                if not condition:
-                    return JsonResponse({"error": "Condition or subject_id is required"}, status=400)
-                if not condition.replace(".", "", 1).isdigit():
-                    condition = convert_condition_by_bigquery(condition)
-                    if not condition:
-                        return JsonResponse({"error": f"Condition '{condition}' not found in mimic database."}, status=404)
-                subject_id = get_subject_id_by_condition(condition)
-                if not subject_id:
-                    return JsonResponse({"error": f"No patient found with condition ICD code {condition}."}, status=404)
-                data["condition"] = condition
-                data["subject_id"] = subject_id
-
-        subject_id = data["subject_id"]
-        condition = data["condition"]
-        logger.info(f"Final condition: {condition}, subject_id: {subject_id}")
-
-        (patient, diagnoses, admissions, notes, lab_tests, prescriptions, icu_stays, transfers, procedures, services, microbiology) = fetch_patient_data(client, subject_id=subject_id)
-        if not patient:
-            return JsonResponse({"error": "No patient data found"}, status=404)
-
-        save_raw_mimic_data(subject_id, patient, admissions, diagnoses, procedures, icu_stays, transfers, services, lab_tests, prescriptions, microbiology, notes)
-
-        prompt = build_prompt(subject_id, patient, admissions, diagnoses, procedures, icu_stays, transfers, services, lab_tests, prescriptions, microbiology, notes)
-        gpt_response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a medical assistant providing structured patient histories. Use all the provided raw MIMIC-III data to create a detailed and coherent summary."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=800,
-            temperature=0.7,
-        )
-        history_str = gpt_response["choices"][0]["message"]["content"].strip()
+    subject_id = data["subject_id"]
+    condition = data["condition"]
+    logger.info(f"Final condition: {condition}, subject_id: {subject_id}")
 
-        # === SAFER HISTORY PARSING ===
-        try:
-            history_data = json.loads(history_str)
-        except json.JSONDecodeError:
-            logger.warning("Initial JSON parse failed. Attempting to extract embedded JSON.")
-            match = re.search(r'```json\s*(\{.*\})\s*```', history_str, re.DOTALL)
-            if match:
-                try:
-                    history_data = json.loads(match.group(1))
-                    logger.info("Successfully parsed nested JSON from GPT response.")
-                except json.JSONDecodeError:
-                    logger.error("Nested JSON still invalid. Returning fallback history.")
-                    history_data = {
-                        "PC": history_str,
-                        "HPC": "", "PMHx": "", "DHx": "", "FHx": "", "SHx": "", "SR": ""
-                    }
-            else:
-                logger.warning("No JSON block found in GPT response. Storing full as PC.")
-                history_data = {
-                    "PC": history_str,
-                    "HPC": "", "PMHx": "", "DHx": "", "FHx": "", "SHx": "", "SR": ""
-                }
-
-        # Extract right_condition and fallback to condition_name if needed
-        right_condition = extract_right_condition(diagnoses, fallback_condition_name)
-
-        # Try infer category if not given
-        category = data.get("category")
-        if not category or category.lower() == "other":
-            icd_code = None
-            for diag in diagnoses:
-                if diag.get("icd_code"):
-                    icd_code = diag["icd_code"]
-                    break
-            if icd_code:
-                logger.info(f"Attempting to infer category from ICD code: {icd_code}")
-                category = get_category_from_icd(client, icd_code)
-            else:
-                logger.warning("No usable ICD code found to derive category.")
-            category = category or "Other"
+    (patient, diagnoses, admissions, notes, lab_tests, prescriptions, icu_stays, transfers, procedures, services, microbiology) = fetch_patient_data(client, subject_id=subject_id)
+    if not patient:
+        return None, JsonResponse({"error": "No patient data found"}, status=404)
 
-        return JsonResponse({
-            "history": history_data,
-            "right_condition": right_condition,
-            "category": category
-        })
+    # The admission's lab events are unbounded; only their per-test summary is saved and prompted.
+    lab_tests = lab_summary.summarize_labs(lab_tests)
+    save_raw_mimic_data(subject_id, patient, admissions, diagnoses, procedures, icu_stays, transfers, services, lab_tests, prescriptions, microbiology, notes)
 
-    except Exception as e:
-        logger.exception("Unexpected error in generate_history: %s", e)
-        return JsonResponse({"error": f"Unexpected error: {str(e)}"}, status=500)
+    # PMHx and DHx are rendered locally from the structured tables; the LLM writes the narrative sections.
+    prefilled = structured_sections.prefill_sections(diagnoses, prescriptions, condition=condition)
+    narrative_count = len(SECTION_TITLES) - len(prefilled)
+    prompt = build_prompt(subject_id, patient, admissions, diagnoses, procedures, icu_stays, transfers, services, lab_tests, prescriptions, microbiology, notes, prefilled=prefilled)
+    return {
+        "subject_id": subject_id,
+        "condition": condition,
+        "diagnoses": diagnoses,
+        "fallback_condition_name": fallback_condition_name,
+        "prefilled": prefilled,
+        "requested": [section for section in SECTION_TITLES if section not in prefilled],
+        "prompt": prompt,
+        "max_tokens": max(300, NARRATIVE_TOKENS_PER_SECTION * narrative_count),
+    }, None
+
+
+def history_messages(prompt):
+    return [
+        {"role": "system", "content": "You are a medical assistant providing structured patient histories. Use all the provided raw MIMIC-III data to create a detailed and coherent summary."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def parse_history_response(history_str, sections=None, reask=None):
+    """
+    Parse the LLM's history JSON (see patient_history/structured_output.py), re-asking once
+    through `reask` if given. If no usable object is found the raw text is kept under PC.
+    """
+    schema = structured_output.history_schema(sections or list(SECTION_TITLES))
+    try:
+        return structured_output.flatten_history(structured_output.parse_with_reask(history_str, schema, reask))
+    except StructuredOutputError as e:
+        return unparsed_history(history_str, e)
+
+
+async def aparse_history_response(history_str, sections=None, reask=None):
+    """
+    parse_history_response with an async `reask` (structured_output.areask_via).
+    """
+    schema = structured_output.history_schema(sections or list(SECTION_TITLES))
+    try:
+        return structured_output.flatten_history(await structured_output.aparse_with_reask(history_str, schema, reask))
+    except StructuredOutputError as e:
+        return unparsed_history(history_str, e)
+
+
+def streamed_history(parser, sections=None):
+    """
+    The history from a finished SectionStreamParser, validated and flattened like
+    parse_history_response. Incomplete or invalid output is parsed from the raw text.
+    """
+    schema = structured_output.history_schema(sections or list(SECTION_TITLES))
+    if parser.complete and not schema.problems(parser.sections):
+        return structured_output.flatten_history(parser.sections)
+    return parse_history_response(parser.text.strip(), sections)
+
+
+def unparsed_history(history_str, error):
+    logger.error("Could not parse history JSON (%s). Storing full reply as PC.", error)
+    return {
+        "PC": history_str,
+        "HPC": "", "PMHx": "", "DHx": "", "FHx": "", "SHx": "", "SR": ""
+    }
+
+
+def merge_history_sections(history_data, prefilled):
+    return {section: prefilled.get(section, history_data.get(section, "")) for section in SECTION_TITLES}
+
+
+def history_result(client, data, case, history_data):
+    """
+    The generate_history response body: merged sections, right_condition and category.
+    """
+    diagnoses = case["diagnoses"]
+    # Extract right_condition and fallback to condition_name if needed
+    right_condition = extract_right_condition(diagnoses, case["fallback_condition_name"])
+
+    # Try infer category if not given
+    category = data.get("category")
+    if not category or category.lower() == "other":
+        icd_code = None
+        for diag in diagnoses:
+            if diag.get("icd_code"):
+                icd_code = diag["icd_code"]
+                break
+        if icd_code:
+            logger.info(f"Attempting to infer category from ICD code: {icd_code}")
+            category = get_category_from_icd(client, icd_code)
+        else:
+            logger.warning("No usable ICD code found to derive category.")
+        category = category or "Other"
+
+    return {
+        "history": merge_history_sections(history_data, case["prefilled"]),
+        "right_condition": right_condition,
+        "category": category
+    }
 
 # ========== HELPER FUNCTIONS ==========
 def select_random_condition_and_subject(client, max_retries=5):
@@ -383,6 +613,9 @@ def select_random_condition_and_subject(client, max_retries=5):
                 return icd_code, subject_id, condition_name
             else:
                 logger.warning(f"No subject_id found for ICD code: {icd_code}")
+        except DependencyUnavailableError as e:
+            logger.error(f"BigQuery unavailable, not retrying: {e}")
+            break
         except Exception as e:
             logger.error(f"BigQuery error on attempt #{attempt + 1}: {e}")
 
@@ -430,66 +663,65 @@ def save_raw_mimic_data(subject_id, patient, admissions, diagnoses, procedures,
                 "prescriptions": prescriptions,
                 "microbiology": microbiology,
                 "notes": notes,
-            }, f, indent=2)
+            }, f, indent=2, default=serialization.json_default)
         logger.info(f"Saved raw MIMIC data to {mimic_data_file}")
     except Exception as e:
         logger.error(f"Failed to save MIMIC data: {e}")
 
-def build_prompt(subject_id, patient, admissions, diagnoses, procedures, icu_stays, transfers, services, lab_tests, prescriptions, microbiology, notes):
+SECTION_TITLES = {
+    "PC": "Presenting complaint (PC)",
+    "HPC": "History of presenting complaint (HPC)",
+    "PMHx": "Past medical history (PMHx)",
+    "DHx": "Drug history (DHx)",
+    "FHx": "Family history (FHx)",
+    "SHx": "Social history (SHx)",
+    "SR": "Systems review (SR)",
+}
+NARRATIVE_TOKENS_PER_SECTION = 110
+
+
+def build_prompt(subject_id, patient, admissions, diagnoses, procedures, icu_stays, transfers, services, lab_tests, prescriptions, microbiology, notes, prefilled=None):
+    """
+    Prompt for the history sections that are not in `prefilled` (sections already rendered
+    from structured tables, see history/structured_sections.py). Prefilled sections are shown
+    as context instead of being requested, and a prefilled DHx replaces the prescriptions source.
+    `lab_tests` is the per-test summary from history/lab_summary.py.
+    """
+    prefilled = prefilled or {}
+    requested = [section for section in SECTION_TITLES if section not in prefilled]
+    sources = [source for source in prompting.HISTORY_SOURCES if not (source.key == "prescriptions" and "DHx" in prefilled)]
+    # Each source is fitted into its token budget (see history/prompting.py) so the prompt size stays bounded.
+    sections = prompting.assemble({
+        "patient": patient,
+        "admissions": admissions,
+        "diagnoses": diagnoses,
+        "procedures": procedures,
+        "icu_stays": icu_stays,
+        "transfers": transfers,
+        "services": services,
+        "lab_tests": lab_tests,
+        "prescriptions": prescriptions,
+        "microbiology": microbiology,
+        # Only the history-relevant sections of the notes (see history/note_sections.py).
+        "notes": note_sections.prompt_rows(notes),
+    }, sources=sources)
+    headings = "\n".join(f"{i}) {SECTION_TITLES[section]}" for i, section in enumerate(requested, 1))
+    fields = ",\n".join(f'  "{section}": "..."' for section in requested)
+    context = ""
+    if prefilled:
+        context = "These sections are already written; keep the other sections consistent with them and do not repeat them:\n"
+        context += "\n".join(f"{section}: {text}" for section, text in prefilled.items()) + "\n\n"
     return f"""
 You are provided with detailed MIMIC-III patient data (subject_id={subject_id}). Please analyze the data below and generate a structured patient history with the following headings:
-1) Presenting complaint (PC)
-2) History of presenting complaint (HPC)
-3) Past medical history (PMHx)
-4) Drug history (DHx)
-5) Family history (FHx)
-6) Social history (SHx)
-7) Systems review (SR)
+{headings}
 
 Include as many relevant details as possible from the following data sources:
 
-Patient Info (PATIENTS):
-{patient}
-
-Admissions (ADMISSIONS):
-{admissions}
-
-Diagnoses (DIAGNOSES_ICD + D_ICD_DIAGNOSES):
-{diagnoses}
-
-Procedures (PROCEDURES_ICD + D_ICD_PROCEDURES):
-{procedures}
-
-ICU Stays (ICUSTAYS):
-{icu_stays}
-
-Transfers (TRANSFERS):
-{transfers}
-
-Services (SERVICES):
-{services}
-
-Lab Tests (LABEVENTS + D_LABITEMS):
-{lab_tests}
+{sections.render()}
 
-Prescriptions (PRESCRIPTIONS):
-{prescriptions}
-
-Microbiology (MICROBIOLOGYEVENTS):
-{microbiology}
-
-Clinical Notes (NOTEEVENTS):
-{notes}
-
-Return the entire result as valid JSON with exactly these fields:
+{context}Return the entire result as valid JSON with exactly these fields:
 {{
-  "PC": "...",
-  "HPC": "...",
-  "PMHx": "...",
-  "DHx": "...",
-  "FHx": "...",
-  "SHx": "...",
-  "SR": "..."
+{fields}
 }}
 
 Ensure that even if a section is empty, the field is present.
@@ -497,7 +729,7 @@ Ensure that even if a section is empty, the field is present.
 
 
 @csrf_exempt
-def generate_questions(request):
+async def generate_questions(request):
     """
     This route takes either the original raw MIMIC-III patient data or the generated history details
     as input and returns 4 related questions with their answers.
@@ -555,7 +787,15 @@ def generate_questions(request):
     
     # Determine if we have full raw MIMIC data or just generated history details.
     if isinstance(mimic_data, dict) and "patient" in mimic_data:
-        # Build a detailed prompt using all raw MIMIC-III fields.
+        # Build a detailed prompt using all raw MIMIC-III fields, fitted into a token budget.
+        sections = prompting.assemble(
+            dict(
+                mimic_data,
+                lab_tests=lab_summary.summarize_labs(mimic_data.get("lab_tests")),
+                notes=note_sections.prompt_rows(mimic_data.get("notes")),
+            ),
+            total_budget=prompting.QUESTION_TOTAL_BUDGET,
+        )
         prompt = f"""
 You are provided with detailed raw MIMIC-III patient data. Use all the details below to generate 4 clinically relevant questions and their concise answers.
 Do not include any extra explanation or commentary—return ONLY valid JSON in the following format:
@@ -581,17 +821,7 @@ Do not include any extra explanation or commentary—return ONLY valid JSON in t
   ]
 }}
 
-Patient Info (PATIENTS): {mimic_data.get("patient", "")}
-Admissions (ADMISSIONS): {mimic_data.get("admissions", "")}
-Diagnoses (DIAGNOSES_ICD + D_ICD_DIAGNOSES): {mimic_data.get("diagnoses", "")}
-Procedures (PROCEDURES_ICD + D_ICD_PROCEDURES): {mimic_data.get("procedures", "")}
-ICU Stays (ICUSTAYS): {mimic_data.get("icu_stays", "")}
-Transfers (TRANSFERS): {mimic_data.get("transfers", "")}
-Services (SERVICES): {mimic_data.get("services", "")}
-Lab Tests (LABEVENTS + D_LABITEMS): {mimic_data.get("lab_tests", "")}
-Prescriptions (PRESCRIPTIONS): {mimic_data.get("prescriptions", "")}
-Microbiology (MICROBIOLOGYEVENTS): {mimic_data.get("microbiology", "")}
-Clinical Notes (NOTEEVENTS): {mimic_data.get("notes", "")}
+{sections.render()}
 """
     else:
         # Fallback prompt using generated history details.
@@ -627,51 +857,44 @@ Here is the patient history:
 """
     logger.debug("Constructed prompt for generate_questions: %s", prompt)
 
-    try:
-        openai.api_key = os.getenv("OPENAI_API_KEY")
+    messages = [
+        {"role": "system", "content": "You are a medical assistant that generates relevant clinical questions and answers based on detailed patient data. Output ONLY valid JSON."},
+        {"role": "user", "content": prompt}
+    ]
+    completion_kwargs = {"route": "generate_questions", "temperature": 0.7}
+
+    async def ask_for_questions():
         logger.info("Sending prompt to OpenAI for generate_questions...")
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a medical assistant that generates relevant clinical questions and answers based on detailed patient data. Output ONLY valid JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=500,
-        )
+        response = await llm_gateway.achat_completion("generation", messages=messages, **completion_kwargs)
         logger.info("Received response from OpenAI for generate_questions.")
+        ai_message = response.choices[0].message['content']
+        logger.debug("Raw AI message for generate_questions: %s", ai_message)
+        return await structured_output.aparse_with_reask(
+            ai_message,
+            structured_output.QUESTIONS,
+            reask=structured_output.areask_via(llm_gateway.acreator("generation"), messages, **completion_kwargs),
+        )
+
+    # Students on the same pooled case send the same prompt; they share one completion.
+    try:
+        result_json = await llm_flight.ado(singleflight.make_key("generate_questions", messages, completion_kwargs), ask_for_questions)
+    except DependencyUnavailableError as e:
+        return circuit_breaker.unavailable_response(e)
+    except StructuredOutputError as e:
+        logger.error("Failed to parse AI response as JSON in generate_questions: %s", e)
+        return JsonResponse({'error': 'Failed to parse AI response as JSON.'}, status=500)
     except Exception as e:
         logger.error("Error during OpenAI request for generate_questions: %s", e)
         return JsonResponse({'error': str(e)}, status=500)
     
-    ai_message = response.choices[0].message['content']
-    logger.debug("Raw AI message for generate_questions: %s", ai_message)
-    
-    try:
-        result_json = json.loads(ai_message)
-    except json.JSONDecodeError as e:
-        logger.error("Failed to parse AI response as JSON in generate_questions: %s", e)
-        json_match = re.search(r"\{.*\}", ai_message, re.DOTALL)
-        if json_match:
-            try:
-                result_json = json.loads(json_match.group(0))
-                logger.info("Extracted JSON via regex fallback in generate_questions.")
-            except json.JSONDecodeError as e2:
-                logger.error("Fallback JSON extraction failed in generate_questions: %s", e2)
-                return JsonResponse({'error': 'Failed to parse AI response as JSON.'}, status=500)
-        else:
-            return JsonResponse({'error': 'Failed to parse AI response as JSON.'}, status=500)
-    
     logger.info("Returning result from generate_questions: %s", result_json)
     return JsonResponse(result_json)
 
 @csrf_exempt
+@executor_view
 def get_conditions(request):
     logger.info("Received request to fetch condition types.")
     try:
-        client = bigquery.Client()
-        logger.info("BigQuery client initialized for get_conditions.")
-
         search_query = request.GET.get("search", "").strip()
         # Updated query joining the two tables:
         query = """
@@ -683,15 +906,9 @@ def get_conditions(request):
             ORDER BY d.long_title
             LIMIT 10000;
         """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("search", "STRING", f"%{search_query}%")
-            ]
-        )
-        query_job = client.query(query, job_config=job_config)
-        results = query_job.result()
+        rows = run_bigquery(query, [("search", "STRING", f"%{search_query}%")])
         # Use lowercase field name
-        conditions = [row.long_title for row in results]
+        conditions = [row["long_title"] for row in rows]
         logger.info("Fetched conditions from BigQuery.")
         return JsonResponse({"conditions": conditions}, status=200)
     except Exception as e:
@@ -699,20 +916,16 @@ def get_conditions(request):
         return JsonResponse({"error": f"Failed to fetch conditions: {str(e)}"}, status=500)
 
 @csrf_exempt
+@executor_view
 def get_history_categories(request):
     logger.info("Received request to fetch history categories.")
     try:
-        client = bigquery.Client()
-        logger.info("BigQuery client initialized for get_history_categories.")
-
         query = """
             SELECT DISTINCT SUBSTR(icd9_code, 1, 3) AS category_prefix
             FROM `fyp-project-451413.mimic_iii_local.DIAGNOSES_ICD`            ORDER BY category_prefix
             LIMIT 50;
         """
-        query_job = client.query(query)
-        results = query_job.result()
-        categories = [row.category_prefix for row in results]
+        categories = [row["category_prefix"] for row in run_bigquery(query, fallback=True)]
         logger.info("Fetched history categories from BigQuery.")
         return JsonResponse({"categories": categories}, status=200)
     except Exception as e:
@@ -720,7 +933,7 @@ def get_history_categories(request):
         return JsonResponse({"error": f"Failed to fetch categories: {str(e)}"}, status=500)
 
 @csrf_exempt
-def ask_question(request):
+async def ask_question(request):
     logger.info("Received request to ask a question.")
     if request.method == "POST":
         try:
@@ -735,6 +948,16 @@ def ask_question(request):
                 logger.warning("Missing 'question' or 'history' in the request.")
                 return JsonResponse({"error": "Both question and history are required"}, status=400)
 
+            # Answers that need no LLM call: a plain section lookup, then a precomputed answer.
+            lookup = question_intents.answer(history, question)
+            if lookup:
+                section, answer = lookup
+                logger.info("Answered ask_question from the %s section.", section)
+                return JsonResponse({"answer": answer, "section": section}, status=200)
+            precomputed = await run_blocking(case_answers.lookup, history, question)
+            if precomputed:
+                return JsonResponse({"answer": precomputed, "precomputed": True}, status=200)
+
             prompt = f"""
 Based on the following patient history, please answer the user's question.
 Do not provide any additional details, recommendations, or case analysis beyond what is explicitly asked.
@@ -746,19 +969,21 @@ User's Question:
 {question}
 """
             logger.info("Sending prompt to OpenAI for ask_question...")
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
+            response = await llm_gateway.achat_completion(
+                "ask_question",
+                route="ask_question",
                 messages=[
                     {"role": "system", "content": "You are a medical assistant. Answer only the question asked using the provided patient history, and do not provide any extra details or recommendations."},
                     {"role": "user", "content": prompt}
                 ],
-                max_tokens=600,
                 temperature=0.7
             )
             answer = response["choices"][0]["message"]["content"].strip()
             logger.info(f"ChatGPT response (ask_question): {answer}")
 
             return JsonResponse({"answer": answer}, status=200)
+        except DependencyUnavailableError as e:
+            return circuit_breaker.unavailable_response(e)
         except Exception as e:
             logger.exception("An error occurred while querying ChatGPT for ask_question: %s", e)
             return JsonResponse({"error": f"ChatGPT query failed: {e}"}, status=500)
@@ -770,13 +995,59 @@ User's Question:
 
 def example_endpoint(request):
     return JsonResponse({'message': 'Hello from the new API!'})
+
+
+def llm_metrics(request):
+    """
+    Queue depth, admissions, rejections and bucket levels of the LLM gateway, the
+    circuit breaker states, how many calls the single-flight groups coalesced, the
+    transcript cache's hit rate, the lookup fallback cache's size, how many
+    questions precomputed answers served, how many ask_question lookups were
+    answered from the history sections and the model routes' latencies.
+    """
+    return JsonResponse({
+        "gateway": llm_gateway.metrics(),
+        "circuit_breakers": circuit_breaker.metrics(),
+        "singleflight": singleflight.stats(),
+        "transcript_cache": transcripts.cache.metrics(),
+        "lookup_cache": fallbacks.lookup_cache.stats(),
+        "case_answers": case_answers.stats(),
+        "question_intents": question_intents.stats(),
+        "routes": model_routing.metrics(),
+    })
+
+
+@csrf_exempt
+def llm_routes(request):
+    """
+    GET: the model routing table with observed latencies. POST: change it, e.g.
+    {"routes": {"ask_question": {"tier": "fast", "slo": 3}}, "tiers": {"fast": "<model>"}}.
+    Changes need the LLM_ADMIN_TOKEN environment variable, sent as X-Admin-Token.
+    """
+    if request.method == "GET":
+        return JsonResponse(model_routing.metrics())
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request method"}, status=400)
+    admin_token = os.getenv("LLM_ADMIN_TOKEN")
+    supplied = request.headers.get("X-Admin-Token", "").encode("utf-8")
+    if not admin_token or not hmac.compare_digest(supplied, admin_token.encode("utf-8")):
+        return JsonResponse({"error": "Forbidden"}, status=403)
+    try:
+        overrides = json.loads(request.body)
+        if not isinstance(overrides, dict):
+            raise ValueError("expected a JSON object")
+        model_routing.configure(overrides)
+    except (ValueError, TypeError, AttributeError) as e:
+        return JsonResponse({"error": f"Invalid routing change: {e}"}, status=400)
+    logger.info("Model routing changed: %s", overrides)
+    return JsonResponse(model_routing.metrics())
+
+
 @csrf_exempt
+@executor_view
 def get_general_condition_categories(request):
     logger.info("Received request to fetch general condition categories.")
     try:
-        client = bigquery.Client()
-        logger.info("BigQuery client initialized for get_general_condition_categories.")
-
         # This query groups ICD-9 codes into general disease categories.
         # Note: Adjust the ranges below based on your specific mapping.
         query = """
@@ -806,9 +1077,7 @@ def get_general_condition_categories(request):
         ORDER BY disease_category
         LIMIT 50;
         """
-        query_job = client.query(query)
-        results = query_job.result()
-        categories = [row.disease_category for row in results]
+        categories = [row["disease_category"] for row in run_bigquery(query, fallback=True)]
         logger.info("Fetched general condition categories from BigQuery.")
         return JsonResponse({"categories": categories}, status=200)
     except Exception as e:
@@ -817,12 +1086,10 @@ def get_general_condition_categories(request):
 
 
 @csrf_exempt
+@executor_view
 def get_conditions_by_category(request):
     logger.info("Received request to fetch conditions by category.")
     try:
-        client = bigquery.Client()
-        logger.info("BigQuery client initialized for get_conditions_by_category.")
-        
         category = request.GET.get("category", "").strip()
         if not category:
             return JsonResponse({"error": "Category parameter is required."}, status=400)
@@ -855,14 +1122,7 @@ def get_conditions_by_category(request):
             ORDER BY d.LONG_TITLE
             LIMIT 100;
         """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("category", "STRING", category)
-            ]
-        )
-        query_job = client.query(query, job_config=job_config)
-        results = query_job.result()
-        conditions = [row.long_title for row in results]
+        conditions = [row["long_title"] for row in run_bigquery(query, [("category", "STRING", category)], fallback=True)]
         logger.info("Fetched conditions for category '%s' from BigQuery.", category)
         return JsonResponse({"conditions": conditions}, status=200)
     except Exception as e:
@@ -872,6 +1132,7 @@ def get_conditions_by_category(request):
 
 # ✅ Fetch conditions based on selected category
 @csrf_exempt
+@executor_view
 def get_conditions_by_category_profile(request):
     """
     Fetches all conditions under a specific category from `text2dt_mimic_mapping_english-full-profile.json`,
@@ -900,6 +1161,7 @@ def get_conditions_by_category_profile(request):
     return JsonResponse({"conditions": sorted(conditions)}, status=200)
 
 @csrf_exempt
+@executor_view
 def get_category_by_condition_profile(request):
     """
     Fetches the category for a given condition from `text2dt_mimic_mapping_english-full-profile.json`.
@@ -929,21 +1191,6 @@ def get_category_by_condition_profile(request):
     category = matched_entry.get("category", "Unknown")
     return JsonResponse({"category": category}, status=200)
 
-logger = logging.getLogger(__name__)
-
-# Function to load the MIMIC mapping JSON
-def load_text2dt_mapping():
-    mapping_file = "text2dt_mimic_mapping_english-full-profile.json"
-    if not os.path.exists(mapping_file):
-        logger.error(f"Mapping file {mapping_file} not found.")
-        return None
-    try:
-        with open(mapping_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Error reading mapping file: {e}")
-        return None
-
 def convert_mimic_to_icd_internal(condition):
     """
     Helper to translate an English mimic condition name into its ICD‑9 code using the mapping file.
@@ -974,21 +1221,15 @@ def convert_condition_by_bigquery(condition):
     Returns the ICD‑9 code if found; otherwise, returns None.
     """
     try:
-        client = bigquery.Client()
         query = """
             SELECT icd9_code
             FROM `fyp-project-451413.mimic_iii_local.D_ICD_DIAGNOSES`
             WHERE LOWER(long_title) = LOWER(@cond)
             LIMIT 1
         """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[bigquery.ScalarQueryParameter("cond", "STRING", condition)]
-        )
-        query_job = client.query(query, job_config=job_config)
-        results = query_job.result()
-        for row in results:
-            logger.info(f"BigQuery conversion: Found ICD code {row.icd9_code} for condition '{condition}'")
-            return row.icd9_code
+        for row in run_bigquery(query, [("cond", "STRING", condition)]):
+            logger.info(f"BigQuery conversion: Found ICD code {row['icd9_code']} for condition '{condition}'")
+            return row["icd9_code"]
         logger.warning(f"BigQuery conversion: No ICD code found for condition '{condition}'")
         return None
     except Exception as e:
@@ -1030,21 +1271,15 @@ def get_category_from_icd(client, icd_code: str) -> str:
         LIMIT 1
         """
 
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("icd_code", "STRING", icd_code_clean)
-            ]
-        )
-
-        results = client.query(query, job_config=job_config).result()
-        row = next(results, None)
-        if row:
-            return row.disease_category
+        rows = run_bigquery(query, [("icd_code", "STRING", icd_code_clean)], client=client)
+        if rows:
+            return rows[0]["disease_category"]
     except Exception as e:
         logger.warning(f"BigQuery category lookup failed: {e}")
     return "Other"
 
 @csrf_exempt
+@executor_view
 def convert_icd_to_condition(request):
     """
     Given an ICD-9 code (e.g. "425.1"), return the corresponding condition name.
@@ -1065,21 +1300,15 @@ def convert_icd_to_condition(request):
 
     # 2) Fallback: BigQuery lookup
     try:
-        client = bigquery.Client()
         query = """
           SELECT long_title
           FROM `fyp-project-451413.mimic_iii_local.D_ICD_DIAGNOSES`
           WHERE icd9_code = @code
           LIMIT 1
         """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("code", "STRING", code)
-            ]
-        )
-        row = next(client.query(query, job_config=job_config).result(), None)
-        if row:
-            return JsonResponse({"condition": row.long_title}, status=200)
+        rows = run_bigquery(query, [("code", "STRING", code)])
+        if rows:
+            return JsonResponse({"condition": rows[0]["long_title"]}, status=200)
     except Exception as e:
         logger.error("BigQuery lookup failed in convert_icd_to_condition: %s", e)
 
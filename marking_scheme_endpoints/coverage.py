@@ -0,0 +1,197 @@
+"""
+Deterministic history-taking coverage against a condition's english_profile.
+
+When the compiled profiles (history/profiles.py) are first used, every question
+(C node) and every treatment option (D node) is tokenised and encoded into a
+per-condition TF-IDF matrix. Scoring a conversation is then one matrix
+product between the student's utterances and that matrix, which gives per-item
+coverage and a numeric score in milliseconds without calling the LLM.
+"""
+import json
+import logging
+import re
+import threading
+import time
+
+import numpy as np
+
+from history import profiles
+from patient_history.text_similarity import TfidfSpace
+
+logger = logging.getLogger(__name__)
+
+MAPPING_FILE = profiles.MAPPING_FILE
+COVERAGE_THRESHOLD = 0.35   # cosine similarity at which an item counts as covered
+TREATMENT_WEIGHT = 0.5      # D-node options matter less than C-node questions in history taking
+
+DOCTOR_ROLES = {"user", "doctor", "student", "clinician", "examiner"}
+_SPEAKER_PREFIX = re.compile(r"^\s*(doctor|user|student|clinician|patient|assistant|ai)\s*:\s*", re.IGNORECASE)
+_SENTENCE_SPLIT = re.compile(r"(?<=[?.!])\s+|\n+")
+
+_index_lock = threading.Lock()
+_index_cache = {}
+
+
+def coverage_items(compiled):
+    """
+    Coverage items for a compiled profile: one per C-node question and one per D-node option.
+    {"kind": "question" | "treatment", "text": <shown to the user>, "match_text": <what is matched>, ...}
+    """
+    items = []
+    for node in compiled.nodes:
+        if isinstance(node, profiles.Question):
+            items.append({"kind": "question", "text": node.text, "match_text": node.finding})
+        else:
+            items.extend(
+                {"kind": "treatment", "text": option, "match_text": option, "logical_rel": node.logical_rel}
+                for option in node.options
+            )
+    return items
+
+
+class CaseCoverage:
+    """
+    A mapping entry with its coverage items pre-encoded against the shared TF-IDF space.
+    """
+
+    def __init__(self, entry, compiled, items, space):
+        self.entry = entry
+        self.compiled = compiled
+        self.items = items
+        self.space = space
+        self.weights = np.array(
+            [TREATMENT_WEIGHT if item["kind"] == "treatment" else 1.0 for item in items], dtype=np.float32
+        )
+        self.vocab, self.matrix = space.encode([item["match_text"] for item in items])
+
+
+class CoverageIndex:
+    def __init__(self, library):
+        cases = [(entry, compiled, coverage_items(compiled)) for entry, compiled in zip(library.entries, library.compiled)]
+        self.space = TfidfSpace(item["match_text"] for _, _, items in cases for item in items)
+        self.by_icd = {}
+        for entry, compiled, items in cases:
+            if not items:
+                continue
+            case = CaseCoverage(entry, compiled, items, self.space)
+            for code in compiled.icd9_codes:
+                self.by_icd.setdefault(profiles.normalize_icd(code), case)
+
+    def lookup(self, mimic_icd_code):
+        return self.by_icd.get(profiles.normalize_icd(mimic_icd_code))
+
+
+def get_index(mapping_file=MAPPING_FILE):
+    """
+    Return the CoverageIndex for `mapping_file`. It is rebuilt only when the compiled
+    profile library (history/profiles.py) is reloaded because the file changed.
+    """
+    library = profiles.load_profiles(mapping_file)
+    if library is None:
+        return None
+    cached = _index_cache.get(mapping_file)
+    if cached and cached[0] is library:
+        return cached[1]
+    with _index_lock:
+        cached = _index_cache.get(mapping_file)
+        if cached and cached[0] is library:
+            return cached[1]
+        start = time.perf_counter()
+        index = CoverageIndex(library)
+        _index_cache[mapping_file] = (library, index)
+        logger.info("Built coverage index for %d ICD codes in %.0f ms.",
+                    len(index.by_icd), (time.perf_counter() - start) * 1000)
+        return index
+
+
+def conversation_utterances(conversation_logs):
+    """
+    Split conversation logs into the student's utterances (sentences).
+    Accepts a list of {"role", "content"} messages, a list of strings, a JSON string
+    or plain "Doctor: ... / Patient: ..." text. If no speaker can be identified every line is used.
+    """
+    logs = conversation_logs
+    if isinstance(logs, str):
+        try:
+            logs = json.loads(logs)
+        except json.JSONDecodeError:
+            logs = logs.splitlines()
+    if isinstance(logs, dict):
+        logs = logs.get("messages") or list(logs.values())
+    if not isinstance(logs, list):
+        logs = [str(logs)]
+
+    doctor_turns, all_turns = [], []
+    for turn in logs:
+        if isinstance(turn, dict):
+            text = str(turn.get("content") or turn.get("text") or turn.get("message") or "")
+            role = str(turn.get("role") or turn.get("sender") or "").lower()
+        else:
+            text = str(turn)
+            prefix = _SPEAKER_PREFIX.match(text)
+            role = prefix.group(1).lower() if prefix else ""
+            text = _SPEAKER_PREFIX.sub("", text)
+        if not text.strip():
+            continue
+        all_turns.append(text)
+        if role in DOCTOR_ROLES:
+            doctor_turns.append(text)
+
+    utterances = []
+    for turn in doctor_turns or all_turns:
+        utterances.extend(part for part in _SENTENCE_SPLIT.split(turn) if part.strip())
+    return utterances
+
+
+def score_coverage(case, conversation_logs):
+    """
+    Score how much of `case`'s profile the conversation covered.
+    Returns {"score", "covered_count", "total", "items", "elapsed_ms"}; each item carries
+    its similarity, whether it was covered and the utterance that matched it best.
+    """
+    start = time.perf_counter()
+    utterances = conversation_utterances(conversation_logs)
+    if utterances:
+        _, turns = case.space.encode(utterances, case.vocab)
+        similarity = turns @ case.matrix.T
+        best_turn = similarity.argmax(axis=0)
+        best = similarity.max(axis=0)
+    else:
+        best_turn = np.zeros(len(case.items), dtype=int)
+        best = np.zeros(len(case.items), dtype=np.float32)
+
+    credit = np.minimum(best / COVERAGE_THRESHOLD, 1.0)
+    score = float((credit * case.weights).sum() / case.weights.sum() * 100) if len(case.items) else 0.0
+    items = []
+    for i, item in enumerate(case.items):
+        covered = bool(best[i] >= COVERAGE_THRESHOLD)
+        items.append({
+            "kind": item["kind"],
+            "text": item["text"],
+            "similarity": round(float(best[i]), 3),
+            "covered": covered,
+            "matched_utterance": utterances[best_turn[i]] if covered else None,
+        })
+    return {
+        "score": int(round(score)),
+        "covered_count": sum(1 for item in items if item["covered"]),
+        "total": len(items),
+        "items": items,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+    }
+
+
+
+def summarize_coverage(result):
+    """
+    Plain-English summary of a score_coverage() result, used in prompts and as
+    feedback when no LLM narrative is available.
+    """
+    covered = [item["text"] for item in result["items"] if item["covered"]]
+    missed = [item["text"] for item in result["items"] if not item["covered"]]
+    lines = [f"Covered {result['covered_count']} of {result['total']} profile items (score {result['score']}%)."]
+    if covered:
+        lines.append("Covered: " + "; ".join(covered))
+    if missed:
+        lines.append("Missed: " + "; ".join(missed))
+    return "\n".join(lines)
@@ -0,0 +1,275 @@
+"""
+Write-behind persistence for marking results.
+
+Views append records to a local SQLite spool and return straight away; a
+background flusher batch-inserts pending records into Supabase, retrying with
+exponential backoff. A record only leaves the spool once Supabase has accepted
+it, so an outage delays scores instead of losing them.
+The flusher starts on the first enqueue(), or at startup (resume_pending(),
+called from asgi.py/wsgi.py) when a previous process left records behind.
+
+Every record carries its dedupe key into Supabase, and the flusher upserts on
+that unique column (supabase/dedupe_key.sql) while ignoring duplicates. So a
+batch that is sent twice adds no rows. That happens when a claim lease expires
+mid-flush, or when a worker dies between the insert and marking the batch sent.
+
+The spool lives under the project's data/ directory unless MARKING_SPOOL_PATH
+says otherwise; in a container that directory must be a persistent volume, or
+unsent marks are lost on restart.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+SPOOL_PATH = os.getenv("MARKING_SPOOL_PATH", os.path.join(DATA_DIR, "marking_spool.sqlite3"))
+FLUSH_INTERVAL = float(os.getenv("MARKING_SPOOL_FLUSH_INTERVAL", "2"))
+BATCH_SIZE = 50
+MAX_BACKOFF = 300          # seconds between retries of a failing record
+CLAIM_LEASE = 120          # seconds before another worker may retake a claimed batch
+SENT_RETENTION = 7 * 86400 # keep delivered records around for a week for auditing
+
+_client_factory = None
+_local = threading.local()
+_flusher_lock = threading.Lock()
+_flusher = None
+_wake = threading.Event()
+_instance = uuid.uuid4().hex[:8]
+
+
+def set_client_factory(factory):
+    """
+    Register a zero-argument callable returning the Supabase client used by the flusher.
+    """
+    global _client_factory
+    _client_factory = factory
+
+
+def _worker_id():
+    # Includes the pid so forked gunicorn workers never share a claim token.
+    return f"{os.getpid()}-{_instance}"
+
+
+def _connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(os.path.abspath(SPOOL_PATH)), exist_ok=True)
+        conn = sqlite3.connect(SPOOL_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS spool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                dedupe_key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                claimed_by TEXT,
+                claimed_at REAL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                sent_at REAL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS spool_pending ON spool (sent_at, next_attempt_at)")
+        _local.conn = conn
+    return conn
+
+
+def dedupe_key(table, fields):
+    """
+    Stable key for a record: resubmitting the same marking result is a no-op.
+    `fields` must only hold values that are the same on every resubmission.
+    """
+    canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{table}:{canonical}".encode("utf-8")).hexdigest()
+
+
+def enqueue(table, payload, key_fields=None):
+    """
+    Durably append a record destined for `table` and wake the flusher. The dedupe
+    key is computed from `key_fields` (default: the whole payload) and stored in
+    the row's dedupe_key column. Returns the key.
+    """
+    key = dedupe_key(table, payload if key_fields is None else key_fields)
+    conn = _connection()
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO spool (table_name, dedupe_key, payload, created_at) VALUES (?, ?, ?, ?)",
+        (table, key, json.dumps(dict(payload, dedupe_key=key), default=str), time.time()),
+    )
+    if cursor.rowcount:
+        logger.info("Spooled record for %s (key=%s).", table, key[:12])
+    else:
+        logger.info("Duplicate record for %s ignored (key=%s).", table, key[:12])
+    start_flusher()
+    _wake.set()
+    return key
+
+
+def pending_count():
+    row = _connection().execute("SELECT COUNT(*) FROM spool WHERE sent_at IS NULL").fetchone()
+    return row[0]
+
+
+def _claim_batch(conn, now):
+    """
+    Claim up to BATCH_SIZE due records for this worker so that several gunicorn
+    workers sharing the spool never insert the same record twice.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            """
+            UPDATE spool SET claimed_by = ?, claimed_at = ?
+            WHERE id IN (
+                SELECT id FROM spool
+                WHERE sent_at IS NULL
+                  AND next_attempt_at <= ?
+                  AND (claimed_by IS NULL OR claimed_at < ?)
+                ORDER BY id
+                LIMIT ?
+            )
+            """,
+            (_worker_id(), now, now, now - CLAIM_LEASE, BATCH_SIZE),
+        )
+        rows = conn.execute(
+            "SELECT id, table_name, payload, attempts FROM spool WHERE claimed_by = ? AND sent_at IS NULL ORDER BY id",
+            (_worker_id(),),
+        ).fetchall()
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return rows
+
+
+def _mark_sent(conn, ids):
+    conn.executemany(
+        "UPDATE spool SET sent_at = ?, claimed_by = NULL, last_error = NULL WHERE id = ?",
+        [(time.time(), record_id) for record_id in ids],
+    )
+
+
+def _mark_failed(conn, rows, error):
+    now = time.time()
+    conn.executemany(
+        "UPDATE spool SET attempts = ?, next_attempt_at = ?, claimed_by = NULL, last_error = ? WHERE id = ?",
+        [
+            (attempts + 1, now + min(MAX_BACKOFF, 2 ** (attempts + 1)), str(error)[:500], record_id)
+            for record_id, _, _, attempts in rows
+        ],
+    )
+
+
+def _insert_rows(client, table, rows):
+    # Upsert on the unique dedupe_key: records Supabase already has are skipped.
+    client.table(table).upsert(
+        [json.loads(payload) for _, _, payload, _ in rows],
+        on_conflict="dedupe_key",
+        ignore_duplicates=True,
+    ).execute()
+
+
+def flush_once():
+    """
+    Deliver one batch of due records. Returns the number of records delivered.
+    """
+    if _client_factory is None:
+        logger.warning("No Supabase client factory registered; spool not flushed.")
+        return 0
+    conn = _connection()
+    rows = _claim_batch(conn, time.time())
+    if not rows:
+        return 0
+
+    try:
+        client = _client_factory()
+    except Exception as e:
+        logger.error("Could not obtain Supabase client for spool flush: %s", e)
+        _mark_failed(conn, rows, e)
+        return 0
+
+    by_table = {}
+    for row in rows:
+        by_table.setdefault(row[1], []).append(row)
+
+    delivered = 0
+    for table, table_rows in by_table.items():
+        try:
+            _insert_rows(client, table, table_rows)
+            _mark_sent(conn, [row[0] for row in table_rows])
+            delivered += len(table_rows)
+            logger.info("Flushed %d spooled record(s) to %s.", len(table_rows), table)
+            continue
+        except Exception as e:
+            logger.warning("Batch insert into %s failed (%s); retrying records individually.", table, e)
+            if len(table_rows) == 1:
+                _mark_failed(conn, table_rows, e)
+                continue
+        # One bad record must not hold back the rest of the batch.
+        for row in table_rows:
+            try:
+                _insert_rows(client, table, [row])
+                _mark_sent(conn, [row[0]])
+                delivered += 1
+            except Exception as e:
+                logger.error("Insert of spooled record %s into %s failed: %s", row[0], table, e)
+                _mark_failed(conn, [row], e)
+    return delivered
+
+
+def _purge_sent(conn):
+    conn.execute("DELETE FROM spool WHERE sent_at IS NOT NULL AND sent_at < ?", (time.time() - SENT_RETENTION,))
+
+
+def _run_flusher():
+    logger.info("Spool flusher started (worker %s, spool %s).", _worker_id(), SPOOL_PATH)
+    last_purge = 0.0
+    while True:
+        _wake.wait(FLUSH_INTERVAL)
+        _wake.clear()
+        try:
+            while flush_once() == BATCH_SIZE:
+                pass
+            if time.time() - last_purge > 3600:
+                _purge_sent(_connection())
+                last_purge = time.time()
+        except Exception as e:
+            logger.exception("Spool flusher iteration failed: %s", e)
+
+
+def start_flusher():
+    """
+    Start the background flusher for this process if it is not already running.
+    """
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return
+    with _flusher_lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_run_flusher, name="marking-spool-flusher", daemon=True)
+            _flusher.start()
+
+
+def resume_pending(client_factory=None):
+    """
+    Called at process startup: start the flusher straight away when the spool already
+    holds undelivered records (left by a previous process), instead of waiting for the
+    next enqueue(). Returns whether the flusher was started.
+    """
+    if client_factory is not None:
+        set_client_factory(client_factory)
+    if not os.path.exists(SPOOL_PATH) or not pending_count():
+        return False
+    logger.info("Resuming delivery of %d spooled record(s).", pending_count())
+    start_flusher()
+    _wake.set()
+    return True
@@ -0,0 +1,154 @@
+"""
+Provisional, LLM-free section scores for evaluate_history.
+
+The student's write-up is segmented into the seven history headings and each
+section is compared with the same section of the expected history: TF-IDF
+cosine similarity for all sections in one batched NumPy operation, plus recall
+of the expected section's clinical keywords. The result has the same shape as
+the LLM's section_scores, so it can be shown instantly and used as a fallback
+when OpenAI is unavailable.
+"""
+import json
+import re
+import time
+
+import numpy as np
+
+from patient_history.text_similarity import TfidfSpace, keyword_overlap, tokenize
+
+SECTIONS = ["PC", "HPC", "PMHx", "DHx", "FHx", "SHx", "SR"]
+
+SECTION_ALIASES = {
+    "PC": ["presenting complaint", "presenting complaints", "chief complaint", "pc", "cc"],
+    "HPC": ["history of presenting complaint", "history of presenting illness", "history of present illness", "hpc", "hpi"],
+    "PMHx": ["past medical history", "past medical and surgical history", "medical history", "pmhx", "pmh"],
+    "DHx": ["drug history", "medication history", "medications", "medicines", "allergies", "dhx", "dh"],
+    "FHx": ["family history", "fhx", "fh"],
+    "SHx": ["social history", "shx", "sh"],
+    "SR": ["systems review", "system review", "review of systems", "sr", "ros"],
+}
+_ALIAS_TO_SECTION = {alias: section for section, aliases in SECTION_ALIASES.items() for alias in aliases}
+_HEADING = re.compile(
+    r"^[ \t]*(?:[-*#>\d.)]+[ \t]*)?\**[ \t]*("
+    + "|".join(sorted((re.escape(alias) for alias in _ALIAS_TO_SECTION), key=len, reverse=True))
+    + r")\b[ \t]*(?:\([^)\n]{1,12}\))?\**[ \t]*(?::|-|–|\n|$)",
+    re.IGNORECASE | re.MULTILINE,
+)
+_EMPTY_VALUES = {"", "none", "n/a", "na", "not provided", "nil"}
+
+SIMILARITY_WEIGHT = 0.6    # share of a section score from TF-IDF similarity; the rest is keyword recall
+SIMILARITY_CEILING = 0.7   # similarity treated as a perfect match
+
+
+def _canonical_key(key):
+    key = str(key).strip()
+    for section in SECTIONS:
+        if key.lower() == section.lower():
+            return section
+    return _ALIAS_TO_SECTION.get(key.lower())
+
+
+def split_sections(history):
+    """
+    Return {section: text} for a history given as a dict, a JSON string or free text
+    with headings. Free text without any recognisable heading is returned under None.
+    """
+    if isinstance(history, str):
+        try:
+            parsed = json.loads(history)
+            if isinstance(parsed, dict):
+                history = parsed
+        except json.JSONDecodeError:
+            pass
+    if isinstance(history, dict):
+        sections = {}
+        for key, value in history.items():
+            section = _canonical_key(key)
+            if section:
+                sections[section] = value if isinstance(value, str) else json.dumps(value)
+        return sections
+
+    text = str(history or "")
+    matches = list(_HEADING.finditer(text))
+    if not matches:
+        return {None: text}
+    sections = {}
+    for i, match in enumerate(matches):
+        section = _ALIAS_TO_SECTION[match.group(1).lower()]
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        body = text[match.end():end].strip()
+        sections[section] = f"{sections[section]}\n{body}".strip() if section in sections else body
+    return sections
+
+
+def _is_empty(text):
+    return str(text or "").strip().strip(".").lower() in _EMPTY_VALUES
+
+
+def _blend(expected, answered, similarity):
+    if _is_empty(expected):
+        return 100.0
+    if _is_empty(answered):
+        return 0.0
+    overlap = keyword_overlap(tokenize(expected), tokenize(answered))
+    return 100.0 * (
+        SIMILARITY_WEIGHT * min(1.0, float(similarity) / SIMILARITY_CEILING)
+        + (1 - SIMILARITY_WEIGHT) * overlap
+    )
+
+
+def score_answer(expected_answer, user_answer):
+    """
+    Provisional score for a single free-text answer (compare_answer's degraded mode),
+    using the same similarity/keyword blend as a history section. Returns 0-100.
+    """
+    expected, answered = str(expected_answer or ""), str(user_answer or "")
+    space = TfidfSpace([expected, answered])
+    vocab, expected_matrix = space.encode([expected])
+    _, answered_matrix = space.encode([answered], vocab)
+    return int(round(_blend(expected, answered, float(expected_matrix[0] @ answered_matrix[0]))))
+
+
+def score_sections(expected_history, user_response):
+    """
+    Provisional scores for each section plus an overall score, formatted like the LLM result
+    ({"overall_score": "72", "section_scores": {"PC": "80", ...}}). Sections with no
+    expected content are listed in "unscored_sections" instead of being scored.
+    """
+    start = time.perf_counter()
+    expected = split_sections(expected_history)
+    answered = split_sections(user_response)
+    segmented = None not in answered
+    if None in expected:
+        # An unstructured expected history can only be compared as a whole.
+        expected = {section: expected[None] for section in SECTIONS}
+    if not segmented:
+        answered = {section: answered[None] for section in SECTIONS}
+
+    expected_texts = [str(expected.get(section) or "") for section in SECTIONS]
+    answered_texts = [str(answered.get(section) or "") for section in SECTIONS]
+
+    space = TfidfSpace(expected_texts + answered_texts)
+    vocab, expected_matrix = space.encode(expected_texts)
+    _, answered_matrix = space.encode(answered_texts, vocab)
+    similarity = np.einsum("ij,ij->i", expected_matrix, answered_matrix)
+
+    # Sections the expected history leaves empty have nothing to mark against: they get
+    # no score and are left out of the overall average.
+    section_scores = {}
+    unscored = []
+    for i, section in enumerate(SECTIONS):
+        if _is_empty(expected_texts[i]):
+            unscored.append(section)
+            continue
+        section_scores[section] = str(int(round(_blend(expected_texts[i], answered_texts[i], similarity[i]))))
+
+    overall = sum(int(value) for value in section_scores.values()) / len(section_scores) if section_scores else 0
+    return {
+        "overall_score": str(int(round(overall))),
+        "section_scores": section_scores,
+        "unscored_sections": unscored,
+        "segmented": segmented,
+        "provisional": True,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+    }
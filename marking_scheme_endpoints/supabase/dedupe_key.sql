@@ -0,0 +1,8 @@
+-- Idempotent delivery of spooled marking results (marking_scheme_endpoints/persistence.py).
+-- The flusher upserts on dedupe_key with ignore_duplicates, so a batch delivered
+-- twice (expired claim lease, worker crash before it was marked sent) adds no rows.
+ALTER TABLE history_entries ADD COLUMN IF NOT EXISTS dedupe_key text;
+CREATE UNIQUE INDEX IF NOT EXISTS history_entries_dedupe_key ON history_entries (dedupe_key);
+
+ALTER TABLE history_entries_with_profiles ADD COLUMN IF NOT EXISTS dedupe_key text;
+CREATE UNIQUE INDEX IF NOT EXISTS history_entries_with_profiles_dedupe_key ON history_entries_with_profiles (dedupe_key);
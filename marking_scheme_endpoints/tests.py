@@ -1,3 +1,267 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from history import profiles
+from patient_history import text_similarity
+
+from . import coverage, persistence, section_scoring, views
+from .views import save_marking_result
+
+START_FLUSHER = persistence.start_flusher
+
+PROFILE_ENTRY = {
+    "text2dt_condition": "Epilepsy",
+    "mapped_mimic_group": {"mimic_condition": "Epilepsy", "icd9_codes": ["345.9"]},
+    "category": "neurology",
+    "english_profile": [
+        "Does the patient have seizures (symptom)?",
+        "Does the patient have headache (symptom)?",
+        "Does the patient have shortness of breath (symptom)?",
+        'D node: {"role": "D", "triples": [["patient", "treatment", "Drug therapy"]], "logical_rel": "null"}',
+    ],
+}
+
+
+def write_mapping(directory, entries=(PROFILE_ENTRY,)):
+    path = os.path.join(directory, "mapping.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(list(entries), f)
+    return path
+
+
+class FakeTable:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.rows = None
+
+    def upsert(self, rows, on_conflict=None, ignore_duplicates=False):
+        self.client.calls.append((self.name, rows, on_conflict, ignore_duplicates))
+        self.rows = rows
+        return self
+
+    def execute(self):
+        if any(row.get("bad") for row in self.rows) or self.client.fail:
+            raise RuntimeError("insert rejected")
+        for row in self.rows:
+            self.client.stored.setdefault(row["dedupe_key"], row)
+        return self
+
+
+class FakeSupabase:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+        self.stored = {}
+
+    def table(self, name):
+        return FakeTable(self, name)
+
+
+class SpoolTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        patches = [
+            mock.patch.object(persistence, "SPOOL_PATH", f"{self.tmp}/spool.sqlite3"),
+            mock.patch.object(persistence, "start_flusher"),
+            mock.patch.object(persistence, "_local", mock.Mock(conn=None)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = FakeSupabase()
+        persistence.set_client_factory(lambda: self.client)
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_duplicate_enqueue_is_ignored(self):
+        first = persistence.enqueue("history_entries", {"user_id": "u", "overall_score": 7})
+        second = persistence.enqueue("history_entries", {"user_id": "u", "overall_score": 7})
+        self.assertEqual(first, second)
+        self.assertEqual(persistence.pending_count(), 1)
+
+    def test_anonymous_resubmission_has_a_stable_key(self):
+        data = {"user_response": "{}", "conversation_logs": [], "category": "cardio"}
+        first = save_marking_result({"overall_score": 5}, data)
+        second = save_marking_result({"overall_score": 5}, data)
+        self.assertEqual(first, second)
+        self.assertEqual(persistence.pending_count(), 1)
+
+    def test_flush_upserts_on_the_dedupe_key(self):
+        key = persistence.enqueue("history_entries", {"user_id": "u", "overall_score": 7})
+        self.assertEqual(persistence.flush_once(), 1)
+        table, rows, on_conflict, ignore_duplicates = self.client.calls[0]
+        self.assertEqual((table, on_conflict, ignore_duplicates), ("history_entries", "dedupe_key", True))
+        self.assertEqual(rows[0]["dedupe_key"], key)
+        self.assertEqual(persistence.pending_count(), 0)
+        self.assertEqual(persistence.flush_once(), 0)
+
+    def test_redelivered_batch_adds_no_rows(self):
+        persistence.enqueue("history_entries", {"user_id": "u", "overall_score": 7})
+        # The worker dies after the insert, before the batch is marked sent.
+        with mock.patch.object(persistence, "_mark_sent"):
+            persistence.flush_once()
+        with mock.patch("time.time", return_value=time.time() + persistence.CLAIM_LEASE + 1):
+            self.assertEqual(persistence.flush_once(), 1)
+        self.assertEqual(len(self.client.calls), 2)
+        self.assertEqual(len(self.client.stored), 1)
+
+    def test_claim_is_retaken_only_after_the_lease(self):
+        persistence.enqueue("history_entries", {"overall_score": 1})
+        conn = persistence._connection()
+        now = time.time()
+        with mock.patch.object(persistence, "_worker_id", return_value="worker-a"):
+            self.assertEqual(len(persistence._claim_batch(conn, now)), 1)
+        with mock.patch.object(persistence, "_worker_id", return_value="worker-b"):
+            self.assertEqual(persistence._claim_batch(conn, now + 1), [])
+            self.assertEqual(len(persistence._claim_batch(conn, now + persistence.CLAIM_LEASE + 1)), 1)
+
+    def test_failed_batch_is_retried_with_backoff(self):
+        self.client.fail = True
+        persistence.enqueue("history_entries", {"overall_score": 1})
+        self.assertEqual(persistence.flush_once(), 0)
+        attempts, next_attempt_at, error = persistence._connection().execute(
+            "SELECT attempts, next_attempt_at, last_error FROM spool"
+        ).fetchone()
+        self.assertEqual(attempts, 1)
+        self.assertIn("insert rejected", error)
+        self.client.fail = False
+        self.assertEqual(persistence.flush_once(), 0)   # not due yet
+        with mock.patch("time.time", return_value=next_attempt_at + 0.1):
+            self.assertEqual(persistence.flush_once(), 1)
+
+    def test_one_bad_record_does_not_hold_back_the_batch(self):
+        persistence.enqueue("history_entries", {"overall_score": 1})
+        persistence.enqueue("history_entries", {"overall_score": 2, "bad": True})
+        persistence.enqueue("history_entries", {"overall_score": 3})
+        self.assertEqual(persistence.flush_once(), 2)
+        self.assertEqual(persistence.pending_count(), 1)
+
+    def test_spool_left_by_a_previous_process_is_drained_at_startup(self):
+        persistence.enqueue("history_entries", {"overall_score": 1})
+        persistence.enqueue("history_entries", {"overall_score": 2})
+        # A new process: fresh per-thread connections, no flusher, nothing enqueued.
+        with mock.patch.object(persistence, "_local", threading.local()), \
+                mock.patch.object(persistence, "_flusher", None), \
+                mock.patch.object(persistence, "start_flusher", START_FLUSHER), \
+                mock.patch.object(persistence, "_run_flusher", persistence.flush_once), \
+                mock.patch.object(persistence, "enqueue") as enqueue:
+            self.assertTrue(persistence.resume_pending())
+            persistence._flusher.join(5)
+            self.assertEqual(persistence.pending_count(), 0)
+        enqueue.assert_not_called()
+        self.assertEqual(len(self.client.stored), 2)
+
+    def test_empty_spool_does_not_start_the_flusher(self):
+        self.assertFalse(persistence.resume_pending())
+        persistence.start_flusher.assert_not_called()
+
+
+class CoverageTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.index = coverage.get_index(write_mapping(self.tmp))
+
+    def test_questions_and_treatments_are_indexed(self):
+        case = self.index.lookup("3459")
+        self.assertEqual([item["kind"] for item in case.items], ["question"] * 3 + ["treatment"])
+
+    def test_conversation_covers_the_questions_it_asks(self):
+        case = self.index.lookup("345.9")
+        result = coverage.score_coverage(case, [
+            {"role": "user", "content": "Have you had any seizures?"},
+            {"role": "assistant", "content": "Yes, two last week."},
+            {"role": "user", "content": "Are you short of breath?"},
+        ])
+        covered = {item["text"] for item in result["items"] if item["covered"]}
+        self.assertIn("Does the patient have seizures (symptom)?", covered)
+        self.assertIn("Does the patient have shortness of breath (symptom)?", covered)
+        self.assertNotIn("Does the patient have headache (symptom)?", covered)
+        self.assertEqual(result["covered_count"], 2)
+        self.assertTrue(0 < result["score"] < 100)
+
+    def test_empty_conversation_scores_zero(self):
+        result = coverage.score_coverage(self.index.lookup("3459"), [])
+        self.assertEqual((result["score"], result["covered_count"]), (0, 0))
+
+    def test_profile_questions_exclude_treatment_options(self):
+        def no_llm(*args, **kwargs):
+            raise ConnectionError("offline")
+
+        with mock.patch.object(coverage, "get_index", return_value=self.index), \
+                mock.patch.object(views.llm_gateway, "achat_completion", side_effect=no_llm):
+            response = asyncio.run(views.assess_history_taking({
+                "conversation_logs": [{"role": "user", "content": "Any seizures?"}],
+                "mimic_icd_code": "345.9",
+            }))
+        result = json.loads(response.content)
+        self.assertEqual(len(result["profile_questions"]), 3)
+        self.assertNotIn("Drug therapy", result["profile_questions"])
+        self.assertEqual(len(result["coverage"]), 4)
+
+    def test_untranslated_nodes_are_not_scored(self):
+        entry = dict(PROFILE_ENTRY, english_profile=PROFILE_ENTRY["english_profile"] + [
+            'Does the patient have 腰痛 (临床表现)?" translates to "Does the patient have lower back pain (symptom)?',
+            "Does the patient have 少痰 (临床表现)?",
+            'D node: {"role": "D", "triples": [["患者", "治疗药物", "糖皮质激素"], '
+            '["患者", "治疗药物", "Heparin"]], "logical_rel": "or"}',
+        ])
+        case = coverage.get_index(write_mapping(self.tmp, [entry])).lookup("345.9")
+        texts = [item["text"] for item in case.items]
+        self.assertIn("Does the patient have lower back pain (symptom)?", texts)
+        self.assertIn("Heparin", texts)
+        self.assertEqual(len(texts), 6)
+        self.assertTrue(all(profiles.is_english(text) for text in texts))
+
+    def test_ambiguous_words_are_not_rewritten(self):
+        self.assertNotIn("seizure", text_similarity.normalize("the shoes fits well"))
+        self.assertNotIn("fever", text_similarity.normalize("room temperature"))
+        self.assertNotIn("myocardial", text_similarity.normalize("mi casa"))
+        self.assertIn("fever", text_similarity.normalize("a high temperature"))
+        self.assertIn("myocardial infarction", text_similarity.normalize("a heart attack"))
+
+
+class SectionScoringTests(SimpleTestCase):
+    EXPECTED = {
+        "PC": "Chest pain for two hours",
+        "HPC": "Central crushing chest pain radiating to the left arm, with sweating",
+        "PMHx": "Hypertension",
+        "DHx": "Ramipril 5mg daily",
+        "FHx": "",
+        "SHx": "Smoker, 20 pack years",
+        "SR": "None",
+    }
+
+    def test_sections_without_expected_content_are_not_scored(self):
+        result = section_scoring.score_sections(self.EXPECTED, {"PC": "Chest pain", "FHx": "", "SR": ""})
+        self.assertEqual(result["unscored_sections"], ["FHx", "SR"])
+        self.assertNotIn("FHx", result["section_scores"])
+        self.assertNotIn("SR", result["section_scores"])
+        scores = [int(value) for value in result["section_scores"].values()]
+        self.assertEqual(int(result["overall_score"]), round(sum(scores) / len(scores)))
+
+    def test_blank_answer_to_a_blank_section_does_not_raise_the_score(self):
+        answered = {"PC": "Chest pain for two hours"}
+        with_blank = section_scoring.score_sections(self.EXPECTED, dict(answered, FHx=""))
+        without = section_scoring.score_sections(self.EXPECTED, answered)
+        self.assertEqual(with_blank["overall_score"], without["overall_score"])
+        self.assertLess(int(without["overall_score"]), 50)
+
+    def test_matching_write_up_scores_well(self):
+        result = section_scoring.score_sections(self.EXPECTED, dict(self.EXPECTED))
+        self.assertEqual(set(result["section_scores"]), {"PC", "HPC", "PMHx", "DHx", "SHx"})
+        self.assertGreaterEqual(int(result["overall_score"]), 90)
+
+    def test_free_text_write_up_is_segmented_by_heading(self):
+        user_response = "Presenting complaint: chest pain for two hours\nDrug history - ramipril 5mg daily"
+        result = section_scoring.score_sections(self.EXPECTED, user_response)
+        self.assertTrue(result["segmented"])
+        self.assertGreater(int(result["section_scores"]["DHx"]), int(result["section_scores"]["PMHx"]))
@@ -4,12 +4,15 @@ import re
 import uuid
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-import openai
 import logging
 import time
-from dotenv import load_dotenv
-load_dotenv()
 import hashlib
+# OpenAI and Supabase are loaded lazily on first use; see patient_history/services.py.
+from patient_history import circuit_breaker, llm_gateway, services
+from patient_history.aio import executor_view, run_blocking
+from patient_history.circuit_breaker import DependencyUnavailableError
+from patient_history import structured_output
+from patient_history.structured_output import StructuredOutputError
 def generate_user_uuid(email: str) -> str:
     """
     Generate a consistent UUID based on the provided email address.
@@ -21,18 +24,16 @@ def generate_user_uuid(email: str) -> str:
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
-from supabase import create_client, Client
 
-SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
-SUPABASE_KEY = os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# The spool flusher builds the Supabase client the first time it has records to deliver.
+from history import profiles
+from . import coverage, persistence, section_scoring
+persistence.set_client_factory(services.get_supabase)
 
-def get_user_id(data):
+def known_user_id(data):
     """
-    Ensure that a valid UUID is returned.
-    - If the user_id field is provided and valid, return it.
-    - Otherwise, if an email is provided, generate a consistent UUID from it.
-    - If neither is provided, generate a new random UUID.
+    The user's UUID from a valid user_id field, else one derived from the email,
+    else None.
     """
     user_id = data.get("user_id")
     if user_id:
@@ -43,11 +44,31 @@ def get_user_id(data):
     email = data.get("email")
     if email:
         return generate_user_uuid(email)
-    return str(uuid.uuid4())
+    return None
+
+def get_user_id(data):
+    """
+    Ensure that a valid UUID is returned.
+    - If the user_id field is provided and valid, return it.
+    - Otherwise, if an email is provided, generate a consistent UUID from it.
+    - If neither is provided, generate a new random UUID.
+    """
+    return known_user_id(data) or str(uuid.uuid4())
+
+def submission_key_fields(payload, data):
+    """
+    The fields a spooled record's dedupe key is computed from: the payload, but
+    with the user's known id (or None) instead of a random one, so resubmitting an
+    anonymous result gives the same key.
+    """
+    return dict(payload, user_id=known_user_id(data))
 
 def save_marking_result(result_json, data):
-    # The basic history_entries table includes overall_score.
-    response = supabase.table("history_entries").insert({
+    """
+    Spool the marking result for the history_entries table (which includes overall_score).
+    The insert into Supabase happens in the background; returns the record's dedupe key.
+    """
+    payload = {
         "user_id": get_user_id(data),
         "expected_history": data.get("expected_history"),
         "user_response": data.get("user_response"),
@@ -61,15 +82,17 @@ def save_marking_result(result_json, data):
         "section_scores": result_json.get("section_scores"),
         "section_feedback": result_json.get("section_feedback"),
         "category": data.get("category")
-    }).execute()
-    logger.info("Supabase insert response (history_entries): %s", response)
-    return response
+    }
+    key = persistence.enqueue("history_entries", payload, submission_key_fields(payload, data))
+    logger.info("Spooled marking result for history_entries (key=%s).", key)
+    return key
 
 def save_history_taking_details(feedback_json, data, overall_score):
     """
     Save the detailed history-taking feedback (including score, feedback, and profile questions)
     into a separate table named history_entries_with_profiles.
-    Now also records overall_score.
+    Now also records overall_score. Like save_marking_result, the record is spooled locally
+    and inserted into Supabase by the background flusher.
     """
     payload = {
         "user_id": get_user_id(data),
@@ -86,37 +109,23 @@ def save_history_taking_details(feedback_json, data, overall_score):
         "profile_questions": feedback_json.get("profile_questions"),
         "category": data.get("category")
     }
-    response = supabase.table("history_entries_with_profiles").insert(payload).execute()
-    logger.info("Supabase insert response (history_entries_with_profiles): %s", response)
-    return response
+    key = persistence.enqueue("history_entries_with_profiles", payload, submission_key_fields(payload, data))
+    logger.info("Spooled history-taking details for history_entries_with_profiles (key=%s).", key)
+    return key
 
 def profile_exists_for_condition(mimic_icd_code):
     """
     Checks if an associated profile exists for the given mimic ICD code.
-    Returns True if a matching record is found in the mapping file.
+    Returns True if a matching record is found in the (cached) coverage index of the mapping file.
     """
-    mapping_file = "text2dt_mimic_mapping_english-full-profile.json"
-    if not os.path.exists(mapping_file):
+    index = coverage.get_index()
+    if index is None:
         logger.error("Mapping file not found in profile_exists_for_condition.")
         return False
-    try:
-        with open(mapping_file, "r", encoding="utf-8") as f:
-            text2dt_mapping = json.load(f)
-    except Exception as e:
-        logger.error("Error reading mapping file in profile_exists_for_condition: %s", e)
-        return False
-    normalized = mimic_icd_code.replace(".", "").lstrip("0")
-    matched = next(
-        (
-            record for record in text2dt_mapping
-            if normalized in [code.replace(".", "").lstrip("0") for code in record.get("mapped_mimic_group", {}).get("icd9_codes", [])]
-        ),
-        None
-    )
-    return bool(matched)
+    return index.lookup(mimic_icd_code) is not None
 
 @csrf_exempt
-def evaluate_history(request):
+async def evaluate_history(request):
     logger.info("evaluate_history: Received a request.")
     print("evaluate_history: Received a request.")
 
@@ -152,6 +161,11 @@ def evaluate_history(request):
         logger.error("Missing one or more required parameters.")
         return JsonResponse({'error': 'Missing one or more required parameters.'}, status=400)
 
+    # Local scores are cheap (a few ms, off the event loop); they are returned alongside the
+    # LLM marks and replace them when OpenAI is unavailable.
+    provisional = await run_blocking(section_scoring.score_sections, expected_history, user_response)
+    logger.info("Provisional section scores: %s (%s ms)", provisional["section_scores"], provisional["elapsed_ms"])
+
     prompt = f"""
 You are provided with the expected patient history and a user's response.
 Expected History: {expected_history}
@@ -196,44 +210,51 @@ Make sure the JSON is valid.
 """
     logger.debug("Constructed prompt: %s", prompt)
 
-    openai.api_key = os.getenv("NEXT_PUBLIC_OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
-
     try:
         logger.info("Sending prompt to OpenAI...")
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = await llm_gateway.achat_completion(
+            "marking",
+            route="evaluate_history",
             messages=[
                 {"role": "system", "content": "You are an assistant that evaluates user responses to historical data."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.7,
-            max_tokens=250,
         )
         logger.info("Received response from OpenAI.")
     except Exception as e:
-        logger.error("Error during OpenAI request: %s", e)
-        return JsonResponse({'error': str(e)}, status=500)
-
-    ai_message = response.choices[0].message['content']
-    logger.debug("Raw AI message: %s", ai_message)
+        logger.error("Error during OpenAI request: %s; falling back to provisional local scores.", e)
+        response = None
 
-    try:
-        result_json = json.loads(ai_message)
-        logger.info("AI response parsed successfully as JSON.")
-    except json.JSONDecodeError as e:
-        logger.error("Failed to parse AI response as JSON: %s", e)
-        score_match = re.search(r"(\d{1,3})", ai_message)
-        overall_score = score_match.group(1) if score_match else "0"
+    if response is None:
         result_json = {
-            "overall_score": overall_score,
-            "overall_feedback": ai_message,
-            "section_scores": {},
-            "section_feedback": {}
+            "overall_score": provisional["overall_score"],
+            "overall_feedback": "Detailed feedback is temporarily unavailable. These scores were calculated automatically and are provisional.",
+            "section_scores": provisional["section_scores"],
+            "section_feedback": {},
+            "provisional": True,
         }
+    else:
+        ai_message = response.choices[0].message['content']
+        logger.debug("Raw AI message: %s", ai_message)
+
+        try:
+            result_json = structured_output.extract_json(ai_message, structured_output.EVALUATION)
+            logger.info("AI response parsed successfully as JSON.")
+        except StructuredOutputError as e:
+            # The provisional scores are a better fallback than a re-ask round trip here.
+            logger.error("Failed to parse AI response as JSON: %s", e)
+            result_json = {
+                "overall_score": provisional["overall_score"],
+                "overall_feedback": ai_message,
+                "section_scores": provisional["section_scores"],
+                "section_feedback": {}
+            }
+    result_json["provisional_section_scores"] = provisional["section_scores"]
 
     # Only trigger detailed history-taking if conversation logs, guessed condition, and right disease exist
     # AND if an associated profile is found for the mimic condition.
-    if conversation_logs and guessed_condition and right_disease and profile_exists_for_condition(right_disease):
+    if conversation_logs and guessed_condition and right_disease and await run_blocking(profile_exists_for_condition, right_disease):
         logger.info("Associated profile found for the mimic condition; calling assess_history_taking for detailed history-taking feedback...")
         history_taking_payload = {
             "conversation_logs": conversation_logs,
@@ -246,7 +267,7 @@ Make sure the JSON is valid.
             "guessed_condition": guessed_condition,
             "right_disease": right_disease
         }
-        assess_response = assess_history_taking(history_taking_payload)
+        assess_response = await assess_history_taking(history_taking_payload)
         if assess_response.status_code == 200:
             try:
                 history_taking_data = json.loads(assess_response.content)
@@ -260,14 +281,17 @@ Make sure the JSON is valid.
                 "profile_questions": []
             }
         # Save the detailed feedback in the separate table.
-        save_history_taking_details(history_taking_data, data, result_json.get("overall_score"))
+        try:
+            await run_blocking(save_history_taking_details, history_taking_data, data, result_json.get("overall_score"))
+        except Exception as e:
+            logger.error("Error saving history-taking details: %s", e)
         # Merge the detailed fields into the result JSON so they are returned to the client.
         result_json["history_taking_feedback"] = history_taking_data.get("feedback", "")
         result_json["history_taking_score"] = history_taking_data.get("score", "0")
         result_json["profile_questions"] = history_taking_data.get("profile_questions", [])
 
     try:
-        save_marking_result(result_json, data)
+        await run_blocking(save_marking_result, result_json, data)
     except Exception as e:
         logger.error("Error saving marking result: %s", e)
 
@@ -275,7 +299,39 @@ Make sure the JSON is valid.
     return JsonResponse(result_json)
 
 @csrf_exempt
-def assess_history_taking(data):
+@executor_view
+def evaluate_history_provisional(request):
+    """
+    Instant, LLM-free section scores for a user's history write-up.
+
+    Expects the same JSON payload as evaluate_history (only expected_history and
+    user_response are required) and returns:
+    {
+      "overall_score": "<0-100>",
+      "section_scores": {"PC": "...", "HPC": "...", ...},
+      "segmented": <whether headings were found in user_response>,
+      "provisional": true
+    }
+    The client can call this in parallel with evaluate-history and replace the
+    provisional scores once the full feedback arrives.
+    """
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError as e:
+        logger.error("Invalid JSON received: %s", e)
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+
+    expected_history = data.get('expected_history')
+    user_response = data.get('user_response')
+    if expected_history is None or user_response is None:
+        return JsonResponse({'error': 'Missing one or more required parameters.'}, status=400)
+
+    result = section_scoring.score_sections(expected_history, user_response)
+    logger.info("Returning provisional section scores in %s ms.", result["elapsed_ms"])
+    return JsonResponse(result)
+
+@csrf_exempt
+async def assess_history_taking(data):
     logger.info("assess_history_taking: Function activated.")
     print("assess_history_taking: Function activated.")
 
@@ -289,44 +345,25 @@ def assess_history_taking(data):
         logger.error("assess_history_taking: Missing required parameters.")
         return JsonResponse({'error': 'Missing required parameters.'}, status=400)
 
-    mapping_file = "text2dt_mimic_mapping_english-full-profile.json"
-    if not os.path.exists(mapping_file):
-        logger.error(f"assess_history_taking: Mapping file {mapping_file} not found.")
+    # The first call builds the index from the mapping file: keep it off the event loop.
+    index = await run_blocking(coverage.get_index)
+    if index is None:
+        logger.error(f"assess_history_taking: Mapping file {coverage.MAPPING_FILE} not found.")
         return JsonResponse({'error': 'Mapping file not found.'}, status=500)
 
-    try:
-        with open(mapping_file, "r", encoding="utf-8") as f:
-            text2dt_mapping = json.load(f)
-        logger.info(f"assess_history_taking: Successfully loaded {mapping_file}.")
-    except Exception as e:
-        logger.error(f"assess_history_taking: Error reading {mapping_file}: {e}")
-        return JsonResponse({'error': 'Error reading mapping file.'}, status=500)
-
-    normalized_mimic_icd = mimic_icd_code.replace(".", "").lstrip("0")
-
-    available_icd9_codes = [
-        code.replace(".", "").lstrip("0") for record in text2dt_mapping
-        for code in record.get("mapped_mimic_group", {}).get("icd9_codes", [])
-    ]
-    logger.debug(f"Available ICD-9 codes in JSON file (normalized): {json.dumps(available_icd9_codes, indent=2)}")
-    print(f"Available ICD-9 codes in JSON file (normalized): {json.dumps(available_icd9_codes, indent=2)}")
-
-    matched_condition = next(
-        (
-            record for record in text2dt_mapping
-            if normalized_mimic_icd in [code.replace(".", "").lstrip("0") for code in record.get("mapped_mimic_group", {}).get("icd9_codes", [])]
-        ),
-        None
-    )
-
-    if not matched_condition:
-        logger.warning(f"No match found for ICD-9 code: {mimic_icd_code} (normalized: {normalized_mimic_icd})")
+    case = index.lookup(mimic_icd_code)
+    if not case:
+        logger.warning(f"No match found for ICD-9 code: {mimic_icd_code} (normalized: {profiles.normalize_icd(mimic_icd_code)})")
         return JsonResponse({'error': f'No profile available for condition {mimic_icd_code}.'}, status=404)
 
-    text2dt_condition = matched_condition.get("text2dt_condition", "Unknown Condition")
-    expected_profile = matched_condition.get("english_profile", [])
+    text2dt_condition = case.entry.get("text2dt_condition", "Unknown Condition")
     logger.info(f"Found profile for condition '{text2dt_condition}'.")
-    print(f"Found profile for condition '{text2dt_condition}'.")
+
+    # The score and per-question coverage are computed locally; the LLM is only asked for narrative feedback.
+    coverage_result = await run_blocking(coverage.score_coverage, case, conversation_logs)
+    coverage_summary = coverage.summarize_coverage(coverage_result)
+    logger.info(f"Local coverage for '{text2dt_condition}': {coverage_result['score']}% "
+                f"({coverage_result['covered_count']}/{coverage_result['total']}) in {coverage_result['elapsed_ms']} ms.")
 
     prompt = f"""
 The user conducted a patient interview and provided the following conversation logs:
@@ -334,46 +371,51 @@ The user conducted a patient interview and provided the following conversation l
 Conversation Logs:
 {conversation_logs}
 
-The expected structured questioning profile for this condition '{text2dt_condition}' is:
-{json.dumps(expected_profile, indent=2)}
-Note: The provided profile includes logical decision nodes (denoted by "D node:") that encapsulate additional decision-making logic. Please incorporate these details into your evaluation to provide more comprehensive feedback.
+An automatic comparison of the conversation against the expected structured questioning profile for this condition found:
+{coverage_summary}
+Treatment options come from the profile's decision nodes; mention them only where they should have shaped the questioning.
 
-Please translate the above profile questions from Chinese to English, and ensure that the detailed feedback you provide is entirely in English (do not include any Chinese).
-Then, compare the user's conversation logs to the translated profile and provide detailed feedback on the history-taking performance.
+Provide detailed feedback, entirely in English, on the history-taking performance: what was done well, which important areas were missed and how to improve.
 
 Return a JSON object exactly in this format:
 {{
-  "feedback": "<detailed feedback for history-taking in English>",
-  "score": "<percentage score (0-100)>",
-  "profile_questions": <translated profile questions as an array>
+  "feedback": "<detailed feedback for history-taking in English>"
 }}
 
 Ensure the JSON is valid and contains no additional text.
 """
     logger.debug(f"Constructed AI prompt:\n{prompt}")
 
-    openai.api_key = os.getenv("NEXT_PUBLIC_OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
-
     try:
-        logger.info("Sending prompt to OpenAI for evaluation...")
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        logger.info("Sending prompt to OpenAI for narrative feedback...")
+        response = await llm_gateway.achat_completion(
+            "marking",
+            route="assess_history_taking",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.7,
-            max_tokens=400,
         )
-        logger.info("Received response from OpenAI for assessment.")
-        feedback_json = json.loads(response.choices[0].message["content"])
-        logger.info("Successfully parsed AI response for assessment.")
+        ai_message = response.choices[0].message["content"]
+        try:
+            feedback = structured_output.extract_json(ai_message, structured_output.FEEDBACK)["feedback"]
+        except StructuredOutputError:
+            feedback = ai_message
+        logger.info("Received narrative feedback from OpenAI for assessment.")
     except Exception as e:
-        logger.error(f"Error during OpenAI request: {e}")
-        return JsonResponse({'error': str(e)}, status=500)
-
+        logger.error(f"Error during OpenAI request: {e}; returning local coverage feedback only.")
+        feedback = coverage_summary
+
+    feedback_json = {
+        "feedback": feedback,
+        "score": str(coverage_result["score"]),
+        # Stored in Supabase as the profile's questions: D-node treatment options are not questions.
+        "profile_questions": [item["text"] for item in coverage_result["items"] if item["kind"] == "question"],
+        "coverage": coverage_result["items"],
+    }
     logger.info("Returning feedback response from assess_history_taking.")
     return JsonResponse(feedback_json)
 
 @csrf_exempt
-def generate_tree(request):
+async def generate_tree(request):
     tree_file = "decision_tree.json"
     
     if os.path.exists(tree_file):
@@ -392,17 +434,16 @@ def generate_tree(request):
             "Show the perfect navigation of its logic question tree. "
             "Return the tree in valid JSON format with keys for each decision node."
         )
-        openai.api_key = os.getenv("NEXT_PUBLIC_OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
         try:
             logger.info("No decision tree file found. Requesting tree generation from OpenAI...")
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
+            response = await llm_gateway.achat_completion(
+                "generation",
+                route="generate_tree",
                 messages=[{"role": "user", "content": prompt}],
                 temperature=0.7,
-                max_tokens=500,
             )
             tree_message = response.choices[0].message['content']
-            decision_tree = json.loads(tree_message)
+            decision_tree = structured_output.extract_json(tree_message)
             with open(tree_file, "w") as f:
                 json.dump(decision_tree, f, indent=4)
             return JsonResponse(decision_tree)
@@ -411,7 +452,7 @@ def generate_tree(request):
             return JsonResponse({'error': 'Error generating decision tree.'}, status=500)
 
 @csrf_exempt
-def mark_conversation(request):
+async def mark_conversation(request):
     logger.info("mark_conversation: Received a request.")
     try:
         data = json.loads(request.body)
@@ -429,8 +470,9 @@ def mark_conversation(request):
         logger.error("mark_conversation: Missing one or more required parameters.")
         return JsonResponse({'error': 'Missing one or more required parameters.'}, status=400)
     
+    tree_text = profiles.describe_tree(decision_tree) or json.dumps(decision_tree, indent=2)
     prompt = (
-        f"Using the following decision tree:\n{json.dumps(decision_tree, indent=2)}\n\n"
+        f"Using the following decision tree:\n{tree_text}\n\n"
         f"Evaluate the following conversation logs in which the user navigated a clinical history taking session. "
         f"The user guessed the disease as '{guessed_disease}', but the correct disease is '{right_disease}'.\n\n"
         f"Conversation Logs:\n{conversation_logs}\n\n"
@@ -438,25 +480,27 @@ def mark_conversation(request):
         "Return the feedback in valid JSON format with at least the key 'feedback'."
     )
     
-    openai.api_key = os.getenv("NEXT_PUBLIC_OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
+    messages = [{"role": "user", "content": prompt}]
+    completion_kwargs = {"route": "mark_conversation", "temperature": 0.7}
     try:
         logger.info("mark_conversation: Sending prompt to OpenAI for feedback generation...")
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=300,
-        )
+        response = await llm_gateway.achat_completion("marking", messages=messages, **completion_kwargs)
         feedback_message = response.choices[0].message['content']
-        feedback_json = json.loads(feedback_message)
+        feedback_json = await structured_output.aparse_with_reask(
+            feedback_message,
+            structured_output.FEEDBACK,
+            reask=structured_output.areask_via(llm_gateway.acreator("marking"), messages, **completion_kwargs),
+        )
         return JsonResponse(feedback_json)
+    except DependencyUnavailableError as e:
+        return circuit_breaker.unavailable_response(e)
     except Exception as e:
         logger.error("mark_conversation: Error during OpenAI request: %s", e)
         return JsonResponse({'error': 'Error generating feedback.'}, status=500)
 
 
 @csrf_exempt
-def compare_answer(request):
+async def compare_answer(request):
     logger.info("Received request to compare answer.")
     try:
         data = json.loads(request.body)
@@ -491,44 +535,50 @@ Return ONLY a JSON object exactly in this format:
 Ensure the JSON is valid.
 """
     logger.debug("Constructed prompt for compare_answer: %s", prompt)
-    openai.api_key = os.getenv("NEXT_PUBLIC_OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
     
+    messages = [
+        {"role": "system", "content": "You are an assistant that compares answers and provides very in-depth feedback."},
+        {"role": "user", "content": prompt}
+    ]
+    completion_kwargs = {"route": "compare_answer", "temperature": 0.7}
     try:
         logger.info("Sending prompt to OpenAI for compare_answer...")
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are an assistant that compares answers and provides very in-depth feedback."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=300,
-        )
+        response = await llm_gateway.achat_completion("marking", messages=messages, **completion_kwargs)
         logger.info("Received response from OpenAI for compare_answer.")
     except Exception as e:
-        logger.error("Error during OpenAI request in compare_answer: %s", e)
-        return JsonResponse({'error': str(e)}, status=500)
+        if not circuit_breaker.is_upstream_error(e):
+            logger.error("Error during OpenAI request in compare_answer: %s", e)
+            return JsonResponse({'error': str(e)}, status=500)
+        logger.error("OpenAI unavailable in compare_answer (%s); returning a provisional local score.", e)
+        return JsonResponse(await run_blocking(provisional_answer_result, expected_answer, user_answer))
     
     ai_message = response.choices[0].message["content"]
     logger.debug("Raw AI message for compare_answer: %s", ai_message)
     
     try:
-        result_json = json.loads(ai_message)
-    except json.JSONDecodeError as e:
+        result_json = await structured_output.aparse_with_reask(
+            ai_message,
+            structured_output.COMPARE_ANSWER,
+            reask=structured_output.areask_via(llm_gateway.acreator("marking"), messages, **completion_kwargs),
+        )
+    except Exception as e:
         logger.error("Failed to parse AI response as JSON in compare_answer: %s", e)
-        json_match = re.search(r"\{.*\}", ai_message, re.DOTALL)
-        if json_match:
-            try:
-                result_json = json.loads(json_match.group(0))
-                logger.info("Extracted JSON via regex fallback in compare_answer.")
-            except json.JSONDecodeError as e2:
-                logger.error("Fallback JSON extraction failed in compare_answer: %s", e2)
-                return JsonResponse({'error': 'Failed to parse AI response as JSON.'}, status=500)
-        else:
-            return JsonResponse({'error': 'Failed to parse AI response as JSON.'}, status=500)
+        return JsonResponse({'error': 'Failed to parse AI response as JSON.'}, status=500)
     
     logger.info("Returning compare_answer result: %s", result_json)
     return JsonResponse(result_json)
+
+
+def provisional_answer_result(expected_answer, user_answer):
+    """
+    compare_answer's degraded response: a local similarity score in the LLM's format.
+    """
+    return {
+        "score": str(section_scoring.score_answer(expected_answer, user_answer)),
+        "feedback": "Detailed feedback is temporarily unavailable. This score was calculated automatically and is provisional.",
+        "provisional": True,
+    }
+
 @csrf_exempt
 def example_endpoint(request):
     return JsonResponse({'message': 'Hello from the new API!'})
\ No newline at end of file
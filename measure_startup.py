@@ -0,0 +1,62 @@
+"""
+Measure worker cold-start time.
+
+Each run spawns a fresh interpreter that loads the WSGI application and resolves
+the URLconf (which imports every view module), i.e. the work a gunicorn worker
+does before it can serve its first request.
+
+Usage:
+    python measure_startup.py [--runs 10] [--warm-up]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import time
+start = time.perf_counter()
+from patient_history.wsgi import application
+from django.urls import get_resolver
+get_resolver().url_patterns
+loaded = time.perf_counter()
+if {warm_up}:
+    from patient_history import services
+    services.warm_up()
+print(loaded - start, time.perf_counter() - start)
+"""
+
+
+def measure(runs, warm_up):
+    boot, total = [], []
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE.format(warm_up=warm_up)],
+            capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        if out.returncode != 0:
+            print(out.stderr, file=sys.stderr)
+            sys.exit(out.returncode)
+        first, second = out.stdout.strip().splitlines()[-1].split()
+        boot.append(float(first))
+        total.append(float(second))
+    return boot, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure worker cold-start time.")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--warm-up", action="store_true", help="Also time services.warm_up() after boot.")
+    args = parser.parse_args()
+
+    boot, total = measure(args.runs, args.warm_up)
+    print(f"worker boot (wsgi + urlconf): median {statistics.median(boot) * 1000:.0f} ms, "
+          f"min {min(boot) * 1000:.0f} ms over {args.runs} runs")
+    if args.warm_up:
+        print(f"boot + warm-up: median {statistics.median(total) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
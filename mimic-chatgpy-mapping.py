@@ -1,10 +1,13 @@
 import json
 import os
-import openai
 import logging
 import time
 from difflib import SequenceMatcher
 
+from patient_history.structured_output import CATEGORY, MIMIC_CONDITION, extract_json
+from patient_history import llm_gateway
+from history.profiles import Question, compile_tree
+
 # Configuration file names and paths
 TEXT2DT_FILE = "Text2DT_train.json"                # Your Text2DT training file
 OUTPUT_MAPPING_FILE = "text2dt_mimic_mapping_english.json" # Output file for Text2DT records with mimic mappings
@@ -14,30 +17,6 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- Helper functions ---
-def clean_json_response(response_text):
-    """
-    Remove markdown formatting (e.g. ```json ... ```) from the ChatGPT response.
-    """
-    response_text = response_text.strip()
-    if response_text.startswith("```"):
-        lines = response_text.splitlines()
-        if lines[0].strip().startswith("```"):
-            lines = lines[1:]
-        if lines and lines[-1].strip().endswith("```"):
-            lines = lines[:-1]
-        response_text = "\n".join(lines).strip()
-    return response_text
-
-def extract_json_from_response(response_text):
-    """
-    Extract a JSON object string from the response by locating the first '{' and the last '}'.
-    """
-    start = response_text.find("{")
-    end = response_text.rfind("}")
-    if start != -1 and end != -1 and end > start:
-        return response_text[start:end+1]
-    return response_text
-
 def similarity(a, b):
     """Compute the similarity ratio between two strings."""
     return SequenceMatcher(None, a, b).ratio()
@@ -47,14 +26,14 @@ def translate_to_english(chinese_text):
     prompt = f"Translate the following Chinese medical condition into English: '{chinese_text}'"
     logger.info(f"Translating to English: {chinese_text}")
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = llm_gateway.chat_completion(
+            "offline",
+            route="mapping_translate",
             messages=[
                 {"role": "system", "content": "You are a medical translation assistant."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=60,
         )
         translation = response["choices"][0]["message"]["content"].strip()
         logger.info(f"Translation result: {translation}")
@@ -63,6 +42,21 @@ def translate_to_english(chinese_text):
         logger.error(f"Error during English translation: {e}")
         return chinese_text  # Fallback
 
+_translations = {}
+
+def translate_term(chinese_text):
+    """Translate a single finding/relation/treatment term, reusing earlier translations."""
+    if chinese_text not in _translations:
+        _translations[chinese_text] = translate_to_english(chinese_text)
+    return _translations[chinese_text]
+
+def translate_tree(tree):
+    """Translate a raw decision tree into English term by term, keeping its nodes, triples and logical relations."""
+    return [
+        dict(node, triples=[[translate_term(term) if term else term for term in triple] for triple in node.get("triples", [])])
+        for node in tree
+    ]
+
 def get_best_mimic_condition(text2dt_condition, profile):
     """
     Ask ChatGPT to determine the best fitting Mimic-III condition for the given Text2DT condition and its decision tree profile.
@@ -85,20 +79,18 @@ Only provide one mimic condition that best fits the given Text2DT condition and
 """
     logger.info(f"Asking AI for best Mimic-III condition for: {text2dt_condition}")
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = llm_gateway.chat_completion(
+            "offline",
+            route="mapping_match",
             messages=[
                 {"role": "system", "content": "You are a medical coding assistant."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=150,
         )
         reply = response["choices"][0]["message"]["content"].strip()
         logger.info(f"AI response for condition '{text2dt_condition}': {reply}")
-        reply = clean_json_response(reply)
-        reply = extract_json_from_response(reply)
-        result = json.loads(reply)
+        result = extract_json(reply, MIMIC_CONDITION)
         mimic_condition = result.get("mimic_condition", "No Suitable Group")
         icd9_codes = result.get("icd9_codes", [])
         return mimic_condition, icd9_codes
@@ -133,20 +125,18 @@ Respond strictly in JSON format as follows:
 """
     logger.info(f"Asking AI for category for: {text2dt_condition}")
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = llm_gateway.chat_completion(
+            "offline",
+            route="mapping_classify",
             messages=[
                 {"role": "system", "content": "You are a medical classification assistant."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=60,
         )
         reply = response["choices"][0]["message"]["content"].strip()
         logger.info(f"AI response for category of '{text2dt_condition}': {reply}")
-        reply = clean_json_response(reply)
-        reply = extract_json_from_response(reply)
-        result = json.loads(reply)
+        result = extract_json(reply, CATEGORY)
         category = result.get("category", "other").lower()
         # Validate category against available options:
         if category not in available_categories:
@@ -160,28 +150,26 @@ def process_text2dt_record(record):
     """
     Process a single Text2DT record: extract the condition (substring before '@'),
     build the decision tree profile, ask for the best Mimic-III condition and assign a category.
-    Additionally, translate each profile question to English and store them in 'english_profile'.
+    Additionally, translate each profile question to English and store them in 'english_profile',
+    with the structured trees (C and D nodes) in 'decision_tree' / 'english_decision_tree'.
     """
     text = record.get("text", "")
     logger.info(f"Processing Text2DT record with text (first 30 chars): {text[:30]}...")
     condition_name = text.split("@")[0].strip() if "@" in text else text.strip()
     logger.info(f"Extracted condition name: {condition_name}")
     
-    # Build profile from the decision tree (only include nodes with role "C")
-    profile = []
+    # Compile the decision tree once: C nodes become questions, D nodes treatment sets.
     tree = record.get("tree", [])
     if not tree:
         logger.info(f"No decision tree found for condition '{condition_name}'.")
-    for node in tree:
-        if node.get("role") == "C":
-            for triple in node.get("triples", []):
-                subject, relation, obj = triple
-                question = f"Does the patient have {obj} ({relation})?"
-                profile.append(question)
+    nodes = compile_tree(tree)
+    profile = [node.text for node in nodes if isinstance(node, Question)]
     logger.info(f"Built profile for condition '{condition_name}': {profile}")
     
-    # Create english_profile by translating each profile question
-    english_profile = [translate_to_english(question) for question in profile]
+    # Translate the raw tree term by term, so its C-node grouping is kept, and store it alongside english_profile
+    english_tree = translate_tree(tree)
+    english_nodes = compile_tree(english_tree)
+    english_profile = [node.text for node in english_nodes if isinstance(node, Question)]
     logger.info(f"Built english_profile for condition '{condition_name}': {english_profile}")
     
     # Ask the AI for the best matching Mimic-III condition
@@ -200,7 +188,9 @@ def process_text2dt_record(record):
         },
         "category": category,
         "profile": profile,
-        "english_profile": english_profile
+        "english_profile": english_profile,
+        "decision_tree": tree,
+        "english_decision_tree": english_tree
     }
 
 def process_all_text2dt_records():
@@ -1,12 +1,16 @@
 import json
 import os
-import openai
 import logging
 import random
 import time
 from difflib import get_close_matches, SequenceMatcher
 from google.cloud import bigquery
 
+from patient_history.structured_output import CLUSTERS, extract_json
+from patient_history import llm_gateway
+from history.profiles import Question, compile_tree
+from history.serialization import serialize_table
+
 # Configuration file names and paths
 MIMIC_MAPPING_FILE = "mimic_mapping.json"         # Generated mimic mapping file: representative group -> list of ICD-9 codes
 TEXT2DT_FILE = "Text2DT_train.json"                 # Your Text2DT training file
@@ -22,26 +26,6 @@ BATCH_SIZE = 50  # Adjust batch size if needed
 SIMILARITY_THRESHOLD = 0.8  
 
 # --- Helper functions ---
-def clean_json_response(response_text):
-    """Remove markdown formatting (e.g. ```json ... ```) from the ChatGPT response."""
-    response_text = response_text.strip()
-    if response_text.startswith("```"):
-        lines = response_text.splitlines()
-        if lines[0].strip().startswith("```"):
-            lines = lines[1:]
-        if lines and lines[-1].strip().endswith("```"):
-            lines = lines[:-1]
-        response_text = "\n".join(lines).strip()
-    return response_text
-
-def extract_json_from_response(response_text):
-    """Extract a JSON object string from the response by locating the first '{' and the last '}'."""
-    start = response_text.find("{")
-    end = response_text.rfind("}")
-    if start != -1 and end != -1 and end > start:
-        return response_text[start:end+1]
-    return response_text
-
 def similarity(a, b):
     """Compute the similarity ratio between two strings."""
     return SequenceMatcher(None, a, b).ratio()
@@ -51,14 +35,14 @@ def translate_to_english(chinese_text):
     prompt = f"Translate the following Chinese medical condition into English: '{chinese_text}'"
     logger.info(f"Translating to English: {chinese_text}")
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = llm_gateway.chat_completion(
+            "offline",
+            route="mapping_translate",
             messages=[
                 {"role": "system", "content": "You are a medical translation assistant."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=60,
         )
         translation = response["choices"][0]["message"]["content"].strip()
         logger.info(f"Translation result: {translation}")
@@ -96,7 +80,7 @@ def group_conditions_with_ai(conditions, mapping, retry_count=3):
     
     prompt = f"""
 You are a medical coding assistant. I have the following list of ICD-9 codes with their descriptions:
-{json.dumps(conditions, ensure_ascii=False, indent=2)}
+{serialize_table("conditions", conditions)}
 
 Please group these codes into clusters where each cluster contains codes that represent the same clinical condition.
 Return a JSON object in the following format:
@@ -116,20 +100,18 @@ Only include clusters that have at least two codes. Do not include unique codes.
     clusters = []
     for attempt in range(retry_count):
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
+            response = llm_gateway.chat_completion(
+                "offline",
+                route="mapping_group",
                 messages=[
                     {"role": "system", "content": "You are a medical coding assistant."},
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.3,
-                max_tokens=600,
             )
             reply = response["choices"][0]["message"]["content"].strip()
             logger.info(f"ChatGPT grouping response (attempt {attempt+1}): {reply}")
-            reply = clean_json_response(reply)
-            reply = extract_json_from_response(reply)
-            result = json.loads(reply)
+            result = extract_json(reply, CLUSTERS)
             clusters = result.get("clusters", [])
             if clusters:
                 logger.info("Valid clusters obtained from ChatGPT.")
@@ -210,14 +192,14 @@ Which group best matches this condition?
 """
     logger.info(f"Sending matching prompt to ChatGPT for condition: {condition}")
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = llm_gateway.chat_completion(
+            "offline",
+            route="mapping_classify",
             messages=[
                 {"role": "system", "content": "You are a medical coding assistant."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=60,
         )
         answer = response["choices"][0]["message"]["content"].strip()
         logger.info(f"ChatGPT matching response for condition '{condition}': {answer}")
@@ -293,16 +275,11 @@ def process_text2dt_record(record, mapping):
             logger.info(f"No fuzzy match above threshold for condition '{condition_name}' (best ratio {best_ratio}); using AI matching.")
             assigned_group = get_matching_group(condition_name, mapping)
     
-    profile = []
     tree = record.get("tree", [])
     if not tree:
         logger.info(f"No decision tree found for condition '{condition_name}'.")
-    for node in tree:
-        if node.get("role") == "C":
-            for triple in node.get("triples", []):
-                subject, relation, obj = triple
-                question = f"Does the patient have {obj} ({relation})?"
-                profile.append(question)
+    nodes = compile_tree(tree)
+    profile = [node.text for node in nodes if isinstance(node, Question)]
     logger.info(f"Built profile for condition '{condition_name}': {profile}")
     
     mimic_details = {
@@ -314,7 +291,8 @@ def process_text2dt_record(record, mapping):
     return {
         "text2dt_condition": condition_name,
         "mapped_mimic_group": mimic_details,
-        "profile": profile
+        "profile": profile,
+        "decision_tree": tree
     }
 
 def process_all_text2dt_records(mapping):
@@ -0,0 +1,60 @@
+"""
+Helpers for the async views.
+
+Under ASGI a plain (sync) Django view runs on a single shared thread, so one
+slow BigQuery query or LLM call holds up every other sync request in the
+worker. The LLM-heavy views are therefore `async def` views that await
+llm_gateway.achat_completion. Blocking work that has no async client (BigQuery,
+file I/O, the spool) goes through `run_blocking`, which runs it on a dedicated
+thread pool (BLOCKING_IO_THREADS, default 64) so the event loop stays free.
+`executor_view` turns a sync view whose only I/O is blocking into such an async
+view without rewriting it. `run_in_background` starts work on the same pool
+that the response should not wait for.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+BLOCKING_IO_THREADS = int(os.getenv("BLOCKING_IO_THREADS", 64))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_IO_THREADS, thread_name_prefix="blocking-io")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """
+    Await fn(*args, **kwargs) run on the blocking-I/O thread pool.
+    """
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_executor, call)
+
+
+def executor_view(view):
+    """
+    Wrap a sync view as an async view that runs it on the blocking-I/O pool.
+    Attributes such as csrf_exempt are preserved.
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        return await run_blocking(view, request, *args, **kwargs)
+    return wrapper
+
+
+def run_in_background(fn, *args, **kwargs):
+    """
+    Start fn(*args, **kwargs) on the blocking-I/O pool without waiting for it and
+    return its Future; failures are logged. Unlike an asyncio task it is not tied to
+    the request's event loop, so it also completes under WSGI.
+    """
+    future = _executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Background task failed: %r", future.exception())
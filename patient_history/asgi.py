@@ -13,4 +13,26 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'patient_history.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# The realtime consultation WebSocket is served by a plain ASGI app next to Django.
+from realtime_endpoints.consumers import CONSULTATION_PATH, consultation  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope["type"] != "websocket":
+        return await django_application(scope, receive, send)
+    if scope["path"].rstrip("/") == CONSULTATION_PATH.rstrip("/"):
+        return await consultation(scope, receive, send)
+    # Closing before accepting rejects the handshake (HTTP 403).
+    await receive()
+    await send({"type": "websocket.close", "code": 1008})
+
+# Optionally import the OpenAI/BigQuery/Supabase SDKs in the background once the
+# app is loaded (SERVICES_WARM_UP=1); nothing is imported eagerly otherwise.
+from marking_scheme_endpoints import persistence  # noqa: E402
+from patient_history import services  # noqa: E402
+
+services.warm_up_in_background_if_enabled()
+# Marks spooled before a restart are delivered without waiting for the next submission.
+persistence.resume_pending(services.get_supabase)
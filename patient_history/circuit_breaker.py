@@ -0,0 +1,220 @@
+"""
+Per-dependency circuit breakers for OpenAI and BigQuery.
+
+Each breaker watches the outcomes of the last `window` seconds of calls. A call
+counts as failed when it raises a dependency error (timeouts, connection
+errors, 5xx, 429; not 4xx caused by our own request) or when it succeeds but
+takes longer than `slow_call_seconds`. Once at least `min_calls` were seen and
+the failure rate reaches `failure_rate`, the breaker opens: calls fail
+immediately with CircuitOpenError for `open_seconds`, so workers stop queuing
+behind a dependency that is browning out. After that it is half-open: up to
+`half_open_probes` trial calls go through; a success closes the breaker, a
+failure opens it again.
+
+Views catch DependencyUnavailableError (an open breaker, or the LLM gateway
+rejecting a call) and either serve their degraded response or return
+`unavailable_response(error)`, a 503 with Retry-After.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# Per-dependency settings; anything not listed uses CircuitBreaker's defaults.
+SETTINGS = {
+    "openai": {"slow_call_seconds": 30.0, "open_seconds": 30.0},
+    "bigquery": {"slow_call_seconds": 15.0, "open_seconds": 30.0},
+}
+
+# Client-side timeouts, so a hung dependency cannot hold a worker indefinitely.
+BIGQUERY_TIMEOUT = float(os.getenv("BIGQUERY_TIMEOUT", 30))
+
+_UPSTREAM_PACKAGES = ("openai", "google", "requests", "urllib3", "aiohttp", "grpc")
+
+
+class DependencyUnavailableError(RuntimeError):
+    """A dependency call was refused locally; `retry_after` is a hint in seconds."""
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(DependencyUnavailableError):
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is unavailable (circuit open, retry in {retry_after:.0f}s)", retry_after)
+        self.name = name
+
+
+def is_upstream_error(error):
+    """
+    True for errors raised by a dependency's client library or the network, as
+    opposed to bugs in our own code.
+    """
+    if isinstance(error, (DependencyUnavailableError, TimeoutError, ConnectionError)):
+        return True
+    return type(error).__module__.split(".")[0] in _UPSTREAM_PACKAGES
+
+
+def counts_as_failure(error):
+    """
+    Whether `error` says something about the dependency's health. Rejections of our
+    own request (400/401/403/404) do not; timeouts, 429 and 5xx do.
+    """
+    status = getattr(error, "http_status", None) or getattr(error, "code", None)
+    if isinstance(status, int) and 400 <= status < 500 and status not in (408, 429):
+        return False
+    return is_upstream_error(error)
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_rate=0.5, min_calls=5, window=60.0,
+                 slow_call_seconds=30.0, open_seconds=30.0, half_open_probes=1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._outcomes = deque()   # (timestamp, failed)
+        self._stats = {"calls": 0, "failures": 0, "slow": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes = 0
+            logger.info("Circuit %s half-open: probing.", self.name)
+        return self._state
+
+    def available(self):
+        """
+        Whether a call would currently be let through (without reserving a probe).
+        """
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            return state == CLOSED or (state == HALF_OPEN and self._probes < self.half_open_probes)
+
+    def before(self):
+        """
+        Admit a call or raise CircuitOpenError. Every admitted call must be followed by
+        record() or cancel().
+        """
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and self._probes < self.half_open_probes:
+                self._probes += 1
+                return
+            self._stats["rejected"] += 1
+            retry_after = max(1.0, self.open_seconds - (now - self._opened_at)) if state == OPEN else 1.0
+        raise CircuitOpenError(self.name, retry_after)
+
+    def cancel(self):
+        """
+        Give back an admission that never reached the dependency.
+        """
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def record(self, duration, error=None):
+        failed_call = error is not None and counts_as_failure(error)
+        slow = error is None and duration > self.slow_call_seconds
+        failed = failed_call or slow
+        with self._lock:
+            now = time.monotonic()
+            self._stats["calls"] += 1
+            self._stats["failures"] += failed_call
+            self._stats["slow"] += slow
+            state = self._current_state(now)
+            if state == HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if failed:
+                    self._open(now, "probe failed")
+                elif error is None:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                    logger.info("Circuit %s closed: probe succeeded.", self.name)
+                return
+            if state == OPEN:
+                return
+            self._outcomes.append((now, failed))
+            while self._outcomes and now - self._outcomes[0][0] > self.window:
+                self._outcomes.popleft()
+            total = len(self._outcomes)
+            failures = sum(1 for _, outcome in self._outcomes if outcome)
+            if total >= self.min_calls and failures / total >= self.failure_rate:
+                self._open(now, f"{failures}/{total} failed or slow calls in {self.window:.0f}s")
+
+    def _open(self, now, reason):
+        self._state = OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self._stats["opened"] += 1
+        logger.warning("Circuit %s opened for %.0fs: %s.", self.name, self.open_seconds, reason)
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) through the breaker.
+        """
+        self.before()
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.record(time.monotonic() - start, e)
+            raise
+        self.record(time.monotonic() - start)
+        return result
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._stats, state=self._current_state(time.monotonic()))
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get(name):
+    """
+    The process-wide breaker for dependency `name`, created on first use.
+    """
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **SETTINGS.get(name, {}))
+        return _breakers[name]
+
+
+def metrics():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.metrics() for breaker in breakers}
+
+
+def unavailable_response(error):
+    """
+    The 503 JsonResponse for a DependencyUnavailableError, with a Retry-After hint.
+    """
+    from django.http import JsonResponse
+
+    response = JsonResponse({"error": "The service is busy, please try again shortly.", "retry_after": round(error.retry_after, 1)}, status=503)
+    response["Retry-After"] = str(max(1, round(error.retry_after)))
+    return response
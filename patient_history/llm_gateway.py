@@ -0,0 +1,775 @@
+"""
+Admission control for every OpenAI chat completion made by the project.
+
+Call sites no longer call `openai.ChatCompletion.create` directly but
+`llm_gateway.chat_completion(priority, **kwargs)`. The gateway:
+  * keeps a requests-per-minute and a tokens-per-minute token bucket (the token
+    cost is estimated from the messages plus max_tokens up front and corrected
+    with the reported usage afterwards),
+  * caps the number of calls in flight,
+  * admits waiting calls strictly by priority class (PRIORITIES), FIFO within
+    a class, so interactive chat never queues behind background marking,
+  * bounds both the queue length and each class's queue wait; a call that
+    cannot be admitted in time fails fast with LLMBusyError instead of piling
+    up retries,
+  * empties the buckets when OpenAI answers 429, so every caller backs off
+    together,
+  * counts queue depth, waits, admissions and rejections for `metrics()`.
+Calls also go through the "openai" circuit breaker (patient_history/
+circuit_breaker.py), checked before queueing, and get a per-class
+`request_timeout` unless the caller sets one. `achat_completion` is the async
+variant used by the async views: it waits in the same queue on an asyncio.Event
+that the gateway sets when the ticket may have become admissible (a slot or the
+head of the queue freed up), instead of blocking the event loop, and calls
+ChatCompletion.acreate (aiohttp).
+
+A `route` keyword names the call site's entry in patient_history/
+model_routing.py, which supplies the model and token limit and receives the
+call's observed latency, failed calls included. Async calls on hedged routes
+(realtime_chat, ask_question) race a backup request against one that has not
+answered, or sent its first chunk, within the route's hedge delay. The first response wins and
+the other request is cancelled, which releases its slot. Backups are admitted
+like any other call. They are capped at LLM_MAX_HEDGES in flight, and at
+LLM_HEDGE_RATIO of hedged calls plus HEDGE_BURST. `metrics()` reports how often
+hedges fired and won, and an estimate of the seconds they saved.
+
+Limits come from the environment (LLM_RPM, LLM_TPM, LLM_MAX_CONCURRENCY,
+LLM_MAX_QUEUE). With LLM_GATEWAY_STATE_DIR set, the two buckets live in files
+under that directory, guarded by fcntl locks, so all workers and offline scripts
+on the node share one rate budget. Priority ordering and the concurrency cap
+are always per process. Bucket reservations and refunds are never made while
+holding the queue's lock, and async callers make the file-backed ones on the
+blocking-I/O pool (patient_history/aio.py).
+"""
+import asyncio
+import functools
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: node-wide buckets unavailable
+    fcntl = None
+
+from . import circuit_breaker, model_routing
+from .aio import run_blocking, run_in_background
+from .circuit_breaker import DependencyUnavailableError
+from .services import openai
+
+logger = logging.getLogger(__name__)
+
+# Lower rank is admitted first.
+PRIORITIES = {
+    "realtime": 0,       # simulated patient replies during a station
+    "ask_question": 1,
+    "marking": 2,
+    "generation": 3,     # case histories and question sets
+    "offline": 4,        # mapping / verification scripts
+}
+
+# Longest a call of each class may queue before it is rejected (seconds).
+MAX_QUEUE_WAIT = {
+    "realtime": 2.0,
+    "ask_question": 5.0,
+    "marking": 30.0,
+    "generation": 20.0,
+    "offline": 600.0,
+}
+
+# Client-side timeout per class (seconds), passed to ChatCompletion.create as request_timeout.
+REQUEST_TIMEOUT = {
+    "realtime": 15.0,
+    "ask_question": 20.0,
+    "marking": 45.0,
+    "generation": 60.0,
+    "offline": 120.0,
+}
+
+DEFAULT_MAX_TOKENS = 256
+RATE_LIMIT_BACKOFF = 2.0   # seconds of budget removed from both buckets after a 429
+HEDGE_BURST = 5            # hedges allowed on top of LLM_HEDGE_RATIO
+
+
+class LLMBusyError(DependencyUnavailableError):
+    """The call could not be admitted within its priority class's queue wait."""
+
+    def __init__(self, priority, reason, retry_after=1.0):
+        super().__init__(f"LLM capacity exhausted for {priority} call: {reason}", retry_after)
+        self.priority = priority
+
+
+def _env_number(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return float(default)
+
+
+def estimate_tokens(kwargs):
+    """
+    Rough token cost of a chat completion: ~4 characters per prompt token plus
+    per-message overhead, plus the completion allowance.
+    """
+    prompt = sum(len(str(message.get("content") or "")) // 4 + 4 for message in kwargs.get("messages") or [])
+    return prompt + int(kwargs.get("max_tokens") or DEFAULT_MAX_TOKENS)
+
+
+class TokenBucket:
+    """
+    `per_minute` units refilled continuously, holding at most one minute's worth.
+    With `state_path` the level is kept in a JSON file shared between processes.
+    """
+
+    def __init__(self, name, per_minute, state_path=None):
+        self.name = name
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._level = self.capacity
+        self._updated = time.monotonic()
+
+    def _now(self):
+        # File-backed buckets are shared across processes, so they need wall-clock time.
+        return time.time() if self.state_path else time.monotonic()
+
+    def _update(self, change):
+        """
+        Apply `change(level) -> (new_level, result)` to the refilled level atomically.
+        """
+        with self._lock:
+            if not self.state_path:
+                now = self._now()
+                level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+                self._level, result = change(level)
+                self._updated = now
+                return result
+            with open(self.state_path, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or "{}")
+                    except ValueError:
+                        state = {}
+                    now = self._now()
+                    level = float(state.get("level", self.capacity))
+                    level = min(self.capacity, level + (now - float(state.get("updated", now))) * self.rate)
+                    level, result = change(level)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps({"level": level, "updated": now}))
+                    f.flush()
+                    return result
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reserve(self, amount):
+        """
+        Take `amount` units and return 0, or take nothing and return the seconds until
+        they will be available. Requests larger than the capacity are clamped to it.
+        """
+        amount = min(float(amount), self.capacity)
+
+        def change(level):
+            if level >= amount:
+                return level - amount, 0.0
+            return level, (amount - level) / self.rate
+        return self._update(change)
+
+    def refund(self, amount):
+        """
+        Return unused units (or, with a negative amount, charge units used beyond the estimate).
+        """
+        self._update(lambda level: (min(self.capacity, level + amount), None))
+
+    def drain(self, seconds):
+        """
+        Remove `seconds` worth of refill so that every caller backs off.
+        """
+        self._update(lambda level: (min(level, 0.0) - seconds * self.rate, None))
+
+    @property
+    def level(self):
+        return self._update(lambda level: (level, level))
+
+
+class HedgeBudget:
+    """
+    Caps backup requests: at most `ratio` of hedged calls (plus HEDGE_BURST) and
+    `max_in_flight` at once. Counts outcomes per route.
+    """
+
+    def __init__(self, ratio, max_in_flight):
+        self.ratio = ratio
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._stats = {}
+
+    def _route(self, route):
+        return self._stats.setdefault(route, {
+            "calls": 0, "fired": 0, "backup_wins": 0, "primary_wins": 0,
+            "skipped": 0, "saved_seconds": 0.0,
+        })
+
+    def call(self, route):
+        with self._lock:
+            self._route(route)["calls"] += 1
+
+    def start(self, route):
+        """
+        Reserve a backup request for `route`; False when the budget is spent.
+        """
+        with self._lock:
+            stats = self._route(route)
+            fired = sum(route_stats["fired"] for route_stats in self._stats.values())
+            calls = sum(route_stats["calls"] for route_stats in self._stats.values())
+            if self._in_flight >= self.max_in_flight or fired >= self.ratio * calls + HEDGE_BURST:
+                stats["skipped"] += 1
+                return False
+            self._in_flight += 1
+            stats["fired"] += 1
+            return True
+
+    def finish(self, route, backup_won=None, saved=0.0):
+        with self._lock:
+            self._in_flight -= 1
+            stats = self._route(route)
+            if backup_won is not None:
+                stats["backup_wins" if backup_won else "primary_wins"] += 1
+            stats["saved_seconds"] += saved
+
+    def metrics(self):
+        with self._lock:
+            routes = {}
+            for route, stats in self._stats.items():
+                routes[route] = dict(
+                    stats,
+                    saved_seconds=round(stats["saved_seconds"], 2),
+                    hedge_rate=round(stats["fired"] / stats["calls"], 3) if stats["calls"] else 0.0,
+                )
+            return {"in_flight": self._in_flight, "max_in_flight": self.max_in_flight, "ratio": self.ratio, "routes": routes}
+
+
+class _Ticket:
+    def __init__(self, priority, rank, seq, tokens, wake=None):
+        self.priority = priority
+        self.order = (rank, seq)
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+        self.wake = wake       # called (under the gateway's lock) when an async waiter should re-check
+        self.seen = 0          # the gateway's change count at the ticket's last admission attempt
+        self.admitted = False
+
+    def __lt__(self, other):
+        return self.order < other.order
+
+
+class Gateway:
+    def __init__(self, rpm=None, tpm=None, max_concurrency=None, max_queue=None, state_dir=None):
+        state_dir = state_dir if state_dir is not None else os.getenv("LLM_GATEWAY_STATE_DIR")
+        if state_dir and fcntl is None:
+            logger.warning("LLM_GATEWAY_STATE_DIR ignored: file locking is unavailable on this platform.")
+            state_dir = None
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        self.requests = TokenBucket(
+            "requests", rpm or _env_number("LLM_RPM", 500),
+            os.path.join(state_dir, "llm-requests.json") if state_dir else None,
+        )
+        self.tokens = TokenBucket(
+            "tokens", tpm or _env_number("LLM_TPM", 90000),
+            os.path.join(state_dir, "llm-tokens.json") if state_dir else None,
+        )
+        self.max_concurrency = int(max_concurrency or _env_number("LLM_MAX_CONCURRENCY", 128))
+        self.max_queue = int(max_queue or _env_number("LLM_MAX_QUEUE", 512))
+        self.hedges = HedgeBudget(_env_number("LLM_HEDGE_RATIO", 0.1), int(_env_number("LLM_MAX_HEDGES", 8)))
+        self.shared = bool(state_dir)   # the buckets are files: reservations do blocking I/O
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._reserving = None   # the ticket reserving bucket budget outside the lock
+        self._changes = 0
+        self._stats = {
+            name: {"admitted": 0, "rejected": 0, "rate_limited": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for name in PRIORITIES
+        }
+
+    def _enqueue(self, priority, tokens, wake=None):
+        if priority not in PRIORITIES:
+            raise ValueError(f"unknown LLM priority class '{priority}'")
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                self._stats[priority]["rejected"] += 1
+                raise LLMBusyError(priority, f"queue full ({len(self._waiting)} waiting)")
+            ticket = _Ticket(priority, PRIORITIES[priority], next(self._seq), tokens, wake)
+            heapq.heappush(self._waiting, ticket)
+        return ticket, ticket.enqueued + MAX_QUEUE_WAIT[priority]
+
+    def _notify(self):
+        """
+        Wake waiters after a change that may make a ticket admissible: blocked threads
+        re-check, and so does the head of the queue if it is a coroutine (only the head
+        can be admitted). Called with the condition held.
+        """
+        self._changes += 1
+        self._cond.notify_all()
+        if self._waiting and self._waiting[0].wake is not None:
+            self._waiting[0].wake()
+
+    def _try_admit(self, ticket, deadline):
+        """
+        One admission attempt for `ticket`: None when it was admitted, else how long to
+        wait before trying again. Raises LLMBusyError (and dequeues the ticket) when it
+        cannot be admitted before `deadline`. Called without the condition held: the
+        bucket reservation, which is file I/O for node-wide buckets, runs outside it,
+        and `_reserving` keeps other tickets from being admitted in the meantime.
+        """
+        with self._cond:
+            ticket.seen = self._changes
+            remaining = deadline - time.monotonic()
+            at_head = self._waiting and self._waiting[0] is ticket
+            if not at_head or self._reserving is not None or self._in_flight >= self.max_concurrency:
+                if remaining <= 0:
+                    self._dequeue(ticket, rejected=True)
+                    raise LLMBusyError(ticket.priority, f"waited {MAX_QUEUE_WAIT[ticket.priority]:.0f}s in queue")
+                return remaining
+            self._reserving = ticket
+        wait = None
+        try:
+            wait = self._reserve(ticket.tokens)
+        finally:
+            with self._cond:
+                self._reserving = None
+                ticket.seen = self._changes
+                if wait == 0 and ticket not in self._waiting:
+                    # Abandoned (cancelled) while reserving: give the budget back.
+                    wait = None
+                    self._refund_reservation(ticket.tokens)
+                elif wait == 0:
+                    if self._waiting[0] is ticket:
+                        heapq.heappop(self._waiting)
+                    else:   # a higher class arrived while it was reserving
+                        self._waiting.remove(ticket)
+                        heapq.heapify(self._waiting)
+                    self._in_flight += 1
+                    ticket.admitted = True
+                    waited = time.monotonic() - ticket.enqueued
+                    stats = self._stats[ticket.priority]
+                    stats["admitted"] += 1
+                    stats["wait_total"] += waited
+                    stats["wait_max"] = max(stats["wait_max"], waited)
+                # Whatever happened, the next ticket may be admissible now.
+                self._notify()
+        if wait == 0:
+            return None
+        remaining = deadline - time.monotonic()
+        if wait is None or wait > remaining:
+            # The buckets cannot refill in time: fail now instead of at the deadline.
+            with self._cond:
+                self._dequeue(ticket, rejected=True)
+            raise LLMBusyError(ticket.priority, "rate limit budget exhausted", retry_after=wait or 1.0)
+        return wait
+
+    def _dequeue(self, ticket, rejected=False):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            if rejected:
+                self._stats[ticket.priority]["rejected"] += 1
+            self._notify()
+
+    def acquire(self, priority, tokens):
+        """
+        Block until a call of `priority` costing `tokens` may start, or raise LLMBusyError.
+        """
+        ticket, deadline = self._enqueue(priority, tokens)
+        try:
+            while True:
+                wait = self._try_admit(ticket, deadline)
+                if wait is None:
+                    return ticket
+                with self._cond:
+                    if self._changes == ticket.seen:
+                        self._cond.wait(timeout=wait)
+        except BaseException:
+            with self._cond:
+                self._dequeue(ticket)
+            raise
+
+    async def aacquire(self, priority, tokens):
+        """
+        acquire() for coroutines: sleeps on an asyncio.Event, set by the gateway when
+        the ticket may have become admissible, instead of blocking the event loop.
+        Node-wide (file-backed) reservations run on the blocking-I/O pool.
+        """
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:   # the loop has closed
+                pass
+
+        ticket, deadline = self._enqueue(priority, tokens, wake)
+        try:
+            while True:
+                # Cleared before the attempt, so a wake-up during it is not lost.
+                ready.clear()
+                if self.shared:
+                    wait = await run_blocking(self._try_admit, ticket, deadline)
+                else:
+                    wait = self._try_admit(ticket, deadline)
+                if wait is None:
+                    return ticket
+                try:
+                    await asyncio.wait_for(ready.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # Rejected, or the request was cancelled (client went away) while queued.
+            with self._cond:
+                self._dequeue(ticket)
+            if ticket.admitted:
+                # Admitted on the pool just as the caller was cancelled.
+                self.arelease(ticket, used_tokens=0)
+            raise
+
+    def _reserve(self, tokens):
+        wait = self.requests.reserve(1)
+        if wait:
+            return wait
+        wait = self.tokens.reserve(tokens)
+        if wait:
+            self.requests.refund(1)
+        return wait
+
+    def _refund_reservation(self, tokens):
+        self.requests.refund(1)
+        self.tokens.refund(tokens)
+
+    def _settle(self, ticket, used_tokens=None, error=None):
+        """
+        Correct the buckets after a call: refund the unused token estimate, and drain
+        both buckets after a 429 so every caller backs off.
+        """
+        if used_tokens is not None:
+            self.tokens.refund(ticket.tokens - used_tokens)
+        if error is not None and _is_rate_limit(error):
+            logger.warning("OpenAI rate limit hit by %s call; backing off all callers.", ticket.priority)
+            self.requests.drain(RATE_LIMIT_BACKOFF)
+            self.tokens.drain(RATE_LIMIT_BACKOFF)
+
+    def _free_slot(self, ticket, error=None):
+        with self._cond:
+            self._in_flight -= 1
+            if error is not None and _is_rate_limit(error):
+                self._stats[ticket.priority]["rate_limited"] += 1
+            self._notify()
+
+    def release(self, ticket, used_tokens=None, error=None):
+        self._settle(ticket, used_tokens, error)
+        self._free_slot(ticket, error)
+
+    def arelease(self, ticket, used_tokens=None, error=None):
+        """
+        release() from the event loop: the slot is freed at once, and node-wide bucket
+        corrections are made on the blocking-I/O pool.
+        """
+        if self.shared and (used_tokens is not None or error is not None):
+            run_in_background(self._settle, ticket, used_tokens, error)
+        else:
+            self._settle(ticket, used_tokens, error)
+        self._free_slot(ticket, error)
+
+    def create(self, priority, route=None, **kwargs):
+        """
+        openai.ChatCompletion.create(**kwargs) under admission control. Streaming
+        calls hold their slot until the stream is exhausted or closed.
+        """
+        if route:
+            kwargs = model_routing.apply(route, kwargs)
+        breaker = circuit_breaker.get("openai")
+        breaker.before()
+        try:
+            ticket = self.acquire(priority, estimate_tokens(kwargs))
+        except LLMBusyError:
+            breaker.cancel()
+            raise
+        kwargs.setdefault("request_timeout", REQUEST_TIMEOUT[priority])
+        start = time.monotonic()
+        try:
+            response = openai.ChatCompletion.create(**kwargs)
+        except Exception as e:
+            breaker.record(time.monotonic() - start, e)
+            _observe_failure(route, start, e)
+            self.release(ticket, error=e)
+            raise
+        if kwargs.get("stream"):
+            return self._stream(ticket, response, breaker, start, route)
+        breaker.record(time.monotonic() - start)
+        if route:
+            model_routing.observe(route, time.monotonic() - start)
+        self.release(ticket, used_tokens=_used_tokens(response))
+        return response
+
+    async def acreate(self, priority, route=None, **kwargs):
+        """
+        Async create(): queues without blocking the event loop and calls
+        openai.ChatCompletion.acreate (aiohttp) instead of the blocking client.
+        """
+        if route:
+            kwargs = model_routing.apply(route, kwargs)
+            if model_routing.hedged(route):
+                return await self._ahedged(priority, route, kwargs)
+        return await self._acreate_once(priority, route, kwargs)
+
+    async def _acreate_once(self, priority, route, kwargs):
+        breaker = circuit_breaker.get("openai")
+        breaker.before()
+        try:
+            ticket = await self.aacquire(priority, estimate_tokens(kwargs))
+        except BaseException:
+            breaker.cancel()
+            raise
+        kwargs.setdefault("request_timeout", REQUEST_TIMEOUT[priority])
+        start = time.monotonic()
+        try:
+            response = await openai.ChatCompletion.acreate(**kwargs)
+        except asyncio.CancelledError:
+            breaker.cancel()
+            self.arelease(ticket)
+            raise
+        except Exception as e:
+            breaker.record(time.monotonic() - start, e)
+            _observe_failure(route, start, e)
+            self.arelease(ticket, error=e)
+            raise
+        if kwargs.get("stream"):
+            return self._astream(ticket, response, breaker, start, route)
+        breaker.record(time.monotonic() - start)
+        if route:
+            model_routing.observe(route, time.monotonic() - start)
+        self.arelease(ticket, used_tokens=_used_tokens(response))
+        return response
+
+    async def _astream(self, ticket, chunks, breaker, start, route=None):
+        error = cancelled = None
+        try:
+            async for chunk in chunks:
+                if route:
+                    # Streams are held to their SLO by the time to the first chunk.
+                    model_routing.observe(route, time.monotonic() - start)
+                    route = None
+                yield chunk
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            error = e
+            # Failed before its first chunk: that counts against the route's SLO too.
+            _observe_failure(route, start, e)
+            raise
+        finally:
+            if cancelled:
+                breaker.cancel()
+            else:
+                breaker.record(time.monotonic() - start, error)
+            self.arelease(ticket, error=error)
+
+    async def _afirst(self, priority, route, kwargs):
+        """
+        One attempt of a hedged call: the response, or for a stream (stream,
+        first chunk) once the first chunk has arrived.
+        """
+        response = await self._acreate_once(priority, route, kwargs)
+        if not kwargs.get("stream"):
+            return response
+        try:
+            return response, await response.__anext__()
+        except StopAsyncIteration:
+            return response, None
+
+    async def _ahedged(self, priority, route, kwargs):
+        """
+        acreate() with a backup request once the first has been silent for the
+        route's hedge delay; the first attempt to succeed wins.
+        """
+        self.hedges.call(route)
+        delay = model_routing.get(route).hedge_delay()
+        start = time.monotonic()
+        primary = asyncio.ensure_future(self._afirst(priority, route, kwargs))
+        attempts, backup, winner = [primary], None, None
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if not done and self.hedges.start(route):
+                logger.info("No reply on %s after %.2fs; sending a backup request.", route, delay)
+                backup = asyncio.ensure_future(self._afirst(priority, route, kwargs))
+                attempts.append(backup)
+            pending = {task for task in attempts if not task.done()}
+            while winner is None:
+                for task in attempts:
+                    if task.done() and not task.cancelled() and task.exception() is None:
+                        winner = task
+                        break
+                else:
+                    if not pending:
+                        # Every attempt failed: report the primary's error.
+                        return primary.result()
+                    _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in attempts:
+                if task is not winner:
+                    task.cancel()
+            # Losers that already produced a stream must close it to free their slot.
+            await asyncio.gather(*(self._discard(task) for task in attempts if task is not winner))
+            if backup is not None:
+                elapsed = time.monotonic() - start
+                expected = model_routing.get(route).tail_mean(elapsed) if winner is backup else None
+                self.hedges.finish(
+                    route,
+                    backup_won=None if winner is None else winner is backup,
+                    saved=max(0.0, expected - elapsed) if expected else 0.0,
+                )
+        if not kwargs.get("stream"):
+            return winner.result()
+        stream, first = winner.result()
+        return self._aprepend(first, stream)
+
+    @staticmethod
+    async def _discard(task):
+        try:
+            result = await task
+        except BaseException:
+            return
+        if isinstance(result, tuple):
+            await result[0].aclose()
+
+    @staticmethod
+    async def _aprepend(first, stream):
+        try:
+            if first is not None:
+                yield first
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    def _stream(self, ticket, chunks, breaker, start, route=None):
+        error = None
+        try:
+            for chunk in chunks:
+                if route:
+                    model_routing.observe(route, time.monotonic() - start)
+                    route = None
+                yield chunk
+        except Exception as e:
+            error = e
+            _observe_failure(route, start, e)
+            raise
+        finally:
+            breaker.record(time.monotonic() - start, error)
+            self.release(ticket, error=error)
+
+    def metrics(self):
+        with self._cond:
+            depth = {name: 0 for name in PRIORITIES}
+            for ticket in self._waiting:
+                depth[ticket.priority] += 1
+            classes = {}
+            for name, stats in self._stats.items():
+                admitted = stats["admitted"]
+                classes[name] = {
+                    "queued": depth[name],
+                    "admitted": admitted,
+                    "rejected": stats["rejected"],
+                    "rate_limited": stats["rate_limited"],
+                    "avg_wait_ms": round(stats["wait_total"] / admitted * 1000, 1) if admitted else 0.0,
+                    "max_wait_ms": round(stats["wait_max"] * 1000, 1),
+                }
+            snapshot = {
+                "in_flight": self._in_flight,
+                "max_concurrency": self.max_concurrency,
+                "queue_depth": len(self._waiting),
+                "max_queue": self.max_queue,
+                "classes": classes,
+            }
+        snapshot["hedging"] = self.hedges.metrics()
+        snapshot["requests_available"] = round(self.requests.level, 1)
+        snapshot["tokens_available"] = round(self.tokens.level)
+        return snapshot
+
+
+def _observe_failure(route, start, error):
+    """
+    Report a failed call on `route` to model routing, unless the failure was our own
+    request's fault (see circuit_breaker.counts_as_failure).
+    """
+    if route and circuit_breaker.counts_as_failure(error):
+        model_routing.observe(route, time.monotonic() - start, failed=True)
+
+
+def _used_tokens(response):
+    try:
+        return int(response["usage"]["total_tokens"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _is_rate_limit(error):
+    return type(error).__name__ == "RateLimitError" or getattr(error, "http_status", None) == 429
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = Gateway()
+    return _gateway
+
+
+def chat_completion(priority, **kwargs):
+    """
+    Drop-in for openai.ChatCompletion.create(**kwargs), admitted as `priority`.
+    """
+    return get_gateway().create(priority, **kwargs)
+
+
+async def achat_completion(priority, **kwargs):
+    """
+    Async drop-in for openai.ChatCompletion.acreate(**kwargs), admitted as `priority`.
+    """
+    return await get_gateway().acreate(priority, **kwargs)
+
+
+def creator(priority):
+    """
+    A ChatCompletion.create-compatible callable for `priority`, e.g. for
+    structured_output.reask_via.
+    """
+    return functools.partial(chat_completion, priority)
+
+
+def acreator(priority):
+    """
+    The async counterpart of creator(), e.g. for structured_output.areask_via.
+    """
+    return functools.partial(achat_completion, priority)
+
+
+def metrics():
+    return get_gateway().metrics()
+
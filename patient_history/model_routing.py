@@ -0,0 +1,340 @@
+"""
+Per-call-site model routing with latency SLOs.
+
+Call sites name a route instead of hardcoding a model:
+`llm_gateway.achat_completion("realtime", route="realtime_chat", messages=...)`.
+The gateway asks `apply(route, kwargs)` for the route's model and token limit
+(the route's max_tokens is the default, and the cap for call sites that size
+their own allowance) and reports each call's latency back with
+`observe(route, seconds)`: the time to the first chunk for streamed calls, the
+whole call otherwise. Failed calls are reported with `failed=True` and count at
+their elapsed time or the route's SLO, whichever is longer, so a dependency that
+errors quickly still shows up as a breach.
+
+Each route has a tier (TIERS, fastest first, each mapped to a model by
+TIER_MODELS), a max_tokens and an SLO in seconds for its p95 latency. Routes keep
+the last WINDOW latencies. With auto_downgrade on, a route whose p95 over at
+least MIN_SAMPLES calls reaches its SLO moves to the next faster tier that uses
+a different model; once its p95 is back under RECOVERY_RATIO of the SLO it moves
+back up one tier, never above its configured tier. A route changes tier at most
+once per COOLDOWN seconds. Routes on the fast tier (e.g. realtime_chat, ask_question)
+have no faster tier to move to, so they are never downgraded: a slow fast model
+is only mitigated by hedging, below.
+
+Routes with hedge on (the interactive ones) are hedged by the gateway: when a
+call has not answered, or sent its first chunk, within the route's hedge_delay()
+(its HEDGE_PERCENTILE latency, or its SLO until MIN_SAMPLES calls were seen), a
+backup request is raced against it. LLM_HEDGING=0 turns hedging off everywhere.
+
+The table is adjustable without code changes:
+  * LLM_MODEL_FAST / LLM_MODEL_STANDARD / LLM_MODEL_STRONG pick the tier models
+    (all default to gpt-3.5-turbo, the model every call site used before),
+  * LLM_ROUTES holds JSON overrides, e.g. {"ask_question": {"slo": 2.5}},
+  * LLM_ROUTES_FILE names a JSON file of overrides ({"tiers": {...}, "routes":
+    {...}}) that every worker re-reads when it changes, and which `configure`
+    (and the /llm-routes/ endpoint) writes, so a change reaches all workers.
+An override is validated as a whole before any of it is applied.
+Latencies and automatic downgrades are per process.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+TIERS = ["fast", "standard", "strong"]   # fastest first
+
+TIER_MODELS = {
+    "fast": os.getenv("LLM_MODEL_FAST", "gpt-3.5-turbo"),
+    "standard": os.getenv("LLM_MODEL_STANDARD", "gpt-3.5-turbo"),
+    "strong": os.getenv("LLM_MODEL_STRONG", "gpt-3.5-turbo"),
+}
+
+# Route -> tier, max_tokens, p95 latency SLO (seconds) and whether calls are hedged.
+ROUTES = {
+    "realtime_chat": {"tier": "fast", "max_tokens": 300, "slo": 2.5, "hedge": True},
+    "ask_question": {"tier": "fast", "max_tokens": 600, "slo": 4.0, "hedge": True},
+    "case_answers": {"tier": "standard", "max_tokens": 3000, "slo": 60.0},
+    "generate_history": {"tier": "standard", "max_tokens": 1500, "slo": 30.0},
+    "generate_questions": {"tier": "standard", "max_tokens": 500, "slo": 20.0},
+    "evaluate_history": {"tier": "strong", "max_tokens": 250, "slo": 20.0},
+    "assess_history_taking": {"tier": "strong", "max_tokens": 400, "slo": 20.0},
+    "generate_tree": {"tier": "standard", "max_tokens": 500, "slo": 30.0},
+    "mark_conversation": {"tier": "standard", "max_tokens": 300, "slo": 20.0},
+    "compare_answer": {"tier": "standard", "max_tokens": 300, "slo": 10.0},
+    "mapping_translate": {"tier": "fast", "max_tokens": 60, "slo": 10.0},
+    "mapping_classify": {"tier": "fast", "max_tokens": 60, "slo": 10.0},
+    "mapping_match": {"tier": "standard", "max_tokens": 150, "slo": 20.0},
+    "mapping_verify": {"tier": "standard", "max_tokens": 200, "slo": 20.0},
+    "mapping_group": {"tier": "standard", "max_tokens": 600, "slo": 60.0},
+    "history_exam": {"tier": "fast", "max_tokens": 600, "slo": 10.0},
+    "ai_history": {"tier": "standard", "max_tokens": 800, "slo": 60.0},
+}
+
+WINDOW = 100
+MIN_SAMPLES = 20
+COOLDOWN = 120.0
+RECOVERY_RATIO = 0.6
+RELOAD_INTERVAL = 2.0   # how often LLM_ROUTES_FILE is checked for changes (seconds)
+HEDGE_PERCENTILE = 90
+HEDGE_MIN_DELAY = 0.25   # seconds
+
+HEDGING = os.getenv("LLM_HEDGING", "1") != "0"
+
+ROUTES_FILE = os.getenv("LLM_ROUTES_FILE")
+
+ROUTE_SETTINGS = ("tier", "max_tokens", "slo", "auto_downgrade", "hedge")
+
+
+class RoutingError(ValueError):
+    pass
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class Route:
+    def __init__(self, name, tier, max_tokens, slo, auto_downgrade=True, hedge=False):
+        self.name = name
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=WINDOW)
+        self.calls = 0
+        self.failures = 0
+        self.breaches = 0
+        self.downgrades = 0
+        self.upgrades = 0
+        self.configure(tier=tier, max_tokens=max_tokens, slo=slo, auto_downgrade=auto_downgrade, hedge=hedge)
+
+    def validate(self, tier=None, max_tokens=None, slo=None, auto_downgrade=None, hedge=None):
+        """
+        The given settings, converted, or RoutingError if any of them is invalid.
+        """
+        settings = {}
+        if tier is not None:
+            if tier not in TIERS:
+                raise RoutingError(f"unknown tier '{tier}' for route '{self.name}'")
+            settings["tier"] = tier
+        try:
+            if max_tokens is not None:
+                settings["max_tokens"] = int(max_tokens)
+            if slo is not None:
+                settings["slo"] = float(slo)
+        except (TypeError, ValueError):
+            raise RoutingError(f"max_tokens and slo must be numbers for route '{self.name}'")
+        if settings.get("max_tokens", 1) <= 0:
+            raise RoutingError(f"max_tokens must be positive for route '{self.name}'")
+        if settings.get("slo", 1) <= 0:
+            raise RoutingError(f"slo must be positive for route '{self.name}'")
+        if auto_downgrade is not None:
+            settings["auto_downgrade"] = bool(auto_downgrade)
+        if hedge is not None:
+            settings["hedge"] = bool(hedge)
+        return settings
+
+    def configure(self, **settings):
+        settings = self.validate(**settings)
+        with self.lock:
+            if "tier" in settings:
+                self.tier = self.active_tier = settings["tier"]
+                self.samples.clear()
+                self.changed = time.monotonic()
+            for key in ("max_tokens", "slo", "auto_downgrade", "hedge"):
+                if key in settings:
+                    setattr(self, key, settings[key])
+
+    @property
+    def model(self):
+        return TIER_MODELS[self.active_tier]
+
+    def observe(self, seconds, failed=False):
+        with self.lock:
+            self.calls += 1
+            if failed:
+                self.failures += 1
+                seconds = max(seconds, self.slo)
+            self.breaches += failed or seconds > self.slo
+            self.samples.append(seconds)
+            if not self.auto_downgrade or len(self.samples) < MIN_SAMPLES:
+                return
+            if time.monotonic() - self.changed < COOLDOWN:
+                return
+            p95 = _percentile(self.samples, 95)
+            current = TIERS.index(self.active_tier)
+            if p95 >= self.slo:   # failures are recorded at the SLO
+                faster = [tier for tier in TIERS[:current] if TIER_MODELS[tier] != self.model]
+                if faster:
+                    self._switch(faster[-1], p95)
+                    self.downgrades += 1
+            elif self.active_tier != self.tier and p95 <= self.slo * RECOVERY_RATIO:
+                self._switch(TIERS[current + 1], p95)
+                self.upgrades += 1
+
+    def hedge_delay(self):
+        with self.lock:
+            if len(self.samples) < MIN_SAMPLES:
+                return max(HEDGE_MIN_DELAY, self.slo)
+            return max(HEDGE_MIN_DELAY, _percentile(self.samples, HEDGE_PERCENTILE))
+
+    def tail_mean(self, seconds):
+        """
+        Mean of the recent latencies longer than `seconds`, or None.
+        """
+        with self.lock:
+            tail = [sample for sample in self.samples if sample > seconds]
+        return sum(tail) / len(tail) if tail else None
+
+    def _switch(self, tier, p95):
+        logger.warning(
+            "Route %s: p95 %.2fs against an SLO of %.2fs; moving from %s (%s) to %s (%s).",
+            self.name, p95, self.slo, self.active_tier, self.model, tier, TIER_MODELS[tier],
+        )
+        self.active_tier = tier
+        self.samples.clear()
+        self.changed = time.monotonic()
+
+    def snapshot(self):
+        with self.lock:
+            samples = list(self.samples)
+            return {
+                "tier": self.tier,
+                "active_tier": self.active_tier,
+                "model": self.model,
+                "max_tokens": self.max_tokens,
+                "slo": self.slo,
+                "auto_downgrade": self.auto_downgrade,
+                "hedge": self.hedge and HEDGING,
+                "calls": self.calls,
+                "failures": self.failures,
+                "slo_breaches": self.breaches,
+                "p50": round(_percentile(samples, 50), 3) if samples else None,
+                "p95": round(_percentile(samples, 95), 3) if samples else None,
+                "downgrades": self.downgrades,
+                "upgrades": self.upgrades,
+            }
+
+
+_lock = threading.Lock()
+_routes = {name: Route(name, **settings) for name, settings in ROUTES.items()}
+_file_state = {"checked": 0.0, "mtime": None}
+
+
+def _apply_overrides(overrides, source):
+    """
+    Validate every part of `overrides` first, then apply it, so an invalid override
+    changes nothing.
+    """
+    tiers = overrides.get("tiers") or {}
+    routes = overrides.get("routes") or {}
+    if not isinstance(tiers, dict) or not isinstance(routes, dict):
+        raise RoutingError("'tiers' and 'routes' must be objects")
+    for tier in tiers:
+        if tier not in TIERS:
+            raise RoutingError(f"unknown tier '{tier}'")
+    validated = {}
+    for name, settings in routes.items():
+        if name not in _routes:
+            raise RoutingError(f"unknown route '{name}'")
+        if not isinstance(settings, dict):
+            raise RoutingError(f"settings for route '{name}' must be an object")
+        validated[name] = _routes[name].validate(**{key: settings[key] for key in ROUTE_SETTINGS if key in settings})
+    for tier, model in tiers.items():
+        TIER_MODELS[tier] = str(model)
+    for name, settings in validated.items():
+        _routes[name].configure(**settings)
+    logger.info("Applied model routing overrides from %s.", source)
+
+
+def _reload_file():
+    now = time.monotonic()
+    if not ROUTES_FILE or now - _file_state["checked"] < RELOAD_INTERVAL:
+        return
+    with _lock:
+        _file_state["checked"] = now
+        try:
+            mtime = os.path.getmtime(ROUTES_FILE)
+        except OSError:
+            return
+        if mtime == _file_state["mtime"]:
+            return
+        _file_state["mtime"] = mtime
+        try:
+            with open(ROUTES_FILE) as f:
+                _apply_overrides(json.load(f), ROUTES_FILE)
+        except (OSError, ValueError, TypeError) as e:
+            logger.error("Ignoring model routing file %s: %s", ROUTES_FILE, e)
+
+
+def get(name):
+    _reload_file()
+    route = _routes.get(name)
+    if route is None:
+        raise RoutingError(f"unknown route '{name}'")
+    return route
+
+
+def apply(name, kwargs):
+    """
+    `kwargs` for ChatCompletion.create with the route's model and token limit.
+    """
+    route = get(name)
+    kwargs = dict(kwargs)
+    kwargs["model"] = route.model
+    kwargs["max_tokens"] = min(int(kwargs.get("max_tokens") or route.max_tokens), route.max_tokens)
+    return kwargs
+
+
+def hedged(name):
+    """
+    Whether calls on route `name` are hedged.
+    """
+    return HEDGING and get(name).hedge
+
+
+def observe(name, seconds, failed=False):
+    route = _routes.get(name)
+    if route is not None:
+        route.observe(seconds, failed)
+
+
+def configure(overrides):
+    """
+    Apply {"tiers": {tier: model}, "routes": {route: {tier, max_tokens, slo,
+    auto_downgrade, hedge}}} now, and store it in LLM_ROUTES_FILE for the other workers.
+    """
+    with _lock:
+        _apply_overrides(overrides, "configure()")
+        if not ROUTES_FILE:
+            return
+        try:
+            with open(ROUTES_FILE) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            stored = {}
+        stored.setdefault("tiers", {}).update(overrides.get("tiers") or {})
+        for name, settings in (overrides.get("routes") or {}).items():
+            stored.setdefault("routes", {}).setdefault(name, {}).update(settings)
+        tmp_path = f"{ROUTES_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(stored, f, indent=2)
+        os.replace(tmp_path, ROUTES_FILE)
+        _file_state["mtime"] = os.path.getmtime(ROUTES_FILE)
+
+
+def metrics():
+    _reload_file()
+    return {
+        "tiers": dict(TIER_MODELS),
+        "routes": {name: route.snapshot() for name, route in _routes.items()},
+    }
+
+
+if os.getenv("LLM_ROUTES"):
+    try:
+        _apply_overrides({"routes": json.loads(os.environ["LLM_ROUTES"])}, "LLM_ROUTES")
+    except (ValueError, TypeError) as e:
+        logger.error("Ignoring LLM_ROUTES: %s", e)
@@ -0,0 +1,227 @@
+"""
+Service locator for the external SDKs (OpenAI, BigQuery, Supabase).
+
+Nothing here imports an SDK or builds a client at module load: views import the
+lazy `openai` / `bigquery` module stand-ins and the `get_*` accessors, and the
+real work happens on first use. A missing environment variable therefore only
+fails the request that needs that service instead of the whole worker boot.
+`warm_up()` can be called after boot to pay the import cost ahead of traffic.
+"""
+import importlib
+import logging
+import os
+import threading
+import time
+
+from . import circuit_breaker
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+_env_loaded = False
+_bigquery_client = None
+_supabase_client = None
+
+
+def load_env():
+    """
+    Load .env into the process environment once.
+    """
+    global _env_loaded
+    if _env_loaded:
+        return
+    with _lock:
+        if not _env_loaded:
+            try:
+                from dotenv import load_dotenv
+                load_dotenv()
+            except ImportError:
+                logger.warning("python-dotenv is not installed; relying on the process environment.")
+            _env_loaded = True
+
+
+def openai_api_key():
+    load_env()
+    return os.getenv("NEXT_PUBLIC_OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access.
+    Attribute writes (e.g. `openai.api_key = ...`) are forwarded to the real module.
+    """
+
+    def __init__(self, name, on_load=None):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_on_load", on_load)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            with _lock:
+                module = self._module
+                if module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    if self._on_load:
+                        self._on_load(module)
+                    object.__setattr__(self, "_module", module)
+                    logger.info("Imported %s in %.0f ms.", self._name, (time.perf_counter() - start) * 1000)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def _configure_openai(module):
+    module.api_key = openai_api_key()
+
+
+openai = LazyModule("openai", on_load=_configure_openai)
+bigquery = LazyModule("google.cloud.bigquery")
+
+
+def get_openai():
+    """
+    Return the configured openai module, importing it if needed.
+    """
+    return openai._load()
+
+
+class GuardedBigQueryClient:
+    """
+    The BigQuery client with every query run through the "bigquery" circuit breaker
+    and bounded by BIGQUERY_TIMEOUT (unless the caller passes its own timeout).
+    Everything other than `query` is forwarded to the wrapped client.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def query(self, query, *args, **kwargs):
+        breaker = circuit_breaker.get("bigquery")
+        breaker.before()
+        kwargs.setdefault("timeout", circuit_breaker.BIGQUERY_TIMEOUT)
+        start = time.monotonic()
+        try:
+            job = self._client.query(query, *args, **kwargs)
+        except Exception as e:
+            breaker.record(time.monotonic() - start, e)
+            raise
+        return _GuardedQueryJob(job, breaker, start)
+
+    def __getattr__(self, attr):
+        return getattr(self._client, attr)
+
+
+class _GuardedQueryJob:
+    def __init__(self, job, breaker, start):
+        self._job = job
+        self._breaker = breaker
+        self._start = start
+        self._recorded = False
+
+    def result(self, *args, **kwargs):
+        kwargs.setdefault("timeout", circuit_breaker.BIGQUERY_TIMEOUT)
+        try:
+            rows = self._job.result(*args, **kwargs)
+        except Exception as e:
+            self._record(e)
+            raise
+        self._record(None)
+        return rows
+
+    def _record(self, error):
+        if not self._recorded:
+            self._recorded = True
+            self._breaker.record(time.monotonic() - self._start, error)
+
+    def __getattr__(self, attr):
+        return getattr(self._job, attr)
+
+
+def get_bigquery_client():
+    """
+    Return the process-wide BigQuery client, constructing it on first use.
+    The client is thread-safe, so views share it instead of building one per request.
+    Queries go through the circuit breaker (see GuardedBigQueryClient).
+    """
+    global _bigquery_client
+    if _bigquery_client is None:
+        with _lock:
+            if _bigquery_client is None:
+                load_env()
+                start = time.perf_counter()
+                _bigquery_client = GuardedBigQueryClient(bigquery.Client())
+                logger.info("BigQuery client ready in %.0f ms.", (time.perf_counter() - start) * 1000)
+    return _bigquery_client
+
+
+def get_supabase():
+    """
+    Return the process-wide Supabase client, constructing it on first use.
+    Raises RuntimeError if the Supabase environment variables are not set.
+    """
+    global _supabase_client
+    if _supabase_client is None:
+        with _lock:
+            if _supabase_client is None:
+                load_env()
+                url = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
+                key = os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
+                if not url or not key:
+                    raise RuntimeError("NEXT_PUBLIC_SUPABASE_URL and NEXT_PUBLIC_SUPABASE_ANON_KEY must be set.")
+                start = time.perf_counter()
+                from supabase import create_client
+                _supabase_client = create_client(url, key)
+                logger.info("Supabase client ready in %.0f ms.", (time.perf_counter() - start) * 1000)
+    return _supabase_client
+
+
+_WARM_UP_STEPS = {
+    "openai": get_openai,
+    "bigquery": get_bigquery_client,
+    "supabase": get_supabase,
+}
+
+
+def warm_up(names=None):
+    """
+    Import and construct the given services (default: all) ahead of traffic.
+    Failures are logged rather than raised so a missing credential never blocks boot.
+    Returns a dict of service name -> seconds taken (None on failure).
+    """
+    timings = {}
+    for name in names or _WARM_UP_STEPS:
+        start = time.perf_counter()
+        try:
+            _WARM_UP_STEPS[name]()
+            timings[name] = time.perf_counter() - start
+        except Exception as e:
+            logger.warning("Warm-up of %s failed: %s", name, e)
+            timings[name] = None
+    logger.info("Service warm-up finished: %s", timings)
+    return timings
+
+
+def warm_up_in_background_if_enabled():
+    """
+    Start warm_up() on a daemon thread when SERVICES_WARM_UP is set (e.g. "1" or
+    "openai,bigquery"). Called from the WSGI/ASGI entry points after the app loads,
+    so the worker accepts requests immediately while SDKs load in the background.
+    """
+    setting = os.getenv("SERVICES_WARM_UP", "").strip()
+    if not setting or setting == "0":
+        return None
+    names = None if setting in ("1", "all", "true") else [n.strip() for n in setting.split(",") if n.strip() in _WARM_UP_STEPS]
+    thread = threading.Thread(target=warm_up, args=(names,), name="services-warm-up", daemon=True)
+    thread.start()
+    return thread
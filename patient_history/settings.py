@@ -65,6 +65,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'patient_history.wsgi.application'
+ASGI_APPLICATION = 'patient_history.asgi.application'
 
 # -----------------------------------------------------------------------------
 # DATABASE CONFIGURATION
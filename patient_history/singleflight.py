@@ -0,0 +1,200 @@
+"""
+Single-flight coalescing of identical concurrent work.
+
+During an exam many students ask for the same category list, the same profiled
+condition or the same questions for a pooled case within a second. `Group.do`
+runs the function once per key: threads of the same worker that arrive while a
+call is in flight wait for it and receive its result (or its exception) instead
+of issuing their own BigQuery query or LLM request.
+
+Set SINGLEFLIGHT_LOCK_DIR to a directory shared by the workers (e.g. /tmp/osce-
+singleflight) to coalesce across processes too: the leader of each worker takes
+an fcntl lock file for the key, and whoever gets it first writes the result to a
+JSON file next to it for `ttl` seconds, which the workers queued behind the lock
+read instead of recomputing. Cross-worker sharing only applies to JSON-
+serialisable results; failures are never shared between processes. Results are
+shared objects, so callers must not mutate them.
+
+`Group.ado` is the coroutine counterpart used by the async views: concurrent
+callers on the same event loop await one shared task. It coordinates within the
+process only.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: in-process coalescing only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 5.0   # seconds a cross-worker result stays reusable
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class Group:
+    """
+    Coalesces concurrent calls with the same key for one kind of operation
+    (the group `name` namespaces the keys and the lock files).
+    """
+
+    def __init__(self, name, ttl=DEFAULT_TTL, lock_dir=None):
+        self.name = name
+        self.ttl = ttl
+        self._lock_dir = lock_dir
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self.stats = {"calls": 0, "coalesced": 0, "shared_from_file": 0}
+
+    @property
+    def lock_dir(self):
+        if fcntl is None:
+            return None
+        return self._lock_dir or os.getenv("SINGLEFLIGHT_LOCK_DIR") or None
+
+    def do(self, key, fn):
+        """
+        Return fn(), sharing one execution between all concurrent callers with `key`.
+        """
+        with self._lock:
+            self.stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run(key, fn)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            if call.waiters:
+                logger.info("singleflight %s: %d waiting caller(s) shared one call.", self.name, call.waiters)
+        return call.result
+
+    async def ado(self, key, coro_fn):
+        """
+        Return await coro_fn(), sharing one task between concurrent callers with `key`.
+        A caller that is cancelled does not cancel the shared task.
+        """
+        task_key = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            self.stats["calls"] += 1
+            task = self._tasks.get(task_key)
+            if task is None:
+                task = self._tasks[task_key] = asyncio.ensure_future(coro_fn())
+                task.add_done_callback(lambda done: self._forget(task_key, done))
+            else:
+                self.stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, task_key, task):
+        with self._lock:
+            if self._tasks.get(task_key) is task:
+                del self._tasks[task_key]
+
+    def _run(self, key, fn):
+        lock_dir = self.lock_dir
+        if not lock_dir:
+            return fn()
+        try:
+            os.makedirs(lock_dir, exist_ok=True)
+            digest = hashlib.sha1(f"{self.name}\0{key}".encode("utf-8")).hexdigest()
+            base = os.path.join(lock_dir, f"{self.name}-{digest}")
+            lock_file = open(base + ".lock", "a")
+        except OSError as e:
+            logger.warning("singleflight %s: lock directory unusable (%s); coalescing in-process only.", self.name, e)
+            return fn()
+
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                found, result = self._read_result(base + ".json")
+                if found:
+                    with self._lock:
+                        self.stats["shared_from_file"] += 1
+                    return result
+                result = fn()
+                self._write_result(base + ".json", result)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_result(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return False, None
+            with open(path, "r") as f:
+                return True, json.load(f)
+        except (OSError, ValueError):
+            return False, None
+
+    def _write_result(self, path, result):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(result, f)
+            os.replace(tmp_path, path)
+        except (TypeError, ValueError, OSError) as e:
+            logger.debug("singleflight %s: result not shared across workers (%s).", self.name, e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def group(name, **kwargs):
+    """
+    The process-wide Group for `name`, created on first use.
+    """
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = Group(name, **kwargs)
+        return _groups[name]
+
+
+def stats():
+    """
+    Counters of every group, by name.
+    """
+    with _groups_lock:
+        groups = list(_groups.values())
+    return {g.name: dict(g.stats) for g in groups}
+
+
+def make_key(*parts):
+    """
+    A stable key for JSON-serialisable arguments (prompts, query parameters, ...).
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
@@ -0,0 +1,241 @@
+"""
+Shared parsing of JSON replies from the LLM.
+
+Every endpoint used to do "json.loads, else regex \\{.*\\} with DOTALL", which
+backtracks badly on long replies and gives up on trivially broken JSON.
+`extract_json` instead:
+  1. tries the reply as-is,
+  2. strips Markdown code fences,
+  3. scans the text once, tracking strings and brace depth, to find each
+     balanced top-level object (and the unterminated tail of a truncated one),
+  4. applies light repairs (smart quotes, trailing commas, closing a
+     truncated object),
+and validates the result against the endpoint's `Schema`. `parse_with_reask`
+adds at most one bounded follow-up request when all of that fails.
+"""
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+_FENCE = re.compile(r"```[a-zA-Z]*\s*\n?(.*?)```", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+_SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class StructuredOutputError(ValueError):
+    """The reply contained no JSON object matching the expected schema."""
+
+
+class Schema:
+    """
+    Expected shape of a JSON reply: `fields` maps key -> accepted type(s); keys in
+    `optional` may be missing. Extra keys are allowed.
+    """
+
+    def __init__(self, name, fields, optional=()):
+        self.name = name
+        self.fields = fields
+        self.optional = set(optional)
+
+    def problems(self, value):
+        if not isinstance(value, dict):
+            return [f"expected a JSON object, got {type(value).__name__}"]
+        problems = []
+        for key, types in self.fields.items():
+            if key not in value:
+                if key not in self.optional:
+                    problems.append(f"missing key '{key}'")
+            elif not isinstance(value[key], types):
+                problems.append(f"'{key}' has the wrong type ({type(value[key]).__name__})")
+        return problems
+
+    def describe(self):
+        return ", ".join(f'"{key}"' for key in self.fields)
+
+
+_TEXT = (str,)
+_SCORE = (str, int, float)
+# The model sometimes structures a section, e.g. "SHx": {"Smoking": "20 pack years"};
+# such sections are accepted and flattened to text with flatten_history.
+_SECTION = (str, dict, list)
+HISTORY_SECTIONS = ["PC", "HPC", "PMHx", "DHx", "FHx", "SHx", "SR"]
+
+
+def history_schema(sections=HISTORY_SECTIONS):
+    return Schema("history", {section: _SECTION for section in sections})
+
+
+def section_text(value):
+    """
+    A history section as plain text: objects become "Key: value" items and lists
+    their items, joined with "; ", recursively.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, dict):
+        items = (f"{key}: {text}" for key, text in ((key, section_text(item)) for key, item in value.items()) if text)
+        return "; ".join(items)
+    if isinstance(value, list):
+        return "; ".join(text for text in map(section_text, value) if text)
+    return str(value).strip()
+
+
+def flatten_history(history):
+    """
+    `history` (a parsed history object) with every section flattened by section_text.
+    """
+    return {key: section_text(value) for key, value in history.items()}
+
+
+QUESTIONS = Schema("questions", {"questions": (list,)})
+COMPARE_ANSWER = Schema("compare_answer", {"score": _SCORE, "feedback": _TEXT})
+EVALUATION = Schema(
+    "evaluation",
+    {"overall_score": _SCORE, "overall_feedback": _TEXT, "section_scores": (dict,), "section_feedback": (dict,)},
+    optional=("section_feedback",),
+)
+FEEDBACK = Schema("feedback", {"feedback": (str, dict, list)})
+MIMIC_CONDITION = Schema("mimic_condition", {"mimic_condition": _TEXT, "icd9_codes": (list,)}, optional=("icd9_codes",))
+CATEGORY = Schema("category", {"category": _TEXT})
+CLUSTERS = Schema("clusters", {"clusters": (list,)})
+ANSWERS = Schema("answers", {"answers": (list,)})
+
+
+def strip_fences(text):
+    """
+    The contents of the first Markdown code fence, or `text` unchanged if there is none.
+    """
+    match = _FENCE.search(text)
+    return match.group(1).strip() if match else text
+
+
+def scan_objects(text):
+    """
+    Single pass over `text` returning every balanced top-level {...} / [...] substring,
+    in order. If the text ends inside an object (a truncated reply), that tail is
+    returned last with the closing brackets it is missing appended.
+    """
+    candidates = []
+    stack = []
+    start = None
+    in_string = escape = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"' and stack:
+            in_string = True
+        elif char in _CLOSERS:
+            if not stack:
+                start = i
+            stack.append(_CLOSERS[char])
+        elif stack and char == stack[-1]:
+            stack.pop()
+            if not stack:
+                candidates.append(text[start:i + 1])
+    if stack:
+        tail = text[start:].rstrip().rstrip(",")
+        candidates.append(tail + ('"' if in_string else "") + "".join(reversed(stack)))
+    return candidates
+
+
+def _repair(candidate):
+    return _TRAILING_COMMA.sub(r"\1", candidate.translate(_SMART_QUOTES))
+
+
+def _loads(candidate):
+    for attempt in (candidate, _repair(candidate)):
+        try:
+            return json.loads(attempt), True
+        except json.JSONDecodeError:
+            continue
+    return None, False
+
+
+def extract_json(text, schema=None):
+    """
+    Return the first JSON value in `text` that satisfies `schema` (any object if no
+    schema is given). Raises StructuredOutputError describing what was wrong.
+    """
+    text = str(text or "").strip()
+    problems = []
+    seen = set()
+    for candidate in [text, strip_fences(text), *scan_objects(text)]:
+        if candidate in seen:
+            continue
+        seen.add(candidate)
+        value, ok = _loads(candidate)
+        if not ok:
+            continue
+        issues = schema.problems(value) if schema else ([] if isinstance(value, (dict, list)) else ["not a JSON object"])
+        if not issues:
+            return value
+        problems = problems or issues
+    name = schema.name if schema else "JSON"
+    raise StructuredOutputError(f"no valid {name} object in reply" + (f": {'; '.join(problems)}" if problems else ""))
+
+
+def _follow_up(messages, reply, error, schema):
+    keys = f" with the keys {schema.describe()}" if schema else ""
+    return messages + [
+        {"role": "assistant", "content": reply},
+        {"role": "user", "content": f"That reply could not be used ({error}). Reply again with ONLY a valid JSON object{keys} and no other text."},
+    ]
+
+
+def reask_via(create, messages, **create_kwargs):
+    """
+    Build a re-ask callback for parse_with_reask: it sends the original conversation plus
+    the invalid reply and a correction request through `create` (e.g. llm_gateway.creator(...)).
+    """
+    def reask(reply, error, schema):
+        follow_up = _follow_up(messages, reply, error, schema)
+        response = create(messages=follow_up, **create_kwargs)
+        return response["choices"][0]["message"]["content"]
+    return reask
+
+
+def parse_with_reask(reply, schema=None, reask=None):
+    """
+    extract_json, and if that fails and `reask` is given, one corrective round trip.
+    Raises StructuredOutputError if the second reply is unusable too.
+    """
+    try:
+        return extract_json(reply, schema)
+    except StructuredOutputError as e:
+        if reask is None:
+            raise
+        logger.warning("Re-asking once for %s: %s", schema.name if schema else "JSON", e)
+        return extract_json(reask(reply, e, schema), schema)
+
+
+def areask_via(acreate, messages, **create_kwargs):
+    """
+    reask_via for async views: `acreate` is e.g. llm_gateway.acreator(...).
+    """
+    async def reask(reply, error, schema):
+        follow_up = _follow_up(messages, reply, error, schema)
+        response = await acreate(messages=follow_up, **create_kwargs)
+        return response["choices"][0]["message"]["content"]
+    return reask
+
+
+async def aparse_with_reask(reply, schema=None, reask=None):
+    """
+    parse_with_reask with an async `reask` callback (see areask_via).
+    """
+    try:
+        return extract_json(reply, schema)
+    except StructuredOutputError as e:
+        if reask is None:
+            raise
+        logger.warning("Re-asking once for %s: %s", schema.name if schema else "JSON", e)
+        return extract_json(await reask(reply, e, schema), schema)
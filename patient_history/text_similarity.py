@@ -0,0 +1,156 @@
+"""
+Local text-similarity primitives shared by the deterministic scorers.
+
+Text is normalised (spelling variants, common lay/clinical synonyms), tokenised
+with a light suffix stemmer and expanded into word unigrams, bigrams and
+character trigrams. `TfidfSpace` learns IDF weights from a reference corpus and
+encodes batches of texts into L2-normalised NumPy matrices, so similarity of
+many texts against many references is a single matrix product.
+"""
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between
+both but by can could did do does doing down during each few for from further had has have having he her
+here hers herself him himself his how i if in into is it its itself just me more most my myself no nor not
+now of off on once only or other our ours ourselves out over own same she should so some such than that the
+their theirs them themselves then there these they this those through to too under until up very was we
+were what when where which while who whom why will with would you your yours yourself yourselves
+patient patients pt doctor dr please tell ok okay yes yeah well also any anything ever currently
+""".split())
+
+# Lay phrasings and spelling variants mapped onto one clinical term, applied
+# before tokenisation so "short of breath" and "dyspnoea" land on the same feature.
+# Only unambiguous words and whole phrases: "fits", "temperature" or "mi" on
+# their own have other meanings and would create false matches.
+CLINICAL_SYNONYMS = [
+    (r"\b(shortness of breath|short of breath|breathless(ness)?|difficulty breathing|trouble breathing|sob|dyspnoea)\b", "dyspnea"),
+    (r"\b(high temperature|raised temperature|pyrexia|febrile|feverish)\b", "fever"),
+    (r"\b(throwing up|being sick|vomiting|vomited|emesis)\b", "vomit"),
+    (r"\b(vomiting blood|vomit blood|haematemesis)\b", "hematemesis"),
+    (r"\b(coughing up blood|cough up blood|haemoptysis)\b", "hemoptysis"),
+    (r"\b(heart attacks?)\b", "myocardial infarction"),
+    (r"\b(high blood pressure|raised blood pressure|htn)\b", "hypertension"),
+    (r"\b(having fits|had a fit|epileptic fits?|convulsions?|seizures?)\b", "seizure"),
+    (r"\b(fainting|fainted|faint|passing out|passed out|blackouts?|loss of consciousness)\b", "syncope"),
+    (r"\b(swelling|swollen|oedema)\b", "edema"),
+    (r"\b(heart racing|racing heart|heart pounding|palpitation)\b", "palpitations"),
+    (r"\b(tummy|belly)\b", "abdominal"),
+    (r"\b(pee|peeing|urinating|urination|passing water)\b", "urine"),
+    (r"\b(poo|stools?|bowel movements?|bowels)\b", "bowel"),
+    (r"\b(tablets?|pills?|medicines?|medications?|meds|drugs?)\b", "medication"),
+    (r"\b(cigarettes?|smoking|smoker|smoke)\b", "smoke"),
+    (r"\b(alcohol|drinking|drinks|drink|booze)\b", "alcohol"),
+    (r"\b(allergic|allergies|allergy)\b", "allergy"),
+    (r"\b(tired|tiredness|fatigued?|lethargy|lethargic|exhausted)\b", "fatigue"),
+    (r"\b(weight loss|losing weight|lost weight)\b", "weightloss"),
+    (r"\b(jaundiced|yellow skin|yellowing)\b", "jaundice"),
+    (r"\b(years old|year old|how old|yrs|y/o|aged?)\b", "age"),
+]
+_SYNONYM_PATTERNS = [(re.compile(pattern), replacement) for pattern, replacement in CLINICAL_SYNONYMS]
+_WORD = re.compile(r"[a-z0-9]+")
+_BRITISH_DIGRAPH = re.compile(r"(?<=[a-z])(ae|oe)(?=[a-z])")
+
+
+def normalize(text):
+    """
+    Lower-case `text` and apply the synonym table.
+    """
+    text = str(text or "").lower()
+    for pattern, replacement in _SYNONYM_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _stem(word):
+    # Fold British spellings first (haematemesis -> hematemesis, diarrhoea -> diarrhea).
+    if len(word) > 5:
+        word = _BRITISH_DIGRAPH.sub("e", word)
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 5 and word.endswith("ing"):
+        return word[:-3]
+    if len(word) > 4 and word.endswith("ed"):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    """
+    Normalised, stemmed content words of `text` (stopwords removed).
+    """
+    return [_stem(word) for word in _WORD.findall(normalize(text)) if word not in STOPWORDS]
+
+
+def features(text):
+    """
+    Word unigrams, word bigrams and character trigrams of the tokens of `text`.
+    """
+    tokens = tokenize(text)
+    feats = list(tokens)
+    feats.extend(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+    for token in tokens:
+        padded = f"<{token}>"
+        feats.extend(f"#{padded[i:i + 3]}" for i in range(len(padded) - 2))
+    return feats
+
+
+class TfidfSpace:
+    """
+    IDF weights learnt from a reference corpus; encodes texts as L2-normalised TF-IDF rows.
+    """
+
+    def __init__(self, corpus):
+        document_frequency = Counter()
+        size = 0
+        for text in corpus:
+            document_frequency.update(set(features(text)))
+            size += 1
+        self.idf = {feat: math.log((1 + size) / (1 + count)) + 1.0 for feat, count in document_frequency.items()}
+        self.unseen_idf = math.log(1 + size) + 1.0
+
+    def encode(self, texts, vocab=None):
+        """
+        Encode `texts` into a (len(texts), len(vocab)) float32 matrix.
+        When `vocab` (feature -> column) is omitted it is built from the texts themselves;
+        features outside a supplied vocab are dropped from the matrix but still count
+        towards each row's norm, so a long text does not look similar because of one shared word.
+        Returns (vocab, matrix).
+        """
+        counts = [Counter(features(text)) for text in texts]
+        if vocab is None:
+            vocab = {feat: i for i, feat in enumerate(sorted(set().union(*counts)))} if counts else {}
+        matrix = np.zeros((len(texts), len(vocab)), dtype=np.float32)
+        norms = np.zeros((len(texts), 1), dtype=np.float32)
+        rows, cols, values = [], [], []
+        for row, counter in enumerate(counts):
+            squared = 0.0
+            for feat, tf in counter.items():
+                weight = (1.0 + math.log(tf)) * self.idf.get(feat, self.unseen_idf)
+                squared += weight * weight
+                col = vocab.get(feat)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+                    values.append(weight)
+            norms[row, 0] = math.sqrt(squared)
+        if rows:
+            matrix[rows, cols] = values
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return vocab, matrix
+
+
+def keyword_overlap(reference_tokens, candidate_tokens):
+    """
+    Fraction of the distinct reference keywords that also appear in the candidate.
+    """
+    reference = set(reference_tokens)
+    if not reference:
+        return 0.0
+    return len(reference & set(candidate_tokens)) / len(reference)
@@ -16,7 +16,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 from django.contrib import admin
-from history.views import generate_history, ask_question, get_history_categories, get_conditions, generate_questions, get_general_condition_categories, get_conditions_by_category, get_conditions_by_category_profile, generate_history_with_profile, get_category_by_condition_profile, convert_mimic_to_icd, convert_icd_to_condition
+from history.views import generate_history, generate_history_stream, ask_question, get_history_categories, get_conditions, generate_questions, get_general_condition_categories, get_conditions_by_category, get_conditions_by_category_profile, generate_history_with_profile, get_category_by_condition_profile, convert_mimic_to_icd, convert_icd_to_condition, llm_metrics, llm_routes
 from history import views
 from django.conf import settings
 from django.conf.urls.static import static
@@ -25,6 +25,7 @@ urlpatterns = [
     path('api/', include('marking_scheme_endpoints.urls')),
     path('realtime-endpoints/', include('realtime_endpoints.urls')),
     path("generate-history/", generate_history, name="generate_history"),
+    path("generate-history/stream/", generate_history_stream, name="generate_history_stream"),
     path("ask-question/", ask_question, name="ask_question"),
     path("get-history-categories/", get_history_categories, name="get_history_categories"),
     path("get-conditions/", get_conditions, name="get_conditions"),
@@ -35,6 +36,8 @@ urlpatterns = [
     path('get_conditions_by_category/', get_conditions_by_category, name = 'get_conditions_by_category'),
     path('get_conditions_by_category_profile/', get_conditions_by_category_profile, name='get_conditions_by_category_profile'),
     path("generate-history-with-profile/", generate_history_with_profile, name="generate_history_with_profile"),
+    path("llm-metrics/", llm_metrics, name="llm_metrics"),
+    path("llm-routes/", llm_routes, name="llm_routes"),
     path('get-category-by-condition-profile/', get_category_by_condition_profile, name='get_marking_results_by_category'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
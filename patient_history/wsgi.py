@@ -14,3 +14,12 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'patient_history.settings')
 
 application = get_wsgi_application()
+
+# Optionally import the OpenAI/BigQuery/Supabase SDKs in the background once the
+# app is loaded (SERVICES_WARM_UP=1); nothing is imported eagerly otherwise.
+from marking_scheme_endpoints import persistence  # noqa: E402
+from patient_history import services  # noqa: E402
+
+services.warm_up_in_background_if_enabled()
+# Marks spooled before a restart are delivered without waiting for the next submission.
+persistence.resume_pending(services.get_supabase)
@@ -0,0 +1,343 @@
+"""
+Local preprocessing of recordings before they are sent to Whisper.
+
+Browsers and the QA harness often upload 44.1/48 kHz stereo WAV, five to six
+times the data Whisper needs. `prepare` reads a WAV upload in blocks of
+BLOCK_SECONDS (never the whole file at once), downmixes it to mono, low-pass
+filters and resamples it to 16 kHz, and trims silence with an energy detector
+on FRAME_MS frames: leading and trailing silence is cut to PAD_MS. Pauses inside
+the recording are kept as they are, since hesitations can matter in a
+consultation; with AUDIO_COMPRESS_PAUSES=1 they are shortened to 2 * PAD_MS as
+well, which sends less audio. The result is a 16-bit mono WAV. A recording with no frame above SILENCE_DBFS is reported as silent, so the
+Whisper call can be skipped.
+
+Compressed uploads (webm, mp3, m4a, ...) cannot be decoded without ffmpeg and
+are already small; they, and WAV encodings the `wave` module cannot read (e.g.
+32-bit float), are passed through unchanged.
+
+`VoiceActivitySegmenter` applies the same detector to live PCM: it cuts the
+stream into segments at short pauses (SEGMENT_PAUSE_MS), so each can be
+transcribed while the speaker carries on, and reports the end of an utterance
+after a longer pause (UTTERANCE_PAUSE_MS).
+"""
+import io
+import logging
+import os
+import time
+import wave
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+BLOCK_SECONDS = 1.0
+FRAME_MS = 30
+PAD_MS = 300
+SILENCE_DBFS = -45.0
+COMPRESS_PAUSES = os.getenv("AUDIO_COMPRESS_PAUSES", "0") == "1"
+FILTER_TAPS = 63
+MAX_OUTPUT_BYTES = 25 * 1024 * 1024   # Whisper's upload limit
+SEGMENT_PAUSE_MS = 500
+UTTERANCE_PAUSE_MS = 1200
+MIN_SPEECH_MS = 120
+MAX_SEGMENT_SECONDS = 15
+
+FRAME_SAMPLES = SAMPLE_RATE * FRAME_MS // 1000
+
+
+class AudioTooLongError(ValueError):
+    pass
+
+
+def is_wav(audio_file):
+    header = audio_file.read(12)
+    audio_file.seek(0)
+    return len(header) == 12 and header[:4] == b"RIFF" and header[8:12] == b"WAVE"
+
+
+def frame_dbfs(frame):
+    """
+    RMS level of float samples in [-1, 1], in dB relative to full scale.
+    """
+    rms = np.sqrt(np.mean(np.square(frame, dtype=np.float64))) if len(frame) else 0.0
+    return 20 * np.log10(max(rms, 1e-10))
+
+
+def pcm_to_float(data, sample_width, channels):
+    """
+    Interleaved little-endian PCM bytes to a mono float32 array in [-1, 1].
+    """
+    if sample_width == 1:
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768
+    elif sample_width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        ints = raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8) | (raw[:, 2].astype(np.int32) << 16)
+        samples = (np.where(ints >= 1 << 23, ints - (1 << 24), ints)).astype(np.float32) / (1 << 23)
+    elif sample_width == 4:
+        samples = np.frombuffer(data, dtype="<i4").astype(np.float32) / (1 << 31)
+    else:
+        raise wave.Error(f"unsupported sample width {sample_width}")
+    if channels > 1:
+        samples = samples[: len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+    return samples
+
+
+def float_to_pcm16(samples):
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+
+class Resampler:
+    """
+    Streaming conversion of float samples from `rate_in` to SAMPLE_RATE: a
+    windowed-sinc low-pass (when downsampling) followed by linear interpolation.
+    Blocks may be any length; state is carried across `feed` calls.
+    """
+
+    def __init__(self, rate_in, rate_out=SAMPLE_RATE):
+        self.step = rate_in / rate_out
+        self.taps = None
+        if rate_in > rate_out:
+            cutoff = 0.45 * rate_out / rate_in   # cycles per input sample
+            n = np.arange(FILTER_TAPS) - (FILTER_TAPS - 1) / 2
+            taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(FILTER_TAPS)
+            self.taps = (taps / taps.sum()).astype(np.float32)
+            self._history = np.zeros(FILTER_TAPS - 1, dtype=np.float32)
+        self._carry = np.zeros(0, dtype=np.float32)
+        self._pos = 0.0
+
+    def feed(self, samples):
+        if self.taps is not None:
+            padded = np.concatenate([self._history, samples])
+            samples = np.convolve(padded, self.taps, mode="valid").astype(np.float32)
+            self._history = padded[len(padded) - (FILTER_TAPS - 1):]
+        if self.step == 1.0:
+            return samples
+        buf = np.concatenate([self._carry, samples])
+        positions = np.arange(self._pos, len(buf) - 1, self.step)
+        out = np.interp(positions, np.arange(len(buf)), buf).astype(np.float32)
+        next_pos = positions[-1] + self.step if len(positions) else self._pos
+        keep = int(next_pos)
+        self._carry = buf[keep:]
+        self._pos = next_pos - keep
+        return out
+
+
+class FrameSplitter:
+    """
+    Cuts a stream of sample blocks into FRAME_SAMPLES frames, carrying the
+    remainder over to the next block.
+    """
+
+    def __init__(self):
+        self._pending = np.zeros(0, dtype=np.float32)
+
+    def split(self, samples):
+        buf = np.concatenate([self._pending, samples])
+        whole = len(buf) - len(buf) % FRAME_SAMPLES
+        self._pending = buf[whole:]
+        return [buf[start:start + FRAME_SAMPLES] for start in range(0, whole, FRAME_SAMPLES)]
+
+    def remainder(self):
+        frames = [self._pending] if len(self._pending) else []
+        self._pending = np.zeros(0, dtype=np.float32)
+        return frames
+
+
+class SilenceTrimmer:
+    """
+    Streaming energy-based trimming of 16 kHz float samples, FRAME_MS at a time.
+    `write` is called with the kept PCM16 bytes. Only leading and trailing silence
+    is trimmed unless `compress_pauses` is set.
+    """
+
+    def __init__(self, write, pad_ms=PAD_MS, threshold_dbfs=SILENCE_DBFS, compress_pauses=COMPRESS_PAUSES):
+        self.write = write
+        self.threshold_dbfs = threshold_dbfs
+        self.compress_pauses = compress_pauses
+        self.pad_frames = max(1, pad_ms // FRAME_MS)
+        self.voiced_frames = 0
+        self._lead = deque(maxlen=self.pad_frames)   # silence that may precede the next speech
+        self._tail_left = 0                          # trailing pad still owed after speech
+        self._gap = []                               # silence past the pad: a pause if speech resumes
+        self._frames = FrameSplitter()
+
+    def feed(self, samples):
+        for frame in self._frames.split(samples):
+            self._frame(frame)
+
+    def finish(self):
+        for frame in self._frames.remainder():
+            self._frame(frame)
+
+    def _frame(self, frame):
+        if frame_dbfs(frame) > self.threshold_dbfs:
+            self.voiced_frames += 1
+            for pause in self._gap:
+                self.write(float_to_pcm16(pause))
+            self._gap.clear()
+            while self._lead:
+                self.write(float_to_pcm16(self._lead.popleft()))
+            self.write(float_to_pcm16(frame))
+            self._tail_left = self.pad_frames
+        elif self._tail_left:
+            self._tail_left -= 1
+            self.write(float_to_pcm16(frame))
+        elif self.voiced_frames and not self.compress_pauses:
+            self._gap.append(frame)
+        else:
+            self._lead.append(frame)
+
+
+def prepare(audio_file):
+    """
+    Return (file, stats) for transcribing `audio_file`: a trimmed 16 kHz mono WAV
+    for WAV input, otherwise the original file. `file` is None when the recording
+    contains no speech. Raises AudioTooLongError if the trimmed audio would still
+    exceed Whisper's upload limit.
+    """
+    start = time.perf_counter()
+    if not is_wav(audio_file):
+        return audio_file, {"preprocessed": False}
+    try:
+        source = wave.open(audio_file, "rb")
+    except (wave.Error, EOFError) as e:
+        logger.info("WAV upload not preprocessed (%s); sending it unchanged.", e)
+        audio_file.seek(0)
+        return audio_file, {"preprocessed": False}
+
+    out = io.BytesIO()
+    out.name = "speech.wav"
+    with source, wave.open(out, "wb") as target:
+        target.setnchannels(1)
+        target.setsampwidth(2)
+        target.setframerate(SAMPLE_RATE)
+
+        def write(pcm):
+            if out.tell() + len(pcm) > MAX_OUTPUT_BYTES:
+                raise AudioTooLongError("Recording is too long to transcribe.")
+            target.writeframesraw(pcm)
+
+        channels, width, rate = source.getnchannels(), source.getsampwidth(), source.getframerate()
+        resampler = Resampler(rate)
+        trimmer = SilenceTrimmer(write)
+        block_frames = max(1, int(rate * BLOCK_SECONDS))
+        input_frames = 0
+        while True:
+            data = source.readframes(block_frames)
+            if not data:
+                break
+            input_frames += len(data) // (width * channels)
+            trimmer.feed(resampler.feed(pcm_to_float(data, width, channels)))
+        trimmer.finish()
+
+    stats = {
+        "preprocessed": True,
+        "input_seconds": round(input_frames / rate, 2) if rate else 0,
+        "output_seconds": round((out.tell() - 44) / 2 / SAMPLE_RATE, 2),
+        "input_format": f"{rate} Hz, {channels} ch, {width * 8}-bit",
+        "output_bytes": out.tell(),
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+    }
+    if not trimmer.voiced_frames:
+        return None, stats
+    out.seek(0)
+    return out, stats
+
+
+def wav_file(pcm, name="speech.wav"):
+    """
+    An in-memory 16 kHz mono WAV file (with `name`) holding PCM16 bytes.
+    """
+    out = io.BytesIO()
+    with wave.open(out, "wb") as target:
+        target.setnchannels(1)
+        target.setsampwidth(2)
+        target.setframerate(SAMPLE_RATE)
+        target.writeframes(pcm)
+    out.name = name
+    out.seek(0)
+    return out
+
+
+class VoiceActivitySegmenter:
+    """
+    Splits live PCM16 audio into speech segments.
+
+    `feed` takes raw little-endian PCM16 bytes at `sample_rate`/`channels` and
+    returns the events it completed, in order:
+      ("segment", wav_file)   a closed speech segment, ready to transcribe
+      ("utterance_end", None) the speaker paused for UTTERANCE_PAUSE_MS
+    `finish` closes whatever is open at the end of the stream.
+    """
+
+    def __init__(self, sample_rate, channels=1, threshold_dbfs=SILENCE_DBFS):
+        self.channels = channels
+        self.threshold_dbfs = threshold_dbfs
+        self.segments = 0
+        self._resampler = Resampler(sample_rate)
+        self._frames = FrameSplitter()
+        self._carry = b""
+        self._lead = deque(maxlen=max(1, PAD_MS // FRAME_MS))
+        self._segment = None        # frames of the open segment
+        self._voiced = 0            # voiced frames in the open segment
+        self._silence = 0           # consecutive silent frames
+        self._speaking = False      # speech since the last utterance_end
+
+    def feed(self, pcm):
+        data = self._carry + pcm
+        usable = len(data) - len(data) % (2 * self.channels)
+        self._carry = data[usable:]
+        samples = pcm_to_float(data[:usable], 2, self.channels)
+        events = []
+        for frame in self._frames.split(self._resampler.feed(samples)):
+            self._frame(frame, events)
+        return events
+
+    def finish(self):
+        events = []
+        for frame in self._frames.remainder():
+            self._frame(frame, events)
+        self._close_segment(events)
+        if self._speaking:
+            self._speaking = False
+            events.append(("utterance_end", None))
+        return events
+
+    def _frame(self, frame, events):
+        voiced = frame_dbfs(frame) > self.threshold_dbfs
+        if voiced:
+            self._silence = 0
+            self._speaking = True
+            if self._segment is None:
+                self._segment = list(self._lead)
+                self._lead.clear()
+            self._segment.append(frame)
+            self._voiced += 1
+            if len(self._segment) >= MAX_SEGMENT_SECONDS * 1000 // FRAME_MS:
+                self._close_segment(events)
+            return
+
+        self._silence += 1
+        if self._segment is not None:
+            if self._silence <= self._lead.maxlen:
+                self._segment.append(frame)
+            if self._silence >= SEGMENT_PAUSE_MS // FRAME_MS:
+                self._close_segment(events)
+        else:
+            self._lead.append(frame)
+        if self._speaking and self._silence >= UTTERANCE_PAUSE_MS // FRAME_MS:
+            self._speaking = False
+            events.append(("utterance_end", None))
+
+    def _close_segment(self, events):
+        segment, voiced = self._segment, self._voiced
+        self._segment, self._voiced = None, 0
+        # Clicks and breaths shorter than MIN_SPEECH_MS are not worth a Whisper call.
+        if segment and voiced >= MIN_SPEECH_MS // FRAME_MS:
+            self.segments += 1
+            pcm = b"".join(float_to_pcm16(frame) for frame in segment)
+            events.append(("segment", wav_file(pcm, f"segment-{self.segments}.wav")))
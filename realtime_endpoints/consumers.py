@@ -0,0 +1,319 @@
+"""
+WebSocket channel for a realtime consultation.
+
+One socket carries one consultation: the case history and the conversation are
+bound to the connection, so each doctor turn is a single small frame instead of
+a POST that resends the whole history. The patient's reply is streamed back
+token by token. This is a plain ASGI application (no Channels dependency);
+patient_history/asgi.py routes websocket connections on CONSULTATION_PATH here
+and everything else to Django.
+
+Client -> server (JSON text frames unless noted):
+    {"type": "start", "history": {"PC": ..., ...}, "messages": [...]}
+        binds a case; "messages" optionally resumes an earlier conversation
+    {"type": "utterance", "text": "..."}        a doctor turn
+    {"type": "audio_start", "format": "webm"}, binary frames, {"type": "audio_end"}
+        a spoken turn: transcribed with Whisper, then answered like an utterance
+    {"type": "stream_start", "sample_rate": 48000, "channels": 1}, binary frames
+    of raw PCM16, ..., {"type": "stream_end"}
+        live microphone audio (see below)
+    {"type": "ping"} / {"type": "pong"}
+
+Server -> client:
+    {"type": "ready", "session": "<id>"}
+    {"type": "partial_transcript", "segment": n, "text": "..."}
+    {"type": "transcript", "text": "..."}       for spoken turns
+    {"type": "token", "text": "..."}            streamed reply fragments
+    {"type": "reply", "text": "..."}            the complete reply; the turn is over
+    {"type": "ping"} / {"type": "pong"}
+    {"type": "busy", "retry_after": s} / {"type": "error", "error": "..."}
+
+Live audio is cut by audio.VoiceActivitySegmenter. Every segment (speech up to
+a short pause) is sent to Whisper as soon as it closes, while the doctor keeps
+talking, and its text is sent as a partial_transcript. When the doctor pauses
+for longer the utterance is over: its segments' texts are joined into the
+transcript and answered as one turn, so the wait before the patient replies is
+about one segment's transcription. At most MAX_PENDING_SEGMENTS segments are
+transcribed at once per socket.
+
+Turns are answered one at a time. At most MAX_PENDING_TURNS wait behind the one
+being answered; further turns are refused with "busy" rather than buffered, and
+a recording beyond MAX_AUDIO_BYTES is discarded with an error. The server pings every
+HEARTBEAT_INTERVAL seconds and closes the socket (code 4408) when nothing was
+received for HEARTBEAT_TIMEOUT seconds. Closing the socket cancels the reply in
+flight, which releases its LLM gateway slot.
+"""
+import asyncio
+import io
+import json
+import logging
+import time
+import uuid
+
+from patient_history.aio import run_blocking
+from patient_history.circuit_breaker import DependencyUnavailableError
+
+from . import audio, views
+
+logger = logging.getLogger(__name__)
+
+CONSULTATION_PATH = "/realtime-endpoints/ws/consultation/"
+
+HEARTBEAT_INTERVAL = 20.0
+HEARTBEAT_TIMEOUT = 60.0
+MAX_PENDING_TURNS = 2
+MAX_PENDING_SEGMENTS = 8
+MAX_AUDIO_BYTES = 25 * 1024 * 1024   # Whisper's upload limit
+MAX_MESSAGES = 40                    # conversation messages kept for the prompt
+AUDIO_FORMATS = {"webm", "wav", "mp3", "m4a", "ogg", "mp4", "mpeg", "mpga"}
+
+CLOSE_IDLE = 4408
+
+
+class ConsultationSession:
+    """
+    Server-side state of one consultation socket.
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.history = None
+        self.messages = []
+        self.audio = None
+        self.audio_format = None
+        self.stream = None          # VoiceActivitySegmenter while live audio is streamed
+        self.segments = []          # transcription tasks of the current live utterance
+        self.transcriptions = set() # every unfinished segment transcription
+        self.last_seen = time.monotonic()
+
+    def start(self, history, messages=()):
+        self.history = history
+        self.messages = [m for m in messages if isinstance(m, dict) and m.get("role") in ("user", "assistant")]
+        self.messages = self.messages[-MAX_MESSAGES:]
+
+    def add(self, role, content):
+        self.messages.append({"role": role, "content": content})
+        del self.messages[:-MAX_MESSAGES]
+
+
+class Connection:
+    def __init__(self, send):
+        self._send = send
+        self._send_lock = asyncio.Lock()
+        self.closed = False
+
+    async def send_json(self, payload):
+        if self.closed:
+            return
+        # Awaiting the server's send is the outbound backpressure: a slow client
+        # slows down how fast tokens are read from the LLM stream.
+        async with self._send_lock:
+            await self._send({"type": "websocket.send", "text": json.dumps(payload)})
+
+    async def close(self, code=1000):
+        if self.closed:
+            return
+        self.closed = True
+        async with self._send_lock:
+            await self._send({"type": "websocket.close", "code": code})
+
+
+async def consultation(scope, receive, send):
+    """
+    ASGI application for CONSULTATION_PATH.
+    """
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+    await send({"type": "websocket.accept"})
+
+    session = ConsultationSession()
+    connection = Connection(send)
+    turns = asyncio.Queue(maxsize=MAX_PENDING_TURNS)
+    logger.info("Consultation %s connected.", session.id)
+    await connection.send_json({"type": "ready", "session": session.id})
+
+    worker = asyncio.ensure_future(answer_turns(session, connection, turns))
+    heartbeat = asyncio.ensure_future(keep_alive(session, connection))
+    try:
+        await read_frames(session, connection, turns, receive)
+    finally:
+        connection.closed = True
+        tasks = [worker, heartbeat, *session.transcriptions]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info("Consultation %s closed after %d messages.", session.id, len(session.messages))
+
+
+async def read_frames(session, connection, turns, receive):
+    while True:
+        message = await receive()
+        if message["type"] == "websocket.disconnect":
+            return
+        session.last_seen = time.monotonic()
+
+        if message.get("bytes") is not None:
+            if session.stream is not None:
+                # Resampling and voice detection are NumPy work: keep them off the event loop. Frames
+                # are still fed one at a time, in order, since the next one is not read until this returns.
+                events = await run_blocking(session.stream.feed, message["bytes"])
+                await handle_stream_events(session, connection, turns, events)
+            else:
+                await receive_audio(session, connection, message["bytes"])
+            continue
+        try:
+            frame = json.loads(message.get("text") or "")
+            kind = frame["type"]
+        except (ValueError, TypeError, KeyError):
+            await connection.send_json({"type": "error", "error": "Frames must be JSON objects with a 'type'."})
+            continue
+
+        if kind == "ping":
+            await connection.send_json({"type": "pong"})
+        elif kind == "pong":
+            pass
+        elif kind == "start":
+            history = frame.get("history")
+            if not isinstance(history, dict):
+                await connection.send_json({"type": "error", "error": "start requires a 'history' object."})
+                continue
+            session.start(history, frame.get("messages") or ())
+        elif kind == "audio_start":
+            audio_format = str(frame.get("format", "webm")).lower()
+            if audio_format not in AUDIO_FORMATS:
+                await connection.send_json({"type": "error", "error": f"Unsupported audio format '{audio_format}'."})
+                continue
+            session.audio, session.audio_format = bytearray(), audio_format
+        elif kind == "audio_end":
+            if session.audio is None:
+                await connection.send_json({"type": "error", "error": "audio_end without audio_start."})
+                continue
+            recording, session.audio = session.audio, None
+            await queue_turn(session, connection, turns, {"audio": bytes(recording), "format": session.audio_format})
+        elif kind == "stream_start":
+            if session.history is None:
+                await connection.send_json({"type": "error", "error": "Send a start frame with the case history first."})
+                continue
+            try:
+                sample_rate, channels = int(frame.get("sample_rate", 16000)), int(frame.get("channels", 1))
+                if not 8000 <= sample_rate <= 96000 or channels not in (1, 2):
+                    raise ValueError
+            except (TypeError, ValueError):
+                await connection.send_json({"type": "error", "error": "stream_start needs a sample_rate (8000-96000) and 1 or 2 channels."})
+                continue
+            session.stream = audio.VoiceActivitySegmenter(sample_rate, channels)
+        elif kind == "stream_end":
+            if session.stream is not None:
+                stream, session.stream = session.stream, None
+                await handle_stream_events(session, connection, turns, await run_blocking(stream.finish))
+        elif kind == "utterance":
+            text = str(frame.get("text", "")).strip()
+            if not text:
+                await connection.send_json({"type": "error", "error": "utterance requires 'text'."})
+                continue
+            await queue_turn(session, connection, turns, {"text": text})
+        else:
+            await connection.send_json({"type": "error", "error": f"Unknown frame type '{kind}'."})
+
+
+async def receive_audio(session, connection, chunk):
+    if session.audio is None:
+        await connection.send_json({"type": "error", "error": "Binary frames must follow audio_start."})
+        return
+    if len(session.audio) + len(chunk) > MAX_AUDIO_BYTES:
+        session.audio = None
+        await connection.send_json({"type": "error", "error": "Recording too long; it was discarded."})
+        return
+    session.audio.extend(chunk)
+
+
+async def handle_stream_events(session, connection, turns, events):
+    for event, segment in events:
+        if event == "segment":
+            if len(session.transcriptions) >= MAX_PENDING_SEGMENTS:
+                await connection.send_json({"type": "busy", "error": "Audio arrives faster than it can be transcribed.", "retry_after": 1})
+                continue
+            task = asyncio.ensure_future(transcribe_segment(connection, len(session.segments), segment))
+            session.transcriptions.add(task)
+            task.add_done_callback(session.transcriptions.discard)
+            session.segments.append(task)
+        elif session.segments:
+            segments, session.segments = session.segments, []
+            if not await queue_turn(session, connection, turns, {"segments": segments}):
+                for task in segments:
+                    task.cancel()
+
+
+async def transcribe_segment(connection, index, segment):
+    text = (await run_blocking(views.transcribe, segment)).strip()
+    await connection.send_json({"type": "partial_transcript", "segment": index, "text": text})
+    return text
+
+
+async def queue_turn(session, connection, turns, turn):
+    """
+    Queue a turn for answer_turns; returns whether it was accepted.
+    """
+    if session.history is None:
+        await connection.send_json({"type": "error", "error": "Send a start frame with the case history first."})
+        return False
+    try:
+        turns.put_nowait(turn)
+    except asyncio.QueueFull:
+        await connection.send_json({"type": "busy", "error": "Still answering earlier questions.", "retry_after": 1})
+        return False
+    return True
+
+
+async def keep_alive(session, connection):
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        if time.monotonic() - session.last_seen > HEARTBEAT_TIMEOUT:
+            logger.info("Consultation %s idle for %.0fs; closing.", session.id, HEARTBEAT_TIMEOUT)
+            await connection.close(CLOSE_IDLE)
+            return
+        await connection.send_json({"type": "ping"})
+
+
+async def answer_turns(session, connection, turns):
+    while True:
+        turn = await turns.get()
+        try:
+            text = turn.get("text")
+            if "segments" in turn:
+                texts = await asyncio.gather(*turn["segments"])
+                text = " ".join(part for part in texts if part)
+            elif "audio" in turn:
+                text = await transcribe(turn["audio"], turn["format"])
+            if "text" not in turn:
+                await connection.send_json({"type": "transcript", "text": text})
+                if not text:
+                    continue
+            await answer(session, connection, text)
+        except DependencyUnavailableError as e:
+            await connection.send_json({"type": "busy", "error": str(e), "retry_after": round(e.retry_after, 1)})
+        except Exception as e:
+            logger.exception("Consultation %s: turn failed: %s", session.id, e)
+            await connection.send_json({"type": "error", "error": str(e)})
+
+
+async def transcribe(recording, audio_format):
+    audio_file = io.BytesIO(recording)
+    audio_file.name = f"speech.{audio_format}"
+    return (await run_blocking(views.transcribe, audio_file)).strip()
+
+
+async def answer(session, connection, text):
+    """
+    Stream the patient's reply to `text` and record both in the session.
+    """
+    conversation = session.messages + [{"role": "user", "content": text}]
+    parts = []
+    async for delta in views.patient_reply_tokens(session.history, conversation):
+        parts.append(delta)
+        await connection.send_json({"type": "token", "text": delta})
+    reply = "".join(parts).strip()
+    session.add("user", text)
+    session.add("assistant", reply)
+    await connection.send_json({"type": "reply", "text": reply})
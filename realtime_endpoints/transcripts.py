@@ -0,0 +1,72 @@
+"""
+Cache of Whisper transcripts keyed by audio content.
+
+Students resubmit the same recording after network hiccups and the QA harness
+replays fixed fixtures, so the same audio reaches Whisper over and over. The key
+is a SHA-256 of what would be uploaded: for WAV input that is the normalised
+16 kHz mono PCM produced by audio.prepare, so two files with the same samples
+hit the same entry even if their headers, metadata chunks or sample layout
+differ; compressed uploads are keyed by their bytes. Entries are evicted least
+recently used beyond TRANSCRIPT_CACHE_SIZE, per worker.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+TRANSCRIPT_CACHE_SIZE = int(os.getenv("TRANSCRIPT_CACHE_SIZE", 2048))
+_READ_CHUNK = 64 * 1024
+
+
+def cache_key(audio_file, model="whisper-1"):
+    """
+    Content hash of a file-like object, read in chunks; the file is rewound.
+    """
+    digest = hashlib.sha256(model.encode("utf-8") + b"\0")
+    audio_file.seek(0)
+    for chunk in iter(lambda: audio_file.read(_READ_CHUNK), b""):
+        digest.update(chunk)
+    audio_file.seek(0)
+    return digest.hexdigest()
+
+
+class TranscriptCache:
+    def __init__(self, max_entries=TRANSCRIPT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        """
+        The cached transcript for `key`, or None.
+        """
+        with self._lock:
+            text = self._entries.get(key)
+            if text is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return text
+
+    def put(self, key, text):
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def metrics(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return dict(
+                self._stats,
+                entries=len(self._entries),
+                max_entries=self.max_entries,
+                hit_rate=round(self._stats["hits"] / lookups, 3) if lookups else None,
+            )
+
+
+cache = TranscriptCache()
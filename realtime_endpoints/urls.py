@@ -6,5 +6,6 @@ urlpatterns = [
     path('', views.index, name='realtime_index'),
     path("chat/", views.realtime_chat, name="realtime_chat"),
     path("transcribe/", views.transcribe_audio, name = "transcribe_audio"),
+    path("spoken-turn/", views.spoken_turn, name="spoken_turn"),
     # Add more endpoints as needed.
 ]
@@ -1,19 +1,32 @@
 import json
 import os
-import openai
 import logging
-from django.http import JsonResponse
+from patient_history import circuit_breaker, llm_gateway, singleflight
+from patient_history.aio import run_blocking
+from patient_history.circuit_breaker import DependencyUnavailableError
+from patient_history.services import openai
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 
+from history import case_answers, streaming
+
+from . import audio, transcripts
+from .audio import AudioTooLongError
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
+transcription_flight = singleflight.group("transcription")
+
+# Completion settings for the simulated patient (HTTP and WebSocket).
+PATIENT_COMPLETION = {"route": "realtime_chat", "temperature": 0.7}
+
 def index(request):
     return JsonResponse({"message": "Realtime API endpoint working!"})
 
 
 @csrf_exempt
-def realtime_chat(request):
+async def realtime_chat(request):
     """
     Expects a JSON payload with:
       - "messages": a list of conversation messages (each with 'role' and 'content')
@@ -39,6 +52,59 @@ def realtime_chat(request):
         logger.error("Invalid JSON or missing parameters: %s", e)
         return JsonResponse({"error": "Invalid JSON or missing required parameters."}, status=400)
 
+    precomputed = await precomputed_reply(history_data, messages)
+    if precomputed:
+        return JsonResponse({"response": precomputed, "precomputed": True}, status=200)
+
+    messages = patient_messages(history_data, messages)
+
+    try:
+        logger.info("Sending messages to OpenAI: %s", messages)
+        response = await llm_gateway.achat_completion("realtime", messages=messages, **PATIENT_COMPLETION)
+        answer = response["choices"][0]["message"]["content"].strip()
+        logger.info("Received AI answer: %s", answer)
+        return JsonResponse({"response": answer}, status=200)
+    except DependencyUnavailableError as e:
+        return circuit_breaker.unavailable_response(e)
+    except Exception as e:
+        logger.exception("Error calling OpenAI API: %s", e)
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+async def precomputed_reply(history_data, messages):
+    """
+    The precomputed answer (history/case_answers.py) to the doctor's last message, or None.
+    """
+    if not messages or not isinstance(messages[-1], dict) or messages[-1].get("role") != "user":
+        return None
+    return await run_blocking(case_answers.lookup, history_data, messages[-1].get("content"))
+
+
+async def patient_reply_tokens(history_data, messages):
+    """
+    Yield the patient's reply to the conversation `messages`, fragment by fragment.
+    """
+    precomputed = await precomputed_reply(history_data, messages)
+    if precomputed:
+        yield precomputed
+        return
+    chunks = await llm_gateway.achat_completion(
+        "realtime",
+        messages=patient_messages(history_data, messages),
+        stream=True,
+        **PATIENT_COMPLETION,
+    )
+    async for chunk in chunks:
+        delta = chunk["choices"][0].get("delta", {}).get("content")
+        if delta:
+            yield delta
+
+
+def patient_messages(history_data, messages):
+    """
+    The completion messages for the simulated patient: the persona system prompt
+    built from the case history, followed by the conversation so far.
+    """
     # Construct a detailed system prompt.
     system_prompt = (
         "You are a real human patient. The doctor (the user) will ask you medical questions, "
@@ -56,27 +122,10 @@ def realtime_chat(request):
     )
 
     # Always insert the system prompt as the first message.
-    messages = [{"role": "system", "content": system_prompt}] + messages
-
-
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    try:
-        logger.info("Sending messages to OpenAI: %s", messages)
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            max_tokens=300,
-            temperature=0.7,
-        )
-        answer = response["choices"][0]["message"]["content"].strip()
-        logger.info("Received AI answer: %s", answer)
-        return JsonResponse({"response": answer}, status=200)
-    except Exception as e:
-        logger.exception("Error calling OpenAI API: %s", e)
-        return JsonResponse({"error": str(e)}, status=500)
+    return [{"role": "system", "content": system_prompt}] + messages
 
 @csrf_exempt
-def transcribe_audio(request):
+async def transcribe_audio(request):
     if request.method != "POST":
         return JsonResponse({"error": "Only POST method allowed."}, status=400)
     
@@ -86,16 +135,109 @@ def transcribe_audio(request):
         if not audio_file:
             return JsonResponse({"error": "No audio file provided."}, status=400)
         
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        transcript_response = openai.Audio.transcribe(
-            model="whisper-1",
-            file=audio_file,
-        )
-        transcript_text = transcript_response["text"]
+        # Preprocessing and the multipart upload run on the blocking-I/O pool.
+        transcript_text = await run_blocking(transcribe, audio_file)
         return JsonResponse({"text": transcript_text})
+    except AudioTooLongError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except DependencyUnavailableError as e:
+        return circuit_breaker.unavailable_response(e)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+@csrf_exempt
+async def spoken_turn(request):
+    """
+    A spoken doctor turn in one round trip: transcribe, then answer as the patient.
+
+    Expects a multipart POST with:
+      - "file": the recording (as for transcribe/)
+      - "history": JSON object with the patient history fields (as for chat/)
+      - "messages": optional JSON list of the conversation so far
+    Responds with Server-Sent Events:
+      - "transcript": {"text": "..."} as soon as the transcription is final
+      - "token": {"text": "..."} fragments of the patient's reply
+      - "done": {"transcript": "...", "response": "..."}
+      - "error": {"error": "..."} if the reply fails part-way
+    Errors before streaming starts are returned as normal JSON responses.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Only POST method allowed."}, status=400)
+
+    audio_file = request.FILES.get("file")
+    try:
+        history_data = json.loads(request.POST.get("history") or "null")
+        messages = json.loads(request.POST.get("messages") or "[]")
+        if not audio_file or not isinstance(history_data, dict) or not isinstance(messages, list):
+            raise ValueError("file, history and messages are required")
+    except ValueError as e:
+        logger.error("Invalid spoken turn: %s", e)
+        return JsonResponse({"error": "Expected an audio 'file', a JSON 'history' object and optional JSON 'messages'."}, status=400)
+
+    try:
+        transcript = (await run_blocking(transcribe, audio_file)).strip()
+    except AudioTooLongError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except DependencyUnavailableError as e:
+        return circuit_breaker.unavailable_response(e)
     except Exception as e:
+        logger.exception("Transcription failed: %s", e)
         return JsonResponse({"error": str(e)}, status=500)
 
+    async def events():
+        yield streaming.sse_event("transcript", {"text": transcript})
+        parts = []
+        try:
+            if transcript:
+                conversation = messages + [{"role": "user", "content": transcript}]
+                async for delta in patient_reply_tokens(history_data, conversation):
+                    parts.append(delta)
+                    yield streaming.sse_event("token", {"text": delta})
+            yield streaming.sse_event("done", {"transcript": transcript, "response": "".join(parts).strip()})
+        except Exception as e:
+            logger.exception("Error while streaming the patient reply: %s", e)
+            yield streaming.sse_event("error", {"error": str(e)})
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def transcribe(audio_file):
+    """
+    Whisper transcript of a file-like object; its `name` must carry the audio
+    format's extension (e.g. "speech.webm"). WAV recordings are downsampled and
+    silence-trimmed first (see audio.py); silent ones are not sent at all, and
+    audio transcribed before is answered from transcripts.cache.
+    """
+    prepared, stats = audio.prepare(audio_file)
+    if stats["preprocessed"]:
+        logger.info("Preprocessed recording: %s", stats)
+    if prepared is None:
+        return ""
+    key = transcripts.cache_key(prepared)
+    cached = transcripts.cache.get(key)
+    if cached is not None:
+        logger.info("Transcript served from cache.")
+        return cached
+
+    def whisper():
+        transcript_response = circuit_breaker.get("openai").call(
+            openai.Audio.transcribe,
+            model="whisper-1",
+            file=prepared,
+            # openai 0.28 otherwise waits up to 600 s; use the gateway's realtime budget.
+            request_timeout=llm_gateway.REQUEST_TIMEOUT["realtime"],
+        )
+        return transcript_response["text"]
+
+    # A resubmission that arrives while the first upload is still being transcribed shares it.
+    text = transcription_flight.do(key, whisper)
+    transcripts.cache.put(key, text)
+    return text
+
 # Import additional endpoints from history.views for patient history and question generation.
 from history.views import (
     generate_history,
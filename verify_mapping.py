@@ -1,12 +1,13 @@
 import json
 import os
-import openai
 import logging
 import random
 import time
 from difflib import get_close_matches
 from google.cloud import bigquery
 
+from patient_history import llm_gateway
+
 # Configuration file names and paths
 MIMIC_MAPPING_FILE = "mimic_mapping.json"              # Your generated mimic mapping file
 TEXT2DT_MAPPING_FILE = "text2dt_mimic_mapping.json"      # The file containing Text2DT records with mimic mappings
@@ -74,14 +75,14 @@ def translate_to_chinese(english_text):
     prompt = f"Translate the following English medical condition into Chinese: '{english_text}'"
     logger.info(f"Translating to Chinese: {english_text}")
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = llm_gateway.chat_completion(
+            "offline",
+            route="mapping_translate",
             messages=[
                 {"role": "system", "content": "You are a medical translation assistant."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=60,
         )
         translation = response["choices"][0]["message"]["content"].strip()
         logger.info(f"Translation result: {translation}")
@@ -110,14 +111,14 @@ Provide a brief explanation and then state either "Correct" or "Incorrect".
 """
     logger.info(f"Sending verification prompt to ChatGPT for group '{group_name}'")
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = llm_gateway.chat_completion(
+            "offline",
+            route="mapping_verify",
             messages=[
                 {"role": "system", "content": "You are a medical coding assistant."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=200,
         )
         answer = response["choices"][0]["message"]["content"].strip()
         logger.info(f"ChatGPT verification response: {answer}")